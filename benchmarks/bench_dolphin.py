@@ -0,0 +1,488 @@
+"""
+This module contains the offline benchmark for the dolphin command.
+
+It drives CommandsDolphin.command and an_event_handler with fake Discord
+contexts, a deterministic fake streaming LLM and an in-memory Redis, so the
+streaming and concurrency paths can be measured without a GPU, a Discord
+token or a Redis server.
+
+    python benchmarks/bench_dolphin.py --users 8 --tokens 256 --token-rate 40
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import os
+import statistics
+import struct
+import sys
+import tempfile
+import time
+
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+os.environ.setdefault("DOLPHIN_PATH", tempfile.mkdtemp(prefix="dolphin-bench-"))
+os.environ.setdefault("DOLPHIN_MODELS", "fake:fake.gguf")
+os.environ.setdefault(
+    "DOLPHIN_MODEL_PROFILES", os.path.join(os.environ["DOLPHIN_PATH"], "models.json")
+)
+os.environ.setdefault("DOLPHIN_REDIS", "localhost")
+os.environ.setdefault("DOLPHIN_SYSTEM_PROMPT", "You are Dolphin, a helpful AI assistant.")
+os.environ.setdefault("DOLPHIN_CMD_CHANNEL", "1")
+# header-only GGUF so the startup model validation passes
+with open(os.path.join(os.environ["DOLPHIN_PATH"], "fake.gguf"), "wb") as fake_gguf:
+    fake_gguf.write(b"GGUF" + struct.pack("<IQQ", 3, 0, 0))
+# the llama2 template comes from the llama_index llama.cpp integration, which imports
+# llama.cpp; the ChatML one is built in, so the benchmark runs without llama-cpp-python
+if not os.path.isfile(os.environ["DOLPHIN_MODEL_PROFILES"]):
+    with open(os.environ["DOLPHIN_MODEL_PROFILES"], "w", encoding="utf-8") as profiles_file:
+        json.dump([{"name": "fake", "file": "fake.gguf", "chat_format": "chatml"}], profiles_file)
+
+# pylint: disable=wrong-import-position
+from commands.dolphin import CommandsDolphin  # noqa: E402
+from utils.generation import GenerationExecutor  # noqa: E402
+from utils.history import ChatHistory  # noqa: E402
+from utils.inflight import InflightRegistry  # noqa: E402
+
+
+class FakeLlama:  # pylint: disable=too-few-public-methods
+    """
+    This class contains the FakeLlama, a deterministic streaming model.
+    """
+
+    def __init__(self, tokens: int, token_rate: float) -> None:
+        self.tokens = tokens
+        self.token_rate = token_rate
+
+    def __call__(
+        self,
+        prompt: str,
+        stream: bool = False,
+        max_tokens: int = 2048,
+        stopping_criteria=None,
+        **_kwargs
+    ):
+        for index in range(min(self.tokens, max_tokens)):
+            time.sleep(1 / self.token_rate)
+            if stopping_criteria is not None and stopping_criteria(None, None):
+                break
+            yield {"choices": [{"text": f"tok{index} "}]}
+
+
+class FakePool:
+    """
+    This class contains the FakePool serving one FakeLlama per model.
+    """
+
+    def __init__(self, llm: FakeLlama) -> None:
+        self.llm = llm
+        self.models = [{"name": "fake", "file": "fake.gguf"}]
+        self.loaded = {}
+
+    @contextmanager
+    def acquire(self, _index: int):
+        """
+        function acquire yield the fake model
+        """
+        yield self.llm
+
+    def count_tokens(self, _index: int, texts):
+        """
+        function count_tokens count the fake tokens
+        """
+        return [len(text) // 4 for text in texts]
+
+    def close(self) -> None:
+        """
+        function close does nothing
+        """
+
+
+class FakePipeline:
+    """
+    This class contains the FakePipeline queuing the FakeRedis calls.
+    """
+
+    def __init__(self, redis: "FakeRedis") -> None:
+        self.redis = redis
+        self.calls = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+        return queue
+
+    async def execute(self):
+        """
+        function execute run the queued calls in one simulated round-trip
+        """
+        await asyncio.sleep(self.redis.latency)
+        return [
+            getattr(self.redis, f"do_{name}")(*args, **kwargs) for name, args, kwargs in self.calls
+        ]
+
+
+class FakeRedis:
+    """
+    This class contains the FakeRedis, an in-memory stand-in for the chat store.
+    """
+
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.lists = {}
+        self.values = {}
+
+    def pipeline(self, transaction: bool = True):  # pylint: disable=unused-argument
+        """
+        function pipeline return a fake pipeline
+        """
+        return FakePipeline(self)
+
+    def do_lrange(self, key, start, end):
+        """
+        function do_lrange return a list slice
+        """
+        items = self.lists.get(key, [])
+        return items[start:] if end == -1 else items[start:end + 1]
+
+    def do_llen(self, key):
+        """
+        function do_llen return a list length
+        """
+        return len(self.lists.get(key, []))
+
+    def do_lindex(self, key, index):
+        """
+        function do_lindex return a list item
+        """
+        items = self.lists.get(key, [])
+        return items[index] if -len(items) <= index < len(items) else None
+
+    def do_rpush(self, key, *values):
+        """
+        function do_rpush append to a list
+        """
+        self.lists.setdefault(key, []).extend(values)
+        return len(self.lists[key])
+
+    def do_expire(self, key, _ttl):
+        """
+        function do_expire does nothing
+        """
+        return key in self.lists
+
+    def do_hset(self, key, mapping):
+        """
+        function do_hset store a hash
+        """
+        self.values.setdefault(key, {}).update(mapping)
+        return len(mapping)
+
+    def do_set(self, key, value, ex=None):  # pylint: disable=unused-argument
+        """
+        function do_set store a value
+        """
+        self.values[key] = value
+        return True
+
+    def do_get(self, key):
+        """
+        function do_get return a value
+        """
+        return self.values.get(key)
+
+    def do_exists(self, key):
+        """
+        function do_exists check a key
+        """
+        return int(key in self.values or key in self.lists)
+
+    def do_publish(self, _channel, _message):
+        """
+        function do_publish has no subscribers
+        """
+        return 0
+
+    async def delete(self, *keys):
+        """
+        function delete drop lists and values
+        """
+        await asyncio.sleep(self.latency)
+        for key in keys:
+            self.lists.pop(key, None)
+            self.values.pop(key, None)
+
+    async def aclose(self):
+        """
+        function aclose does nothing
+        """
+
+
+class FakeMessage:  # pylint: disable=too-few-public-methods
+    """
+    This class contains the FakeMessage returned by follow-up sends.
+    """
+
+    def __init__(self, context: "FakeContext") -> None:
+        self.context = context
+
+    async def edit(self, **kwargs):
+        """
+        function edit record a follow-up edit
+        """
+        await self.context.record("message_edit", kwargs)
+        return self
+
+
+class FakeContext:  # pylint: disable=too-many-instance-attributes
+    """
+    This class contains the FakeContext standing in for SlashContext and ComponentContext.
+    """
+
+    def __init__(self, bot, author, edit_latency: float, custom_id: str = "") -> None:
+        self.client = bot
+        self.bot = bot
+        self.author = author
+        self.channel = SimpleNamespace(id=1)
+        self.token = f"token-{author.id}"
+        self.custom_id = custom_id
+        self.resolved = None
+        self.edit_latency = edit_latency
+        self.started = time.monotonic()
+        self.calls = []
+
+    async def record(self, kind: str, kwargs) -> None:
+        """
+        function record log a Discord call after the simulated REST latency
+        """
+        await asyncio.sleep(self.edit_latency)
+        self.calls.append((time.monotonic() - self.started, kind, kwargs))
+
+    async def defer(self, **kwargs):
+        """
+        function defer record the deferral
+        """
+        await self.record("defer", kwargs)
+
+    async def edit(self, **kwargs):
+        """
+        function edit record an edit of the original response
+        """
+        await self.record("edit", kwargs)
+
+    async def send(self, *_args, **kwargs):
+        """
+        function send record a message send
+        """
+        await self.record("send", kwargs)
+        return FakeMessage(self)
+
+    def first_answer(self) -> float:
+        """
+        function first_answer return the time of the first edit showing generated text
+        """
+        for at, _, kwargs in self.calls:
+            for embed in kwargs.get("embeds") or []:
+                if "tok" in (getattr(embed, "description", "") or ""):
+                    return at
+        return None
+
+    def custom_ids(self, prefix: str):
+        """
+        function custom_ids return the button ids sent with the response
+        """
+        for _, _, kwargs in self.calls:
+            for row in kwargs.get("components") or []:
+                for button in getattr(row, "components", [row]):
+                    custom_id = getattr(button, "custom_id", "") or ""
+                    if custom_id.startswith(prefix):
+                        yield custom_id
+
+
+class FakeBot:
+    """
+    This class contains the FakeBot accepting the extension registration calls.
+    """
+
+    def __init__(self) -> None:
+        self.ext = {}
+        self.logger = SimpleNamespace(debug=print, info=print, warning=print, error=print)
+        self.app = SimpleNamespace(id=1, name="Dolphin")
+        self.user = SimpleNamespace(id=1, avatar_url="https://example.invalid/bot.png")
+        bucket = SimpleNamespace(delta=0.0, remaining=5)
+        self.http = SimpleNamespace(get_ratelimit=lambda route: bucket)
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+    async def fetch_user(self, user_id: int):
+        """
+        function fetch_user return a fake user
+        """
+        return fake_author(user_id)
+
+    def get_user(self, user_id: int):
+        """
+        function get_user return a fake user
+        """
+        return fake_author(user_id)
+
+
+def fake_author(user_id: int) -> SimpleNamespace:
+    """
+    function fake_author build a fake guild member
+    """
+    async def send(*_args, **_kwargs):
+        return None
+    return SimpleNamespace(
+        id=user_id,
+        display_name=f"user{user_id}",
+        avatar_url="https://example.invalid/user.png",
+        roles=[],
+        send=send
+    )
+
+
+def bind(obj, ext):
+    """
+    function bind return the callback of a command or listener bound to the extension
+    """
+    callback = obj.callback
+    if isinstance(callback, functools.partial):
+        return callback
+    return functools.partial(callback, ext)
+
+
+def timed(samples: list, func):
+    """
+    function timed wrap a coroutine function recording its latency
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.monotonic()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            samples.append(time.monotonic() - started)
+    return wrapper
+
+
+async def monitor_lag(samples: list, interval: float = 0.01) -> None:
+    """
+    function monitor_lag sample the event loop lag
+    """
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        samples.append(time.monotonic() - started - interval)
+
+
+def summary(name: str, samples: list, unit: str = "ms", scale: float = 1000) -> str:
+    """
+    function summary format p50/p95/max of a sample list
+    """
+    if not samples:
+        return f"{name:<24} n=0"
+    ordered = sorted(samples)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    return (
+        f"{name:<24} n={len(ordered):<5} p50={statistics.median(ordered) * scale:8.2f}{unit} "
+        f"p95={p95 * scale:8.2f}{unit} max={ordered[-1] * scale:8.2f}{unit}"
+    )
+
+
+async def run_user(ext, bot, user_id: int, args, stats: dict) -> None:
+    """
+    function run_user run one /dolphin call followed by the button clicks
+    """
+    author = fake_author(user_id)
+    ctx = FakeContext(bot, author, args.edit_latency)
+    command = bind(ext.command, ext)
+    handler = bind(ext.an_event_handler, ext)
+    cancel_task = None
+    if args.cancel_after:
+        async def click_cancel():
+            await asyncio.sleep(args.cancel_after)
+            for custom_id in ctx.custom_ids("button_cancel_"):
+                click = FakeContext(bot, author, args.edit_latency, custom_id)
+                await handler(SimpleNamespace(ctx=click))
+                break
+        cancel_task = asyncio.create_task(click_cancel())
+    await command(ctx, prompt=f"Question {user_id}", model=0, max_new_tokens=args.tokens)
+    if cancel_task is not None:
+        cancel_task.cancel()
+    stats["duration"].append(time.monotonic() - ctx.started)
+    stats["edits"].append(sum(1 for _, kind, _ in ctx.calls if kind != "defer"))
+    first = ctx.first_answer()
+    if first is not None:
+        stats["first_edit"].append(first)
+    for button in ("show", "send"):
+        click = FakeContext(bot, author, args.edit_latency, f"button_{button}_{user_id}")
+        started = time.monotonic()
+        await handler(SimpleNamespace(ctx=click))
+        stats["handler"].append(time.monotonic() - started)
+
+
+async def main(args) -> None:
+    """
+    Main function
+    """
+    bot = FakeBot()
+    ext = CommandsDolphin(bot)
+    ext.pool = FakePool(FakeLlama(args.tokens, args.token_rate))
+    ext.generation = GenerationExecutor(ext.pool, workers=args.workers)
+    ext.scheduler.concurrent = args.workers
+    ext.history = ChatHistory(FakeRedis(args.redis_latency))
+    ext.inflight = InflightRegistry(ext.history.redis, "bench", on_stop=ext.scheduler.notify)
+    stats = {key: [] for key in (
+        "duration", "edits", "first_edit", "handler", "lag", "history_get", "history_append"
+    )}
+    ext.history.get = timed(stats["history_get"], ext.history.get)
+    ext.history.append = timed(stats["history_append"], ext.history.append)
+    lag = asyncio.create_task(monitor_lag(stats["lag"]))
+    started = time.monotonic()
+    await asyncio.gather(*[
+        run_user(ext, bot, 1000 + user, args, stats) for user in range(args.users)
+    ])
+    elapsed = time.monotonic() - started
+    lag.cancel()
+    ext.generation.shutdown()
+    print(f"users={args.users} workers={args.workers} tokens={args.tokens} "
+          f"token_rate={args.token_rate}/s edit_latency={args.edit_latency * 1000:.0f}ms")
+    print(summary("time to first edit", stats["first_edit"]))
+    print(summary("generation wall time", stats["duration"], "s", 1))
+    print(summary("edits per generation", stats["edits"], "", 1))
+    print(summary("event loop lag", stats["lag"]))
+    print(summary("history get", stats["history_get"]))
+    print(summary("history append", stats["history_append"]))
+    print(summary("button handler", stats["handler"]))
+    print(f"{'throughput':<24} {args.users / elapsed:.2f} req/s "
+          f"{args.users * args.tokens / elapsed:.1f} tok/s")
+
+
+def parse_args():
+    """
+    function parse_args parse the benchmark options
+    """
+    parser = argparse.ArgumentParser(description="Offline dolphin command benchmark")
+    parser.add_argument("--users", type=int, default=4, help="concurrent users")
+    parser.add_argument("--workers", type=int, default=1, help="generation slots")
+    parser.add_argument("--tokens", type=int, default=256, help="tokens per answer")
+    parser.add_argument("--token-rate", type=float, default=40.0, help="fake tokens per second")
+    parser.add_argument("--edit-latency", type=float, default=0.08, help="Discord REST latency")
+    parser.add_argument("--redis-latency", type=float, default=0.002, help="Redis round-trip")
+    parser.add_argument("--cancel-after", type=float, default=0.0, help="click Cancel after N s")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
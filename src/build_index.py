@@ -0,0 +1,47 @@
+"""
+This module contains the retrieval index builder for bot.
+"""
+
+import argparse
+import logging
+import time
+
+from utils.logs import setup_logging
+from utils.retrieval import DEFAULT_EMBED_MODEL, build_index
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    """
+    Main function
+    """
+    parser = argparse.ArgumentParser(description="Embed a document directory for /dolphin")
+    parser.add_argument("input_dir", help="directory of documents to index")
+    parser.add_argument("output_dir", help="directory to write the index to")
+    parser.add_argument("--model", default=DEFAULT_EMBED_MODEL, help="HuggingFace embedding model")
+    parser.add_argument("--dtype", choices=("float16", "int8"), default="float16",
+                        help="stored vector type")
+    parser.add_argument("--batch-size", type=int, default=64, help="chunks embedded per batch")
+    parser.add_argument("--chunk-size", type=int, default=512, help="tokens per chunk")
+    parser.add_argument("--chunk-overlap", type=int, default=64, help="tokens shared by chunks")
+    args = parser.parse_args()
+    listener = setup_logging()
+    try:
+        started = time.perf_counter()
+        count = build_index(
+            args.input_dir,
+            args.output_dir,
+            model_name=args.model,
+            dtype=args.dtype,
+            batch_size=args.batch_size,
+            chunk_size=args.chunk_size,
+            chunk_overlap=args.chunk_overlap
+        )
+        logger.info("Indexed %s chunks into %s in %.2fs", count, args.output_dir,
+                    time.perf_counter() - started)
+    finally:
+        listener.stop()
+
+if __name__ == "__main__":
+    main()
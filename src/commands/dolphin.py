@@ -3,44 +3,85 @@ This module contains the dolphin command for bot.
 """
 
 import asyncio
+import logging
 import os
 import time
-import io
 import uuid
 
-from typing import List
+from contextlib import aclosing
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 from dotenv import load_dotenv
 from interactions import slash_command, SlashCommandChoice, slash_option, \
-    SlashContext, max_concurrency, Buckets, Button, ActionRow, ButtonStyle, \
+    SlashContext, Button, ActionRow, ButtonStyle, \
     Embed, EmbedAuthor, EmbedFooter, Extension, OptionType, listen, File
-from interactions.ext.paginators import Paginator
-from interactions.api.events import Component
+from interactions.api.events import Component, Ready
 
-# from llama_index.core import SimpleDirectoryReader, VectorStoreIndex
 from llama_index.core.llms import ChatMessage, MessageRole
-from llama_index.llms.llama_cpp import LlamaCPP
-from llama_index.llms.llama_cpp.llama_utils import (
-    messages_to_prompt,
-    completion_to_prompt,
-)
-from llama_index.storage.chat_store.redis import RedisChatStore
-from llama_index.core.memory import ChatMemoryBuffer
+from redis.asyncio import Redis
 
-# from utils.chat import chat_messages_template
+from utils.admission import AdmissionController
+from utils.budget import HistoryBudgeter
+from utils.chat import chat_messages_template, messages_to_prompt, set_prefixes
+from utils.client import InferenceClient
+from utils.compaction import Compactor
+from utils.generation import GenerationExecutor, StopSignal
+from utils.history import ChatHistory
+from utils.inflight import InflightRegistry
+from utils.metrics import ADMISSION_TOTAL, CANCELS_TOTAL, ERRORS_TOTAL
+from utils.models import (
+    DOLPHIN_BATCH_SLOTS,
+    DOLPHIN_CONTEXT_WINDOW,
+    DOLPHIN_PREWARM,
+    ModelPool,
+    get_models,
+    parse_prewarm,
+    sampling_kwargs
+)
+from utils.renderer import EmbedRenderer
+from utils.quota import TokenQuota
+from utils.response_cache import ResponseCache
+from utils.scheduler import Cancelled, QueueFull, Scheduler
+from utils.transcript import export_transcript
+from utils.work_queue import DOLPHIN_REPLICA_ID, DOLPHIN_WORK_QUEUE, WorkQueueClient
 
 load_dotenv()
-DOLPHIN_PATH = os.getenv('DOLPHIN_PATH')
-DOLPHIN_MODELS = os.getenv('DOLPHIN_MODELS')
 DOLPHIN_REDIS = os.getenv('DOLPHIN_REDIS')
-DOLPHIN_GPU_LAYERS = os.getenv('DOLPHIN_GPU_LAYERS')
-DOLPHIN_NTHREADS = os.getenv('DOLPHIN_NTHREADS')
 DOLPHIN_SYSTEM_PROMPT = os.getenv('DOLPHIN_SYSTEM_PROMPT')
 DOLPHIN_EMBED_URL = os.getenv('DOLPHIN_EMBED_URL')
 DOLPHIN_EMBED_IMG = os.getenv('DOLPHIN_EMBED_IMG')
 DOLPHIN_CMD_SCOPE = int(os.getenv('DOLPHIN_CMD_SCOPE',str(1156064224225808488)))
 DOLPHIN_CMD_CHANNEL = int(os.getenv('DOLPHIN_CMD_CHANNEL',str(1189670522653511740)))
 DOLPHIN_MAX_REQ = int(os.getenv('DOLPHIN_MAX_REQ', str(1)))
+DOLPHIN_MAX_QUEUE = int(os.getenv('DOLPHIN_MAX_QUEUE', str(32)))
+DOLPHIN_PRIORITY_ROLES = os.getenv('DOLPHIN_PRIORITY_ROLES', '')
+DOLPHIN_INFERENCE_URL = os.getenv('DOLPHIN_INFERENCE_URL')
+DOLPHIN_RESPONSE_CACHE_SIZE = int(os.getenv('DOLPHIN_RESPONSE_CACHE_SIZE', str(0)))
+DOLPHIN_RESPONSE_CACHE_TTL = int(os.getenv('DOLPHIN_RESPONSE_CACHE_TTL', str(3600)))
+DOLPHIN_COMPACTION_TOKENS = int(os.getenv('DOLPHIN_COMPACTION_TOKENS', str(0)))
+DOLPHIN_COMPACTION_MODEL = int(os.getenv('DOLPHIN_COMPACTION_MODEL', str(0)))
+DOLPHIN_COMPACTION_KEEP = int(os.getenv('DOLPHIN_COMPACTION_KEEP', str(4)))
+DOLPHIN_UPLOAD_LIMIT_MB = int(os.getenv('DOLPHIN_UPLOAD_LIMIT_MB', str(10)))
+DOLPHIN_MAX_GENERATION_SECONDS = int(os.getenv('DOLPHIN_MAX_GENERATION_SECONDS', str(300)))
+DOLPHIN_MAX_GENERATION_TOKENS = int(os.getenv('DOLPHIN_MAX_GENERATION_TOKENS', str(4096)))
+DOLPHIN_QUOTA_TOKENS = int(os.getenv('DOLPHIN_QUOTA_TOKENS', str(0)))
+DOLPHIN_QUOTA_REFILL_PER_MINUTE = int(os.getenv('DOLPHIN_QUOTA_REFILL_PER_MINUTE', str(1000)))
+DOLPHIN_QUOTA_ROLES = os.getenv('DOLPHIN_QUOTA_ROLES', '')
+DOLPHIN_USER_CACHE_TTL = int(os.getenv('DOLPHIN_USER_CACHE_TTL', str(300)))
+DOLPHIN_ADMISSION_SLO_SECONDS = float(os.getenv('DOLPHIN_ADMISSION_SLO_SECONDS', str(0)))
+DOLPHIN_ADMISSION_MIN_TOKENS = int(os.getenv('DOLPHIN_ADMISSION_MIN_TOKENS', str(256)))
+DOLPHIN_FALLBACK_MODEL = int(os.getenv('DOLPHIN_FALLBACK_MODEL', str(-1)))
+DOLPHIN_DECODE_RATE = float(os.getenv('DOLPHIN_DECODE_RATE', str(10)))
+DOLPHIN_PREFILL_RATE = float(os.getenv('DOLPHIN_PREFILL_RATE', str(200)))
+DOLPHIN_RETRIEVAL_INDEX = os.getenv('DOLPHIN_RETRIEVAL_INDEX')
+DOLPHIN_RETRIEVAL_TOP_K = int(os.getenv('DOLPHIN_RETRIEVAL_TOP_K', str(4)))
+DOLPHIN_RETRIEVAL_MIN_SCORE = float(os.getenv('DOLPHIN_RETRIEVAL_MIN_SCORE', str(0.5)))
+DOLPHIN_RETRIEVAL_CACHE_SIZE = int(os.getenv('DOLPHIN_RETRIEVAL_CACHE_SIZE', str(256)))
+
+logger = logging.getLogger(__name__)
 
+# the extension holds one collaborator per concern of the command, and every
+# command, button and listener of /dolphin is one of its methods
+# pylint: disable-next=too-many-instance-attributes,too-many-public-methods
 class CommandsDolphin(Extension):
     """
     This class contains the CommandsDolphin.
@@ -48,30 +89,133 @@ class CommandsDolphin(Extension):
 
     def __init__(self, bot) -> None:
         self.bot = bot
-        self.concurrency = 0
-        self.conversations = {}
-        self.chat_store = RedisChatStore(redis_url=f"redis://{DOLPHIN_REDIS}:6379", ttl=300)
-        models_strings = DOLPHIN_MODELS.split(",")
-        self.models = []
-        for model_str in models_strings:
-            name, path = model_str.split(":")
-            self.models.append({
-                "name": name,
-                "file": f"{DOLPHIN_PATH}/{path}"
-            })
+        self.history = ChatHistory.from_url(f"redis://{DOLPHIN_REDIS}:6379", ttl=300)
+        self.inflight = InflightRegistry(
+            self.history.redis, DOLPHIN_REPLICA_ID, ttl=DOLPHIN_MAX_GENERATION_SECONDS + 600
+        )
+        self.response_cache = ResponseCache(
+            self.history.redis,
+            size=DOLPHIN_RESPONSE_CACHE_SIZE,
+            ttl=DOLPHIN_RESPONSE_CACHE_TTL
+        )
+        self.quota = TokenQuota(
+            self.history.redis,
+            capacity=DOLPHIN_QUOTA_TOKENS,
+            refill_per_minute=DOLPHIN_QUOTA_REFILL_PER_MINUTE,
+            roles=TokenQuota.parse_roles(DOLPHIN_QUOTA_ROLES)
+        )
+        self.models = get_models()
+        if DOLPHIN_WORK_QUEUE:
+            self.pool = None
+            self.generation = WorkQueueClient(
+                Redis.from_url(f"redis://{DOLPHIN_REDIS}:6379"), self.models, self.inflight
+            )
+        elif DOLPHIN_INFERENCE_URL:
+            self.pool = None
+            self.generation = InferenceClient(DOLPHIN_INFERENCE_URL)
+        else:
+            set_prefixes(DOLPHIN_SYSTEM_PROMPT, self.models)
+            self.pool = ModelPool(self.models, slots=DOLPHIN_BATCH_SLOTS)
+            self.pool.validate()
+            if DOLPHIN_BATCH_SLOTS:
+                # the batch engine drives llama.cpp directly, import it only when enabled
+                # pylint: disable-next=import-outside-toplevel
+                from utils.batching import BatchedGenerationExecutor
+                self.generation = BatchedGenerationExecutor(self.pool, slots=DOLPHIN_BATCH_SLOTS)
+            else:
+                self.generation = GenerationExecutor(self.pool, workers=DOLPHIN_MAX_REQ)
+        self.budgeter = HistoryBudgeter(
+            # looked up on each call so a later swap of self.generation is picked up
+            # pylint: disable-next=unnecessary-lambda
+            lambda model, texts: self.generation.count_tokens(model, texts),
+            self.models,
+            DOLPHIN_CONTEXT_WINDOW
+        )
+        self.scheduler = Scheduler(
+            concurrent=DOLPHIN_MAX_REQ,
+            lane_concurrent=max(1, DOLPHIN_BATCH_SLOTS),
+            max_queue=DOLPHIN_MAX_QUEUE
+        )
+        # a cancel from another replica wakes the request if it is still queued here
+        self.inflight.on_stop = self.scheduler.notify
+        self.admission = AdmissionController(
+            self.scheduler,
+            self.models,
+            slo=DOLPHIN_ADMISSION_SLO_SECONDS,
+            min_tokens=DOLPHIN_ADMISSION_MIN_TOKENS,
+            fallback=DOLPHIN_FALLBACK_MODEL,
+            decode_rate=DOLPHIN_DECODE_RATE,
+            prefill_rate=DOLPHIN_PREFILL_RATE
+        )
+        self.compactor = Compactor(
+            self.history,
+            self.generation,
+            self.scheduler,
+            self.budgeter,
+            model=DOLPHIN_COMPACTION_MODEL,
+            threshold=DOLPHIN_COMPACTION_TOKENS,
+            keep=DOLPHIN_COMPACTION_KEEP
+        )
+        self.retriever = None
+        if DOLPHIN_RETRIEVAL_INDEX:
+            # numpy and the embedding model are only needed with an index
+            # pylint: disable-next=import-outside-toplevel
+            from utils.retrieval import Retriever, VectorIndex
+            started = time.perf_counter()
+            self.retriever = Retriever(
+                VectorIndex(DOLPHIN_RETRIEVAL_INDEX),
+                top_k=DOLPHIN_RETRIEVAL_TOP_K,
+                min_score=DOLPHIN_RETRIEVAL_MIN_SCORE,
+                cache_size=DOLPHIN_RETRIEVAL_CACHE_SIZE
+            )
+            logger.info("Loaded retrieval index %s with %s chunks in %.3fs",
+                        DOLPHIN_RETRIEVAL_INDEX, len(self.retriever.index),
+                        time.perf_counter() - started)
+        self.prewarm_task = None
+        self.user_cards: Dict[str, Tuple[float, str, str]] = {}
+        self.priority_roles = {}
+        for role_str in filter(None, DOLPHIN_PRIORITY_ROLES.split(",")):
+            role, priority = role_str.split(":")
+            self.priority_roles[int(role)] = int(priority)
         self.add_ext_check(self.a_check)
 
     async def a_check(self, ctx: SlashContext) -> bool:
         """
         This function contains the check validation.
         """
-        print(f"Check Status:\nChannel:{ctx.channel.id == DOLPHIN_CMD_CHANNEL}")
+        logger.debug("Check Status: Channel:%s", ctx.channel.id == DOLPHIN_CMD_CHANNEL)
         return bool(ctx.channel.id == DOLPHIN_CMD_CHANNEL)
 
-    # def drop(self):
-    #     super().drop()
+    @listen(Ready)
+    async def prewarm_models(self, _: Ready):
+        """
+        Load the DOLPHIN_PREWARM models in the background once the gateway is ready
+        """
+        self.inflight.start()
+        self.history.start()
+        if self.retriever is not None:
+            asyncio.create_task(self.retriever.warm())
+        if self.pool is None or self.prewarm_task is not None:
+            return
+        indexes = parse_prewarm(DOLPHIN_PREWARM, self.models)
+        if indexes:
+            self.prewarm_task = asyncio.get_running_loop().run_in_executor(
+                None, self.pool.prewarm, indexes
+            )
+
+    def drop(self):
+        """
+        This function frees the resident models when the extension is dropped.
+        """
+        self.generation.shutdown()
+        if self.retriever is not None:
+            self.retriever.shutdown()
+        asyncio.get_event_loop().create_task(self.inflight.close())
+        asyncio.get_event_loop().create_task(self.history.close())
+        if self.pool is not None:
+            self.pool.close()
+        super().drop()
 
-    @max_concurrency(bucket=Buckets.CHANNEL, concurrent=DOLPHIN_MAX_REQ)
     @slash_command(
         name="dolphin",
         description="Cognitive Computations: Large Language Model Text Generation Inference Bot.",
@@ -166,125 +310,209 @@ class CommandsDolphin(Extension):
             top_k (int, optional): The top k parameter for text generation (default is 50).
             top_p (float, optional): The top p parameter for text generation (default is 0.95).
         """
-        print("Command start")
-        conversation_id = uuid.uuid4()
+        logger.debug("Command start")
         try:
-            print(model)
             model_selected=self.models[model]
-            print(model_selected["name"])
-            self.concurrency += 1
-            self.conversations[f"{ctx.author.id}_{conversation_id}_cancel"] = False
-            history = ChatMemoryBuffer.from_defaults(
-                token_limit=4096,
-                chat_store=self.chat_store,
-                chat_store_key=f"{ctx.author.id}",
-            )
-            response = ""
-            chat_template = self.get_chat_template(prompt=prompt, messages=history.get_all())
+            logger.debug("Model %s: %s", model, model_selected["name"])
+            messages = await self.history.get(f"{ctx.author.id}")
             embeds = self.get_chat_embeds(ctx=ctx, prompt=prompt, model_name=model_selected["name"])
-            cancel = Button(
-                custom_id=f"button_cancel_{ctx.author.id}_{conversation_id}",
-                style=ButtonStyle.RED,
-                label="Cancel",
-            )
-            components: list[ActionRow] = [
-                ActionRow(
-                    Button(
-                        custom_id=f"button_regenerate_{ctx.author.id}_{model}",
-                        style=ButtonStyle.PRIMARY,
-                        label="Regenerate",
-                    ),
-                    Button(
-                        custom_id=f"button_show_{ctx.author.id}",
-                        style=ButtonStyle.GREEN,
-                        label="Show Chat",
-                    ),
-                    Button(
-                        custom_id=f"button_send_{ctx.author.id}",
-                        style=ButtonStyle.GREY,
-                        label="Send Chat",
-                    ),
-                    Button(
-                        custom_id=f"button_clear_{ctx.author.id}",
-                        style=ButtonStyle.RED,
-                        label="Clear Chat",
-                    )
-                )
-            ]
             await ctx.defer()
+            # retrieval runs after the defer so a cold embedding model cannot miss the ack
+            chat_template = self.get_chat_template(
+                prompt=prompt, messages=messages, context=await self.get_context(prompt)
+            )
 
-            print("llama start")
+            logger.debug("llama start")
 
-            llm = LlamaCPP(
-                model_path=model_selected["file"],
-                temperature=temperature,
+            params = sampling_kwargs(
                 max_new_tokens=max_new_tokens,
-                context_window=8192,
-                generate_kwargs={
-                    "top_k": top_k,
-                    "top_p": top_p,
-                    "repeat_penalty": repeat_penalty
-                },
-                model_kwargs={
-                    "n_threads": int(DOLPHIN_NTHREADS),
-                    "n_gpu_layers": int(DOLPHIN_GPU_LAYERS)
-                },
-                messages_to_prompt=messages_to_prompt,
-                completion_to_prompt=completion_to_prompt,
-                verbose=True,
+                temperature=temperature,
+                repeat_penalty=repeat_penalty,
+                top_k=top_k,
+                top_p=top_p
             )
+            chat_template, fitted = await self.fit_chat_template(model, chat_template, params)
+            messages = chat_template[1:-1]
+            cache_key = None
+            cached = None
+            if self.response_cache.cacheable(params):
+                cache_key = self.response_cache.key(
+                    model_selected["name"], chat_template[0].content, messages, prompt, params
+                )
+                cached = await self.response_cache.get(cache_key)
+            reserved = 0
+            cost = 0.0
+            if cached is None:
+                admitted = await self.admit_request(ctx, model, chat_template, fitted)
+                if admitted is None:
+                    return
+                admitted_model, chat_template, admitted_params, cost = admitted
+                if admitted_model != model or admitted_params != fitted:
+                    # the answer comes from the fallback model or with fewer tokens than
+                    # the cache key was built for, keep it out of the cache
+                    cache_key = None
+                    model, fitted = admitted_model, admitted_params
+                    embeds = self.get_chat_embeds(
+                        ctx=ctx,
+                        prompt=prompt,
+                        model_name=self.get_admitted_name(model, fitted["max_tokens"])
+                    )
+                reserved = await self.reserve_quota(ctx, model, chat_template, fitted)
+                if reserved is None:
+                    return
 
-            ## Stream (give me multiple chunks to form the response)
-
-            update_interval = 0.6
-            last_update_time = time.time()
+            turn = None
+            try:
+                response, reason = await self.generate(
+                    ctx=ctx,
+                    model=model,
+                    chat_template=chat_template,
+                    params=fitted,
+                    embeds=embeds,
+                    cached=cached,
+                    cost=cost
+                )
+                if response is not None:
+                    turn = await self.get_turn_message(
+                        response, model, params, truncated=reason is not None
+                    )
+                    await self.history.append(f"{ctx.author.id}", chat_template[-1], turn)
+                    self.compactor.schedule(f"{ctx.author.id}", model)
+                    # a cut-off answer is not what the same request would get next time
+                    if cache_key is not None and cached is None and reason is None:
+                        await self.response_cache.put(cache_key, response)
+            finally:
+                if reserved:
+                    await self.settle_quota(ctx.author, model, fitted["max_tokens"], turn)
 
-            for chunk in llm.stream_chat(chat_template):
-                if self.conversations[f"{ctx.author.id}_{conversation_id}_cancel"] is True:
-                    llm.stop # noqa: W0104
-                    break
-                response += str(chunk.delta)
-                current_time = time.time()
-                if current_time - last_update_time >= update_interval:
-                    last_update_time = current_time
-                    if len(response) <= 4094:
-                        embeds[2].description = f"{response[:4094]}"
-                        await ctx.edit(embeds=embeds[:3], components=[cancel])
-                    elif len(response) > 4094:
-                        embeds[2].description = f"{response[:4094]}"
-                        embeds[2].footer = ""
-                        embeds[3].description = f"{response[4095:5700]}"
-                        await ctx.edit(embeds=embeds, components=[cancel])
-                    print(f"Embed updated at {time.strftime('%X')}", end="", flush=True)
-
-            response = response.replace("<|im_end|>","")
-            await asyncio.sleep(0.6)
-
-            if self.conversations[f"{ctx.author.id}_{conversation_id}_cancel"] is True:
-                embeds[1].description = f"~~{embeds[1].description[:500]}~~"
-                embeds[2].description = f"~~{response[:4094]}~~"
-                if len(response) <= 4094:
-                    await ctx.edit(embeds=embeds[:3], components=[])
-                elif len(response) > 4094:
-                    embeds[3].description = f"~~{response[4095:5700]}~~"
-                    await ctx.edit(embeds=embeds, components=[])
-            else:
-                if len(response) <= 4094:
-                    embeds[2].description = f"{response[:4094]}"
-                    await ctx.edit(embeds=embeds[:3], components=components)
-                elif len(response) > 4094:
-                    await ctx.edit(embeds=embeds, components=components)
-                history.put(chat_template[-1])
-                history.put(ChatMessage(role=MessageRole.ASSISTANT,content=f"{response}"))
+        except QueueFull:
+            ERRORS_TOTAL.inc(kind="queue_full")
+            await ctx.send("The queue is full, please try again in a few minutes.")
 
         except ImportError:
-            print(f"Error occurred in command: {ImportError}")
+            ERRORS_TOTAL.inc(kind="import")
+            logger.exception("Error occurred in command")
+
+        finally:
+            logger.debug("llama end")
+
+    async def generate(
+        self,
+        ctx: SlashContext,
+        model: int,
+        chat_template: List[ChatMessage],
+        params: Dict,
+        embeds: List[Embed],
+        cached: Optional[str] = None,
+        cost: float = 0.0
+    ) -> Tuple[Optional[str], Optional[str]]:
+        """
+        This function queues, streams and renders one generation.
+
+        Returns the response, or None when the user cancelled it, and the
+        reason it was cut off. A generation stopped by the wall-clock deadline
+        keeps the text generated so far and returns the reason "deadline".
+        `cost` is the admission estimate held in the lane backlog until done.
+        """
+        conversation_id = uuid.uuid4()
+        stop = StopSignal()
+        await self.inflight.add(
+            f"{conversation_id}", stop, author=f"{ctx.author.id}", model=self.models[model]["name"]
+        )
+        if DOLPHIN_MAX_GENERATION_TOKENS:
+            params = {
+                **params, "max_tokens": min(params["max_tokens"], DOLPHIN_MAX_GENERATION_TOKENS)
+            }
+        cancel = Button(
+            custom_id=f"button_cancel_{ctx.author.id}_{conversation_id}",
+            style=ButtonStyle.RED,
+            label="Cancel",
+        )
+        renderer = EmbedRenderer(ctx=ctx, embeds=embeds)
 
+        async def on_position(position: int, wait: float) -> None:
+            embeds[2].description = self.get_queue_status(position, wait)
+            await ctx.edit(embeds=embeds[:3], components=[cancel])
+
+        if cached is None:
+            self.admission.admit(model, cost)
+        try:
+            ## Stream (give me multiple chunks to form the response)
+            if cached is not None:
+                await self.stream_response(
+                    renderer, self.response_cache.replay(cached), stop, [cancel]
+                )
+            else:
+                async with self.scheduler.slot(
+                    author=f"{ctx.author.id}",
+                    lane=model,
+                    priority=self.get_priority(ctx.author),
+                    on_position=on_position,
+                    stop=stop
+                ):
+                    deadline = None
+                    if DOLPHIN_MAX_GENERATION_SECONDS:
+                        deadline = asyncio.get_running_loop().call_later(
+                            DOLPHIN_MAX_GENERATION_SECONDS, stop.stop, "deadline"
+                        )
+                    prompt = messages_to_prompt(chat_template, self.models[model]["chat_format"])
+                    try:
+                        deltas, decode_seconds = await self.stream_response(
+                            renderer,
+                            self.generation.stream(model, prompt, params, stop=stop),
+                            stop,
+                            [cancel]
+                        )
+                        self.admission.observe(model, deltas - 1, decode_seconds)
+                    finally:
+                        if deadline is not None:
+                            deadline.cancel()
+            if stop.reason == "deadline":
+                CANCELS_TOTAL.inc(reason="deadline")
+                logger.info("Generation %s hit the %ss deadline", conversation_id,
+                            DOLPHIN_MAX_GENERATION_SECONDS)
+            elif stop.reason is not None:
+                # the backends also set the event when a stream ends, only a reason means a cancel
+                await renderer.finish(components=[], strike=True)
+                return None, stop.reason
+            response = await renderer.finish(
+                components=self.get_chat_components(f"{ctx.author.id}", model)
+            )
+            return response, stop.reason
+        except Cancelled:
+            CANCELS_TOTAL.inc(reason="queued")
+            await renderer.finish(components=[], strike=True)
+            return None, "queued"
         finally:
-            print("llama end")
-            print(ctx.resolved)
-            self.concurrency -= 1
-            del self.conversations[f"{ctx.author.id}_{conversation_id}_cancel"]
+            if cached is None:
+                self.admission.release(model, cost)
+            await self.inflight.remove(f"{conversation_id}")
+
+    async def stream_response(
+        self,
+        renderer: EmbedRenderer,
+        stream: AsyncIterator[str],
+        stop: StopSignal,
+        components: list
+    ) -> Tuple[int, float]:
+        """
+        This function streams the deltas into the embeds until done or cancelled.
+
+        Returns the number of deltas rendered and the seconds since the first
+        one, which leaves the queue wait and the prefill out of the decode time.
+        """
+        deltas = 0
+        first = None
+        async with aclosing(stream):
+            async for delta in stream:
+                if stop.is_set():
+                    break
+                if first is None:
+                    first = time.perf_counter()
+                renderer.feed(delta)
+                deltas += 1
+                await renderer.update(components=components)
+        return deltas, time.perf_counter() - first if first is not None else 0.0
 
     @listen()
     async def an_event_handler(self, event: Component):
@@ -299,190 +527,402 @@ class CommandsDolphin(Extension):
             # Handle Cancel Button
             ####
             if (component_split[1] == "cancel" and author_id == component_split[-2]):
-                print("\n\ncancel press button\n\n")
-                if f"{author_id}_{component_split[-1]}_cancel" in self.conversations:
-                    self.conversations[f"{author_id}_{component_split[-1]}_cancel"] = True
+                logger.debug("cancel press button")
+                # the generation may run on another replica, the registry routes the cancel
+                if await self.inflight.cancel(component_split[-1], "user"):
+                    CANCELS_TOTAL.inc(reason="user")
             ####
             # Handle Show Button
             ####
             elif component_split[1] == "show":
-                history = ChatMemoryBuffer.from_defaults(
-                    token_limit=4096,
-                    chat_store=self.chat_store,
-                    chat_store_key=f"{component_split[-1]}",
+                embeds, components = await self.get_history_page(component_split[-1], 0)
+                if embeds is None:
+                    await ctx.send("You don't have nothing on chat!")
+                else:
+                    await ctx.send(embeds=embeds, components=components)
+            ####
+            # Handle Show Chat Page Buttons
+            ####
+            elif component_split[1] == "page":
+                embeds, components = await self.get_history_page(
+                    component_split[-1], int(component_split[-2])
                 )
-                messages = history.get_all()
-                if len(messages) == 0:
+                if embeds is None:
                     await ctx.send("You don't have nothing on chat!")
                 else:
-                    chat_embeds = []
-                    user = await self.client.fetch_user(int(component_split[-1]))
-                    for message in messages:
-                        if message.role == "user":
-                            chat_embeds.append(Embed(
-                                description=f"{message.content}",
-                                author = EmbedAuthor(
-                                    name=f"{user.display_name}",
-                                    icon_url=f"{user.avatar_url}",
-                                    url=f"{DOLPHIN_EMBED_URL}"
-                                    )
-                                )
-                            )
-                        elif message.role == "assistant":
-                            if len(message.content) <= 4094:
-                                chat_embeds.append(Embed(
-                                    description=f"{message.content[:4094]}",
-                                    author = EmbedAuthor(
-                                        name=f"{self.client.app.name}",
-                                        icon_url=f"{self.client.user.avatar_url}",
-                                        url=f"{DOLPHIN_EMBED_URL}"
-                                    )
-                                ))
-                            elif len(message.content) > 4094:
-                                chat_embeds.append(Embed(
-                                    description=f"{message.content[:4094]}",
-                                    author = EmbedAuthor(
-                                        name=f"{self.client.app.name}",
-                                        icon_url=f"{self.client.user.avatar_url}",
-                                        url=f"{DOLPHIN_EMBED_URL}"
-                                    )
-                                ))
-                                chat_embeds.append(Embed(
-                                    description=f"{message.content[4095:6000]}",
-                                ))
-                    paginator = Paginator.create_from_embeds(self.client, *chat_embeds)
-                    await paginator.send(ctx)
+                    await ctx.edit_origin(embeds=embeds, components=components)
             ####
             # Handle Send Chat Button
             ####
             elif component_split[1] == "send" and author_id == component_split[-1]:
-                history = ChatMemoryBuffer.from_defaults(
-                    token_limit=4096,
-                    chat_store=self.chat_store,
-                    chat_store_key=f"{component_split[-1]}",
-                )
                 user_dm = self.client.get_user(event.ctx.author.id)
-                messages = history.get_all()
-                formatted_messages = [
-                    f"{ctx.author.display_name}:{message.content}\n"
-                    if message.role == "user"
-                    else f"{self.client.app.name}:{message.content}\n"
-                    for message in messages
-                ]
-                result_text = ''.join(formatted_messages)
-                virtual_file = io.StringIO(result_text)
-                if len(messages) == 0:
+                files = await export_transcript(
+                    self.history.transcript(f"{component_split[-1]}"),
+                    lambda message: ctx.author.display_name
+                    if message.role == "user" else self.client.app.name,
+                    DOLPHIN_UPLOAD_LIMIT_MB * 1024 * 1024
+                )
+                if not files:
                     await ctx.send("You don't have nothing on chat!")
                 else:
-                    await user_dm.send(
-                        file=File(
-                            file=virtual_file,
-                            file_name="chat.txt",
-                            content_type="text/plain"
+                    for file_name, file in files:
+                        await user_dm.send(
+                            file=File(
+                                file=file,
+                                file_name=file_name,
+                                content_type="application/gzip"
+                                if file_name.endswith(".gz") else "text/plain"
+                            )
                         )
-                    )
                     await ctx.send("Chat send to DM!")
+                for _, file in files:
+                    file.close()
             ####
             # Handle Cleat Chat Button
             ####
             elif (component_split[1] == "clear" and author_id == component_split[-1]):
-                print("\n\nclear press button\n\n")
-                history = ChatMemoryBuffer.from_defaults(
-                    token_limit=4096,
-                    chat_store=self.chat_store,
-                    chat_store_key=f"{component_split[-1]}",
-                )
-                history.reset()
+                logger.debug("clear press button")
+                await self.history.clear(f"{component_split[-1]}")
                 await ctx.send("Chat clear!")
             ####
             # Handle Regenerate Button
             ####
             elif (component_split[1] == "regenerate" and author_id == component_split[-2]):
-                print("\n\nregenerate\n\n")
-                history = ChatMemoryBuffer.from_defaults(
-                    token_limit=4096,
-                    chat_store=self.chat_store,
-                    chat_store_key=f"{component_split[-1]}",
-                )
-                history_messages = history.get_all()
-                if len(history_messages) > 0:
-                    model_selected=self.models[int(component_split[-1])]
-                    messages = history_messages[:-2]
-                    response = ""
-                    chat_template = self.get_chat_template(
-                        prompt=history_messages[-2].content,
-                        messages=messages
-                    )
+                logger.debug("regenerate")
+                history_messages = await self.history.get(author_id)
+                if len(history_messages) > 1:
+                    turn = history_messages[-1].additional_kwargs
+                    model = int(turn.get("model", component_split[-1]))
+                    params = turn.get("params", sampling_kwargs())
+                    prompt = history_messages[-2].content
                     embeds = self.get_chat_embeds(
-                        ctx=ctx, prompt=history_messages[-2].content,
-                        model_name=model_selected["name"]
+                        ctx=ctx, prompt=prompt,
+                        model_name=self.models[model]["name"]
                     )
-                    print(chat_template)
-                    llm = LlamaCPP(
-                        model_path=model_selected["file"],
-                        temperature=0.1,
-                        max_new_tokens=4096,
-                        context_window=8192,
-                        generate_kwargs={
-                            "top_k": 50,
-                            "top_p": 0.95,
-                            "repeat_penalty": 1.3
-                        },
-                        model_kwargs={
-                            "n_threads": int(DOLPHIN_NTHREADS),
-                            "n_gpu_layers": int(DOLPHIN_GPU_LAYERS)
-                        },
-                        messages_to_prompt=messages_to_prompt,
-                        completion_to_prompt=completion_to_prompt,
-                        verbose=True,
+                    await ctx.defer(edit_origin=True)
+                    chat_template = self.get_chat_template(
+                        prompt=prompt,
+                        messages=history_messages[:-2],
+                        context=await self.get_context(prompt)
                     )
-                    await ctx.defer()
-                    response = await llm.chat(chat_template)
-                    print(response)
-                    if len(response) <= 4094:
-                        embeds[2].description = f"{response[:4094]}"
-                        await ctx.send(embeds=embeds[:3])
-                    elif len(response) > 4094:
-                        await ctx.send(embeds=embeds)
+                    chat_template, fitted = await self.fit_chat_template(
+                        model, chat_template, params
+                    )
+                    admitted = await self.admit_request(ctx, model, chat_template, fitted)
+                    if admitted is None:
+                        return
+                    admitted_model, chat_template, admitted_params, cost = admitted
+                    if admitted_model != model or admitted_params != fitted:
+                        model, fitted = admitted_model, admitted_params
+                        embeds = self.get_chat_embeds(
+                            ctx=ctx,
+                            prompt=prompt,
+                            model_name=self.get_admitted_name(model, fitted["max_tokens"])
+                        )
+                    reserved = await self.reserve_quota(ctx, model, chat_template, fitted)
+                    if reserved is None:
+                        return
+                    turn = None
+                    try:
+                        response, reason = await self.generate(
+                            ctx=ctx,
+                            model=model,
+                            chat_template=chat_template,
+                            params=fitted,
+                            embeds=embeds,
+                            cost=cost
+                        )
+                        if response is not None:
+                            turn = await self.get_turn_message(
+                                response, model, params, truncated=reason is not None
+                            )
+                            await self.history.replace_last(author_id, turn)
+                    except QueueFull:
+                        ERRORS_TOTAL.inc(kind="queue_full")
+                        await ctx.send("The queue is full, please try again in a few minutes.")
+                    finally:
+                        if reserved:
+                            await self.settle_quota(ctx.author, model, fitted["max_tokens"], turn)
                 else:
                     await ctx.send("Your chat conversation is empty to `regenerate` last question.")
-                # await ctx.edit_origin(content="we are working on regenerate!")
 
     @command.error
     async def command_error(self, e, *args, **kwargs):
         """
         Command error function handle error event
         """
-        print(f"Command hit error with {args=}, {kwargs=}")
-        print(e)
+        ERRORS_TOTAL.inc(kind=type(e).__name__)
+        logger.error("Command hit error with %s, args=%s, kwargs=%s", e, args, kwargs)
 
     @command.pre_run
     async def command_pre_run(self, *args, **kwargs):
         """
         Command pre-run function event
         """
-        print(f"I ran before the command did! {args=}, {kwargs=}")
+        logger.debug("I ran before the command did! args=%s, kwargs=%s", args, kwargs)
 
     @command.post_run
     async def command_post_run(self, *args, **kwargs):
         """
         Command post-run function event
         """
-        print(f"I ran after the command did! {args=}, {kwargs=}")
+        logger.debug("I ran after the command did! args=%s, kwargs=%s", args, kwargs)
 
-    def get_chat_template(self, prompt: str, messages: List[ChatMessage]):
+    def get_priority(self, author) -> int:
         """
-        function get_chat_template
+        function get_priority return the queue priority of the author roles
+        """
+        roles = getattr(author, "roles", [])
+        return max((self.priority_roles.get(int(role.id), 0) for role in roles), default=0)
+
+    async def admit_request(
+        self,
+        ctx: SlashContext,
+        model: int,
+        chat_template: List[ChatMessage],
+        params: Dict
+    ) -> Optional[Tuple[int, List[ChatMessage], Dict, float]]:
         """
-        chat_template = [
-            ChatMessage(
-                role=MessageRole.SYSTEM,
-                content=f"<|im_start|>system\n{DOLPHIN_SYSTEM_PROMPT}<|im_end|>\n"
+        function admit_request plan a request against the admission SLO
+
+        Returns the model, chat template, params and estimated cost to run
+        with, fewer tokens or the fallback model under load, or None after
+        telling the author the bot is overloaded.
+        """
+        max_tokens = params["max_tokens"]
+        if DOLPHIN_MAX_GENERATION_TOKENS:
+            max_tokens = min(max_tokens, DOLPHIN_MAX_GENERATION_TOKENS)
+        prompt_tokens = sum(await self.budgeter.count(model, chat_template))
+        plan = self.admission.plan(model, prompt_tokens, max_tokens)
+        if plan is None:
+            ADMISSION_TOTAL.inc(result="rejected")
+            await ctx.send(
+                "The bot is overloaded, the estimated wait is "
+                f"**{int(self.admission.wait(model))}s**. "
+                "Please try again later or ask for fewer tokens."
+            )
+            return None
+        admitted_model, admitted_tokens = plan
+        if admitted_model != model:
+            ADMISSION_TOTAL.inc(result="fallback")
+            chat_template, params = await self.fit_chat_template(
+                admitted_model, chat_template, params
+            )
+            prompt_tokens = sum(await self.budgeter.count(admitted_model, chat_template))
+        elif admitted_tokens < max_tokens:
+            ADMISSION_TOTAL.inc(result="shortened")
+        else:
+            ADMISSION_TOTAL.inc(result="admitted")
+        if admitted_tokens < params["max_tokens"]:
+            params = {**params, "max_tokens": admitted_tokens}
+        return (
+            admitted_model,
+            chat_template,
+            params,
+            self.admission.cost(admitted_model, prompt_tokens, params["max_tokens"])
+        )
+
+    def get_admitted_name(self, model: int, max_tokens: int) -> str:
+        """
+        function get_admitted_name label the answer of a request changed by admission
+        """
+        return f"{self.models[model]['name']} · up to {max_tokens} tokens under load"
+
+    async def reserve_quota(
+        self,
+        ctx: SlashContext,
+        model: int,
+        chat_template: List[ChatMessage],
+        params: Dict
+    ) -> Optional[int]:
+        """
+        function reserve_quota take the prompt and max answer tokens from the author's quota
+
+        Returns the reserved tokens (0 without a quota), or None after telling
+        the author when the budget refills.
+        """
+        if not self.quota.enabled(ctx.author):
+            return 0
+        cost = sum(await self.budgeter.count(model, chat_template)) + params["max_tokens"]
+        allowed, _, wait = await self.quota.take(ctx.author, cost)
+        if allowed:
+            return cost
+        ERRORS_TOTAL.inc(kind="quota")
+        await ctx.send(
+            f"You have used your token budget, it refills <t:{int(time.time() + wait) + 1}:R>."
+        )
+        return None
+
+    async def settle_quota(
+        self,
+        author,
+        model: int,
+        max_tokens: int,
+        turn: Optional[ChatMessage]
+    ) -> None:
+        """
+        function settle_quota refund the reserved answer tokens that were not generated
+        """
+        generated = 0
+        if turn is not None:
+            generated = turn.additional_kwargs["tokens"][self.models[model]["name"]]
+        await self.quota.refund(author, max_tokens - generated)
+
+    def get_chat_components(self, author_id: str, model: int) -> List[ActionRow]:
+        """
+        function get_chat_components build the buttons of a finished answer
+        """
+        return [
+            ActionRow(
+                Button(
+                    custom_id=f"button_regenerate_{author_id}_{model}",
+                    style=ButtonStyle.PRIMARY,
+                    label="Regenerate",
+                ),
+                Button(
+                    custom_id=f"button_show_{author_id}",
+                    style=ButtonStyle.GREEN,
+                    label="Show Chat",
+                ),
+                Button(
+                    custom_id=f"button_send_{author_id}",
+                    style=ButtonStyle.GREY,
+                    label="Send Chat",
+                ),
+                Button(
+                    custom_id=f"button_clear_{author_id}",
+                    style=ButtonStyle.RED,
+                    label="Clear Chat",
+                )
+            )
+        ]
+
+    async def get_user_card(self, user_id: str) -> Tuple[str, str]:
+        """
+        function get_user_card return the display name and avatar of a user, cached for a while
+        """
+        now = time.monotonic()
+        card = self.user_cards.get(user_id)
+        if card is None or card[0] < now:
+            user = await self.client.fetch_user(int(user_id))
+            self.user_cards = {
+                key: value for key, value in self.user_cards.items() if value[0] >= now
+            }
+            card = (now + DOLPHIN_USER_CACHE_TTL, user.display_name, f"{user.avatar_url}")
+            self.user_cards[user_id] = card
+        return card[1], card[2]
+
+    async def get_history_page(
+        self,
+        owner_id: str,
+        index: int
+    ) -> Tuple[Optional[List[Embed]], List[ActionRow]]:
+        """
+        function get_history_page read one message of a chat and build its Show Chat page
+        """
+        messages, total = await self.history.transcript_page(owner_id, index, 1)
+        if total == 0:
+            return None, []
+        if not messages:
+            index = total - 1
+            messages, total = await self.history.transcript_page(owner_id, index, 1)
+        message = messages[0]
+        if message.role == "user":
+            name, icon_url = await self.get_user_card(owner_id)
+        else:
+            name, icon_url = self.client.app.name, f"{self.client.user.avatar_url}"
+        embeds = [Embed(
+            description=f"{message.content[:4094]}",
+            author=EmbedAuthor(name=f"{name}", icon_url=icon_url, url=f"{DOLPHIN_EMBED_URL}")
+        )]
+        if len(message.content) > 4094:
+            embeds.append(Embed(description=f"{message.content[4094:5900]}"))
+        components = [
+            ActionRow(
+                Button(
+                    custom_id=f"button_page_{index - 1}_{owner_id}",
+                    style=ButtonStyle.GREY,
+                    label="Previous",
+                    disabled=index == 0,
+                ),
+                Button(
+                    custom_id=f"button_position_{owner_id}",
+                    style=ButtonStyle.GREY,
+                    label=f"{index + 1}/{total}",
+                    disabled=True,
+                ),
+                Button(
+                    custom_id=f"button_page_{index + 1}_{owner_id}",
+                    style=ButtonStyle.GREY,
+                    label="Next",
+                    disabled=index >= total - 1,
+                )
             )
         ]
-        chat_template.extend(messages)
-        chat_template.extend([ChatMessage(role=MessageRole.USER,content=f"{prompt}")])
-        return chat_template
+        return embeds, components
+
+    async def get_turn_message(
+        self,
+        response: str,
+        model: int,
+        params: Dict,
+        truncated: bool = False
+    ) -> ChatMessage:
+        """
+        function get_turn_message build the assistant message, keeping the generation
+        settings, its token count and whether the deadline cut it off
+        """
+        additional_kwargs = {"model": model, "params": params}
+        if truncated:
+            additional_kwargs["truncated"] = True
+        message = ChatMessage(
+            role=MessageRole.ASSISTANT,
+            content=f"{response}",
+            additional_kwargs=additional_kwargs
+        )
+        await self.budgeter.count(model, [message])
+        return message
+
+    async def fit_chat_template(
+        self,
+        model: int,
+        chat_template: List[ChatMessage],
+        params: Dict
+    ) -> Tuple[List[ChatMessage], Dict]:
+        """
+        function fit_chat_template drop the oldest turns so prompt and answer fit the context
+        """
+        messages, max_tokens = await self.budgeter.fit(
+            model, chat_template[0], chat_template[1:-1], chat_template[-1], params["max_tokens"]
+        )
+        fitted = {**params, "max_tokens": max_tokens}
+        return [chat_template[0], *messages, chat_template[-1]], fitted
+
+    def get_queue_status(self, position: int, wait: float) -> str:
+        """
+        function get_queue_status format the queue position of a request
+        """
+        return f"Queue position: **{position}**\nEstimated wait: **{int(wait)}s**"
+
+    def get_chat_template(self, prompt: str, messages: List[ChatMessage], context: str = ""):
+        """
+        function get_chat_template
+        """
+        return chat_messages_template(DOLPHIN_SYSTEM_PROMPT, prompt, messages, context)
+
+    async def get_context(self, prompt: str) -> str:
+        """
+        function get_context return the indexed documentation relevant to a prompt
+        """
+        if self.retriever is None:
+            return ""
+        try:
+            results = await self.retriever.retrieve(prompt)
+        except Exception:  # pylint: disable=broad-exception-caught
+            ERRORS_TOTAL.inc(kind="retrieval")
+            logger.exception("Retrieval failed, answering without documentation")
+            return ""
+        return "\n".join(f"[{chunk['source']}] {chunk['text']}" for _, chunk in results)
 
     def get_chat_embeds(self, ctx: SlashContext, prompt: str, model_name: str) -> List[Embed]:
         """
@@ -2,6 +2,13 @@
 This module contains the main function for bot.
 """
 
+import time
+
+STARTED = time.perf_counter()
+
+# pylint: disable=wrong-import-position
+import hashlib
+import json
 import logging
 import os
 import asyncio
@@ -9,12 +16,19 @@ import traceback
 
 from dotenv import load_dotenv
 from interactions import Client, Intents, listen
+from interactions.api.events import Startup
 from interactions.ext import prefixed_commands
 
+from utils.logs import setup_logging
+from utils.metrics import start_metrics_server
+
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
+DOLPHIN_METRICS_HOST = os.getenv('DOLPHIN_METRICS_HOST', '127.0.0.1')
+DOLPHIN_METRICS_PORT = int(os.getenv('DOLPHIN_METRICS_PORT', str(9100)))
+DOLPHIN_COMMANDS_HASH = os.getenv('DOLPHIN_COMMANDS_HASH', '.dolphin-commands.sha256')
 
-logging.basicConfig()
+log_listener = setup_logging()
 cls_log = logging.getLogger("Dolphin-Logger:: ")
 cls_log.setLevel(logging.DEBUG)
 
@@ -26,6 +40,43 @@ bot = Client(
     logger=cls_log
 )
 prefixed_commands.setup(bot)
+startup_phases = {"imports": time.perf_counter() - STARTED}
+command_sync = {"hash": None}
+
+
+def log_phase(phase: str, started: float) -> None:
+    """
+    Record and log the duration of a startup phase
+    """
+    startup_phases[phase] = time.perf_counter() - started
+    cls_log.info("Startup phase %s: %.3fs", phase, startup_phases[phase])
+
+
+def get_commands_hash() -> str:
+    """
+    Hash the application command schema of every scope
+    """
+    schema = {
+        str(scope): sorted(
+            (command.to_dict() for command in commands.values()),
+            key=lambda command: json.dumps(command, sort_keys=True, default=str)
+        )
+        for scope, commands in bot.interactions_by_scope.items()
+    }
+    return hashlib.sha256(
+        json.dumps(schema, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def read_commands_hash() -> str:
+    """
+    Read the hash of the last synced command schema
+    """
+    try:
+        with open(DOLPHIN_COMMANDS_HASH, encoding="utf-8") as hash_file:
+            return hash_file.read().strip()
+    except OSError:
+        return None
 
 
 @listen()
@@ -33,9 +84,26 @@ async def on_ready():
     """
     On Ready
     """
-    print("Ready")
-    print(f"We're online! We've logged in as {bot.app.name}.")
-    print(f"This bot is owned by {bot.owner}")
+    cls_log.info("Ready")
+    cls_log.info("We're online! We've logged in as %s.", bot.app.name)
+    cls_log.info("This bot is owned by %s", bot.owner)
+
+
+@listen(Startup)
+async def on_startup():
+    """
+    On Startup, after the first Ready and the command sync
+    """
+    log_phase("total", STARTED)
+    cls_log.info("Startup phases: %s", ", ".join(
+        f"{phase} {elapsed:.3f}s" for phase, elapsed in startup_phases.items()
+    ))
+    if bot.sync_interactions and command_sync["hash"] is not None:
+        try:
+            with open(DOLPHIN_COMMANDS_HASH, "w", encoding="utf-8") as hash_file:
+                hash_file.write(command_sync["hash"])
+        except OSError:
+            cls_log.warning("Could not store the command schema hash in %s", DOLPHIN_COMMANDS_HASH)
 
 
 @listen()
@@ -43,7 +111,7 @@ async def on_guild_create(event):
     """
     Event for on guild
     """
-    print(f"guild created : {event.guild.name}")
+    cls_log.info("guild created : %s", event.guild.name)
 
 
 @listen()
@@ -51,7 +119,7 @@ async def on_message_create(event):
     """
     Event for on message
     """
-    print(f"message received: {event.message.content}")
+    cls_log.debug("message received: %s", event.message.content)
 
 
 async def main():
@@ -59,12 +127,25 @@ async def main():
     Main function
     """
     try:
+        if DOLPHIN_METRICS_PORT:
+            await start_metrics_server(DOLPHIN_METRICS_HOST, DOLPHIN_METRICS_PORT)
+        started = time.perf_counter()
         bot.reload_extension("commands.dolphin")
         # bot.load_extension("commands.cognitive")
+        log_phase("extensions", started)
+        started = time.perf_counter()
+        command_sync["hash"] = get_commands_hash()
+        if command_sync["hash"] == read_commands_hash():
+            # the schema Discord has is current, only the command ids are fetched
+            bot.sync_interactions = False
+            cls_log.info("Command schema unchanged, skipping the sync")
+        log_phase("command hash", started)
         await bot.astart(TOKEN)
     except ValueError:
         error_message = traceback.format_exc()
-        print(error_message)
+        cls_log.error(error_message)
+    finally:
+        log_listener.stop()
 
 if __name__ == "__main__":
     asyncio.run(main())
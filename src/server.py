@@ -0,0 +1,171 @@
+"""
+This module contains the inference server for bot.
+"""
+
+import asyncio
+import json
+import logging
+import os
+
+from contextlib import aclosing
+
+from aiohttp import web
+from dotenv import load_dotenv
+from redis.asyncio import Redis
+
+from utils.batching import BatchedGenerationExecutor
+from utils.chat import set_prefixes
+from utils.generation import GenerationExecutor
+from utils.inflight import InflightRegistry
+from utils.logs import setup_logging
+from utils.metrics import ERRORS_TOTAL, metrics_handler
+from utils.models import (
+    DOLPHIN_BATCH_SLOTS,
+    DOLPHIN_PREWARM,
+    ModelPool,
+    get_models,
+    parse_prewarm
+)
+from utils.work_queue import DOLPHIN_REPLICA_ID, DOLPHIN_WORK_QUEUE, WorkQueueWorker
+
+load_dotenv()
+DOLPHIN_SYSTEM_PROMPT = os.getenv('DOLPHIN_SYSTEM_PROMPT')
+DOLPHIN_MAX_REQ = int(os.getenv('DOLPHIN_MAX_REQ', str(1)))
+DOLPHIN_SERVER_HOST = os.getenv('DOLPHIN_SERVER_HOST', '127.0.0.1')
+DOLPHIN_SERVER_PORT = int(os.getenv('DOLPHIN_SERVER_PORT', str(8765)))
+DOLPHIN_SERVER_SOCKET = os.getenv('DOLPHIN_SERVER_SOCKET')
+DOLPHIN_REDIS = os.getenv('DOLPHIN_REDIS')
+
+logger = logging.getLogger(__name__)
+routes = web.RouteTableDef()
+
+
+@routes.get("/health")
+async def health(request: web.Request) -> web.Response:
+    """
+    Health check
+    """
+    pool: ModelPool = request.app["pool"]
+    return web.json_response({
+        "status": "ok",
+        "replica": DOLPHIN_REPLICA_ID,
+        "loaded": list(pool.loaded),
+        "load_seconds": {
+            pool.models[index]["name"]: elapsed for index, elapsed in pool.load_times.items()
+        }
+    })
+
+
+@routes.get("/v1/models")
+async def models(request: web.Request) -> web.Response:
+    """
+    List the served models
+    """
+    pool: ModelPool = request.app["pool"]
+    return web.json_response([
+        {"index": index, "name": model["name"], "loaded": index in pool.loaded}
+        for index, model in enumerate(pool.models)
+    ])
+
+
+@routes.post("/v1/tokenize")
+async def tokenize(request: web.Request) -> web.Response:
+    """
+    Count the tokens of texts with a model's tokenizer
+    """
+    body = await request.json()
+    generation: GenerationExecutor = request.app["generation"]
+    counts = await generation.count_tokens(int(body["model"]), body["texts"])
+    return web.json_response({"counts": counts})
+
+
+@routes.post("/v1/chat/stream")
+async def chat_stream(request: web.Request) -> web.StreamResponse:
+    """
+    Stream a chat completion as newline delimited JSON
+    """
+    body = await request.json()
+    generation: GenerationExecutor = request.app["generation"]
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    stream = generation.stream(int(body["model"]), body["prompt"], body["params"])
+    try:
+        async with aclosing(stream):
+            async for delta in stream:
+                await response.write(json.dumps({"delta": delta}).encode() + b"\n")
+        await response.write(json.dumps({"done": True}).encode() + b"\n")
+    except ConnectionResetError:
+        logger.info("Client went away, generation stopped")
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        ERRORS_TOTAL.inc(kind=type(e).__name__)
+        logger.exception("Generation failed")
+        await response.write(json.dumps({"error": f"{e}"}).encode() + b"\n")
+    return response
+
+
+async def on_startup(app: web.Application) -> None:
+    """
+    Prewarm the DOLPHIN_PREWARM models without delaying the listener, and
+    consume the jobs of the Redis work queue when it is enabled
+    """
+    pool: ModelPool = app["pool"]
+    indexes = parse_prewarm(DOLPHIN_PREWARM, pool.models)
+    if indexes:
+        app["prewarm"] = asyncio.get_running_loop().run_in_executor(None, pool.prewarm, indexes)
+    if DOLPHIN_WORK_QUEUE:
+        redis = Redis.from_url(f"redis://{DOLPHIN_REDIS}:6379")
+        app["worker"] = WorkQueueWorker(
+            redis,
+            DOLPHIN_REPLICA_ID,
+            pool,
+            app["generation"],
+            InflightRegistry(redis, DOLPHIN_REPLICA_ID),
+            capacity=max(DOLPHIN_MAX_REQ, DOLPHIN_BATCH_SLOTS)
+        )
+        app["worker"].start()
+        logger.info("Consuming the work queue as replica %s", DOLPHIN_REPLICA_ID)
+
+
+async def on_cleanup(app: web.Application) -> None:
+    """
+    Stop the generations and free the models
+    """
+    if "worker" in app:
+        await app["worker"].close()
+        await app["worker"].redis.aclose()
+    app["generation"].shutdown()
+    app["pool"].close()
+
+
+def create_app() -> web.Application:
+    """
+    Create the inference application
+    """
+    app = web.Application()
+    model_list = get_models()
+    set_prefixes(DOLPHIN_SYSTEM_PROMPT, model_list)
+    app["pool"] = ModelPool(model_list, slots=DOLPHIN_BATCH_SLOTS)
+    app["pool"].validate()
+    if DOLPHIN_BATCH_SLOTS:
+        app["generation"] = BatchedGenerationExecutor(app["pool"], slots=DOLPHIN_BATCH_SLOTS)
+    else:
+        app["generation"] = GenerationExecutor(app["pool"], workers=DOLPHIN_MAX_REQ)
+    app.add_routes(routes)
+    app.router.add_get("/metrics", metrics_handler)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def main():
+    """
+    Main function
+    """
+    setup_logging()
+    if DOLPHIN_SERVER_SOCKET:
+        web.run_app(create_app(), path=DOLPHIN_SERVER_SOCKET)
+    else:
+        web.run_app(create_app(), host=DOLPHIN_SERVER_HOST, port=DOLPHIN_SERVER_PORT)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+This module contains the model profile tuner for bot.
+"""
+
+import argparse
+import concurrent.futures
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+from typing import Any, Dict, List
+
+from dotenv import load_dotenv
+
+from utils.logs import setup_logging
+from utils.models import DOLPHIN_POOL_BUDGET_MB, get_models, llama_kwargs
+
+load_dotenv()
+DOLPHIN_MODEL_PROFILES = os.getenv('DOLPHIN_MODEL_PROFILES')
+DOLPHIN_PATH = os.getenv('DOLPHIN_PATH')
+TUNED_KEYS = ("n_batch", "n_threads", "n_threads_batch", "n_gpu_layers", "type_k", "type_v",
+              "flash_attn")
+
+logger = logging.getLogger(__name__)
+
+
+def resident_mb() -> float:
+    """
+    function resident_mb return the resident memory of this process
+    """
+    with open("/proc/self/statm", encoding="utf-8") as statm:
+        pages = int(statm.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def available_mb() -> float:
+    """
+    function available_mb return the memory the kernel can hand out without swapping
+    """
+    with open("/proc/meminfo", encoding="utf-8") as meminfo:
+        for line in meminfo:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def run_trial(profile: Dict[str, Any], prompt_tokens: int, new_tokens: int) -> Dict[str, float]:
+    """
+    function run_trial load a model with a profile and time prefill and decode
+
+    Runs in its own process so the resident memory is the model's alone and
+    a setting llama.cpp cannot load does not take the tuner down.
+    """
+    from llama_cpp import Llama  # pylint: disable=import-outside-toplevel
+    baseline = resident_mb()
+    started = time.perf_counter()
+    llm = Llama(**llama_kwargs(profile), verbose=False)
+    loaded = time.perf_counter()
+    tokens = llm.tokenize(b" hello" * prompt_tokens, add_bos=True)[:prompt_tokens]
+    prefilled = None
+    generated = 0
+    # the first token comes after the prompt is evaluated, so it times the prefill
+    for token in llm.generate(tokens, temp=0.0):
+        if prefilled is None:
+            prefilled = time.perf_counter()
+        else:
+            generated += 1
+        if generated >= new_tokens or llm.token_eos() == token:
+            break
+    decoded = time.perf_counter()
+    memory = resident_mb() - baseline
+    # the process exits after the trial, which frees the model
+    return {
+        "load_seconds": loaded - started,
+        "prefill_tps": len(tokens) / (prefilled - loaded),
+        "decode_tps": generated / max(decoded - prefilled, 1e-9),
+        "seconds": decoded - loaded,
+        "memory_mb": memory
+    }
+
+
+def candidates(profile: Dict[str, Any], args) -> List[Dict[str, Any]]:
+    """
+    function candidates return the profile with every combination of the swept settings
+    """
+    grid = {
+        "n_batch": args.n_batch,
+        "n_threads": args.threads or [profile["n_threads"]],
+        "n_gpu_layers": args.gpu_layers or [profile["n_gpu_layers"]],
+        "type_k": args.kv_types,
+        "flash_attn": args.flash_attn
+    }
+    swept = []
+    for values in itertools.product(*grid.values()):
+        settings = dict(zip(grid, values))
+        settings["n_threads_batch"] = settings["n_threads"]
+        # a quantised V cache is only supported with flash attention
+        settings["type_v"] = settings["type_k"] if settings["flash_attn"] else "f16"
+        swept.append({**profile, **settings})
+    return swept
+
+
+def tune(profile: Dict[str, Any], budget_mb: float, args) -> Dict[str, Any]:
+    """
+    function tune return the fastest swept settings of a model that fit the memory budget
+    """
+    fitting = []
+    for candidate in candidates(profile, args):
+        settings = {key: candidate[key] for key in TUNED_KEYS}
+        context = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            try:
+                result = pool.submit(
+                    run_trial, candidate, args.prompt_tokens, args.new_tokens
+                ).result()
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                logger.warning("%s %s failed: %s", profile["name"], settings, error)
+                continue
+        fits = not budget_mb or result["memory_mb"] <= budget_mb
+        logger.info("%s %s: prefill %.1f tok/s, decode %.1f tok/s, %.0f MB%s",
+                    profile["name"], settings, result["prefill_tps"], result["decode_tps"],
+                    result["memory_mb"], "" if fits else " (over budget)")
+        if fits:
+            fitting.append((settings, result))
+    if not fitting:
+        raise ValueError(f"No setting of {profile['name']} fits {budget_mb:.0f} MB")
+    settings, result = min(fitting, key=lambda trial: trial[1]["seconds"])
+    return {**settings, "memory_mb": int(result["memory_mb"]) + 1}
+
+
+def new_entry(profile: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    function new_entry return the profile file entry of a DOLPHIN_MODELS model
+    """
+    entry = {"name": profile["name"], "file": os.path.relpath(profile["file"], DOLPHIN_PATH)}
+    if profile["draft"]:
+        kind, tokens = profile["draft"]
+        if kind != "lookup":
+            kind = os.path.relpath(kind, DOLPHIN_PATH)
+        entry["draft"] = f"{kind}={tokens}"
+    return entry
+
+
+def main():
+    """
+    Main function
+    """
+    parser = argparse.ArgumentParser(description="Sweep llama.cpp settings per model")
+    parser.add_argument("--output", default=DOLPHIN_MODEL_PROFILES or "models.json",
+                        help="profile file to write")
+    parser.add_argument("--models", default="", help="model names to tune, default all")
+    parser.add_argument("--budget-mb", type=float, default=DOLPHIN_POOL_BUDGET_MB,
+                        help="memory one model may use, default available memory")
+    parser.add_argument("--prompt-tokens", type=int, default=512, help="tokens to prefill")
+    parser.add_argument("--new-tokens", type=int, default=128, help="tokens to decode")
+    parser.add_argument("--n-batch", type=int, nargs="+", default=[256, 512, 1024])
+    parser.add_argument("--threads", type=int, nargs="+", default=None)
+    parser.add_argument("--gpu-layers", type=int, nargs="+", default=None)
+    parser.add_argument("--kv-types", nargs="+", default=["f16", "q8_0"])
+    parser.add_argument("--flash-attn", type=int, nargs="+", choices=(0, 1), default=[0, 1])
+    args = parser.parse_args()
+    args.flash_attn = [bool(flash_attn) for flash_attn in args.flash_attn]
+    listener = setup_logging()
+    try:
+        budget_mb = args.budget_mb or available_mb()
+        entries = []
+        if DOLPHIN_MODEL_PROFILES and os.path.isfile(DOLPHIN_MODEL_PROFILES):
+            with open(DOLPHIN_MODEL_PROFILES, encoding="utf-8") as profiles_file:
+                entries = json.load(profiles_file)
+        names = [name for name in args.models.split(",") if name]
+        for profile in get_models():
+            entry = next((entry for entry in entries if entry["name"] == profile["name"]), None)
+            if entry is None:
+                entry = new_entry(profile)
+                entries.append(entry)
+            if names and profile["name"] not in names:
+                continue
+            entry.update(tune(profile, budget_mb, args))
+            logger.info("Tuned %s: %s", profile["name"], entry)
+        with open(args.output, "w", encoding="utf-8") as profiles_file:
+            json.dump(entries, profiles_file, indent=2)
+        logger.info("Wrote %s profiles to %s", len(entries), args.output)
+    finally:
+        listener.stop()
+
+if __name__ == "__main__":
+    main()
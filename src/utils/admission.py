@@ -0,0 +1,110 @@
+"""
+This module contains the cost-based admission control for bot.
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+from utils.metrics import ADMISSION_BACKLOG_SECONDS
+from utils.scheduler import Scheduler
+
+
+# the SLO settings and the per-model estimates it keeps
+class AdmissionController:  # pylint: disable=too-many-instance-attributes
+    """
+    This class contains the AdmissionController.
+
+    Estimates the cost of a request in seconds from its prompt tokens,
+    max_new_tokens and the measured decode rate of the model, and keeps the
+    summed cost of the admitted requests of each lane as its backlog. A
+    request whose projected wait and cost miss the SLO gets fewer tokens,
+    then the fallback model, before it is rejected. An SLO of 0 admits all.
+    """
+
+    def __init__(
+        self,
+        scheduler: Scheduler,
+        models: List[dict],
+        slo: float = 0.0,
+        min_tokens: int = 256,
+        fallback: int = -1,
+        decode_rate: float = 10.0,
+        prefill_rate: float = 200.0
+    ) -> None:
+        self.scheduler = scheduler
+        self.models = models
+        self.slo = slo
+        self.min_tokens = min_tokens
+        self.fallback = fallback
+        self.decode_rate = decode_rate
+        self.prefill_rate = prefill_rate
+        self.rates: Dict[int, float] = {}
+        self.backlog: Dict[int, float] = {}
+
+    def rate(self, model: int) -> float:
+        """
+        function rate return the measured tokens per second of a model
+        """
+        return self.rates.get(model, self.decode_rate)
+
+    def observe(self, model: int, tokens: int, seconds: float) -> None:
+        """
+        function observe update the decode rate of a model with a finished generation
+
+        `tokens` are the ones decoded after the first and `seconds` the time
+        since the first, so the prefill that cost() adds is not counted twice.
+        """
+        if tokens > 1 and seconds > 0:
+            self.rates[model] = 0.8 * self.rate(model) + 0.2 * tokens / seconds
+
+    def cost(self, model: int, prompt_tokens: int, max_tokens: int) -> float:
+        """
+        function cost return the estimated seconds a request keeps a slot
+        """
+        return prompt_tokens / self.prefill_rate + max_tokens / self.rate(model)
+
+    def wait(self, model: int) -> float:
+        """
+        function wait return the projected queue wait of a lane in seconds
+
+        A request waits for its lane's slots and for the slots every lane
+        shares, so the wait is the longer of its lane backlog and the backlog
+        of all lanes spread over those slots.
+        """
+        lane = self.backlog.get(model, 0.0) / self.scheduler.lane(model).concurrent
+        shared = sum(self.backlog.values()) / self.scheduler.concurrent
+        return max(lane, shared)
+
+    def plan(self, model: int, prompt_tokens: int, max_tokens: int) -> Optional[Tuple[int, int]]:
+        """
+        function plan return the model and max_tokens to admit a request with, or None
+
+        Tries the full request, fewer tokens, the fallback model in full and
+        with fewer tokens, in that order.
+        """
+        if self.slo <= 0:
+            return model, max_tokens
+        candidates = [model]
+        if 0 <= self.fallback < len(self.models) and self.fallback != model:
+            candidates.append(self.fallback)
+        for candidate in candidates:
+            budget = self.slo - self.wait(candidate) - prompt_tokens / self.prefill_rate
+            tokens = int(budget * self.rate(candidate))
+            if tokens >= max_tokens:
+                return candidate, max_tokens
+            if tokens >= min(self.min_tokens, max_tokens):
+                return candidate, tokens
+        return None
+
+    def admit(self, model: int, cost: float) -> None:
+        """
+        function admit add an admitted request to the backlog of its lane
+        """
+        self.backlog[model] = self.backlog.get(model, 0.0) + cost
+        ADMISSION_BACKLOG_SECONDS.set(self.backlog[model], model=self.models[model]["name"])
+
+    def release(self, model: int, cost: float) -> None:
+        """
+        function release remove a finished request from the backlog of its lane
+        """
+        self.backlog[model] = max(0.0, self.backlog.get(model, 0.0) - cost)
+        ADMISSION_BACKLOG_SECONDS.set(self.backlog[model], model=self.models[model]["name"])
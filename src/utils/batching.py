@@ -0,0 +1,369 @@
+"""
+This module contains the continuous batching generation engine for bot.
+"""
+
+import asyncio
+import codecs
+import logging
+import threading
+import time
+
+from collections import deque
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Deque, Dict, List, Optional
+
+import numpy as np
+
+import llama_cpp
+from llama_cpp import Llama
+
+from utils.metrics import (
+    BATCH_SEQUENCES,
+    GENERATION_SECONDS,
+    TIME_TO_FIRST_TOKEN_SECONDS,
+    TOKENS_PER_SECOND
+)
+from utils.generation import LocalExecutor
+from utils.models import ModelPool
+
+PREFIX_SEQUENCE = 0
+REPEAT_LAST_N = 64
+
+logger = logging.getLogger(__name__)
+
+
+def sample(logits: np.ndarray, history: List[int], params: Dict, rng: np.random.Generator) -> int:
+    """
+    function sample pick the next token with the llama.cpp sampling chain of one sequence
+    """
+    logits = np.array(logits, dtype=np.float32)
+    penalty = params.get("repeat_penalty", 1.1)
+    if penalty != 1.0 and history:
+        last = np.unique(np.array(history[-REPEAT_LAST_N:], dtype=np.intc))
+        values = logits[last]
+        logits[last] = np.where(values > 0, values / penalty, values * penalty)
+    temperature = params.get("temperature", 0.8)
+    if temperature <= 0:
+        return int(np.argmax(logits))
+    top_k = params.get("top_k", 40)
+    if 0 < top_k < len(logits):
+        candidates = np.argpartition(-logits, top_k - 1)[:top_k]
+    else:
+        candidates = np.arange(len(logits))
+    candidates = candidates[np.argsort(-logits[candidates])]
+    probs = np.exp(logits[candidates] - logits[candidates[0]])
+    probs /= probs.sum()
+    keep = np.cumsum(probs) - probs < params.get("top_p", 0.95)
+    keep &= probs >= params.get("min_p", 0.05) * probs[0]
+    keep[0] = True
+    scaled = logits[candidates[keep]] / temperature
+    probs = np.exp(scaled - scaled.max())
+    return int(candidates[keep][rng.choice(len(probs), p=probs / probs.sum())])
+
+
+# the decode state of one request, read by the engine thread on every step
+@dataclass(eq=False)
+class Sequence:  # pylint: disable=too-many-instance-attributes
+    """
+    This class contains the Sequence of one request in a batch, compared by identity.
+    """
+
+    loop: asyncio.AbstractEventLoop
+    queue: asyncio.Queue
+    stop: threading.Event
+    prompt: str
+    params: Dict
+    slot: Optional[int] = None
+    tokens: List[int] = field(default_factory=list)
+    pending: List[int] = field(default_factory=list)
+    position: int = 0
+    generated: int = 0
+    decoder: codecs.IncrementalDecoder = field(
+        default_factory=lambda: codecs.getincrementaldecoder("utf-8")(errors="replace")
+    )
+    rng: np.random.Generator = field(default_factory=np.random.default_rng)
+    started: float = field(default_factory=time.monotonic)
+    first: Optional[float] = None
+
+    def emit(self, item) -> None:
+        """
+        function emit hand a delta, an error or the end marker to the event loop
+        """
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+
+# the engine thread owns the llama.cpp context and the sequences decoded in it
+class BatchEngine:  # pylint: disable=too-many-instance-attributes
+    """
+    This class contains the BatchEngine of one model.
+
+    Runs the active sequences of a model through shared decode steps, each
+    in its own sequence slot of one llama.cpp context. Requests join and
+    leave between steps, the shared system prompt prefix is evaluated once
+    and its KV cells are copied into every new sequence.
+    """
+
+    def __init__(self, pool: ModelPool, index: int, slots: int) -> None:
+        self.pool = pool
+        self.index = index
+        self.slots = slots
+        self.prefix = pool.models[index].get("prefix", "")
+        self.context_window = pool.models[index]["context_window"]
+        self.name = pool.models[index]["name"]
+        self.waiting: Deque[Sequence] = deque()
+        self.active: Dict[int, Sequence] = {}
+        self.condition = threading.Condition()
+        self.closed = False
+        self.llm: Optional[Llama] = None
+        self.prefix_tokens: List[int] = []
+        self.batch = None
+        self.thread = threading.Thread(
+            target=self.run, name=f"dolphin-batch-{self.name}", daemon=True
+        )
+        self.thread.start()
+
+    def submit(self, sequence: Sequence) -> None:
+        """
+        function submit queue a sequence for the next step
+        """
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("Batch engine is closed")
+            self.waiting.append(sequence)
+            self.condition.notify()
+
+    def close(self) -> None:
+        """
+        function close stop the engine thread after the running step
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+    def run(self) -> None:
+        """
+        function run the engine loop, holding the model only while sequences are active
+        """
+        while True:
+            with self.condition:
+                while not self.waiting and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    break
+            with self.pool.acquire(self.index) as llm:
+                self.prepare(llm)
+                while self.admit(llm) or self.active:
+                    try:
+                        self.step(llm)
+                    except Exception as e:  # pylint: disable=broad-exception-caught
+                        logger.exception("Batch step of %s failed", self.name)
+                        for slot in list(self.active):
+                            self.finish(llm, slot, e)
+        with self.condition:
+            for sequence in self.waiting:
+                sequence.emit(RuntimeError("Batch engine is closed"))
+            self.waiting.clear()
+        if self.batch is not None:
+            llama_cpp.llama_batch_free(self.batch)
+
+    def prepare(self, llm: Llama) -> None:
+        """
+        function prepare evaluate the shared prefix once per loaded model
+        """
+        if llm is self.llm:
+            return
+        self.llm = llm
+        if self.batch is not None:
+            llama_cpp.llama_batch_free(self.batch)
+        self.batch = llama_cpp.llama_batch_init(llm.n_batch, 0, 1)
+        llama_cpp.llama_kv_cache_clear(llm.ctx)
+        self.prefix_tokens = llm.tokenize(self.prefix.encode("utf-8"), special=True)
+        for start in range(0, len(self.prefix_tokens), llm.n_batch):
+            chunk = self.prefix_tokens[start:start + llm.n_batch]
+            self.decode(llm, [
+                (token, start + offset, PREFIX_SEQUENCE, False)
+                for offset, token in enumerate(chunk)
+            ])
+
+    def admit(self, llm: Llama) -> bool:
+        """
+        function admit move waiting sequences into the free slots
+        """
+        with self.condition:
+            if self.closed:
+                for slot in list(self.active):
+                    self.finish(llm, slot, RuntimeError("Batch engine is closed"))
+                return False
+            free = [slot for slot in range(1, self.slots + 1) if slot not in self.active]
+            while self.waiting and free:
+                sequence = self.waiting.popleft()
+                if sequence.stop.is_set():
+                    sequence.emit(None)
+                    continue
+                sequence.slot = free.pop(0)
+                sequence.tokens = llm.tokenize(sequence.prompt.encode("utf-8"), special=True)
+                shared = 0
+                for prompt_token, prefix_token in zip(sequence.tokens, self.prefix_tokens):
+                    if prompt_token != prefix_token:
+                        break
+                    shared += 1
+                # keep at least one prompt token to evaluate for the first logits
+                shared = min(shared, len(sequence.tokens) - 1)
+                if shared > 0:
+                    llama_cpp.llama_kv_cache_seq_cp(
+                        llm.ctx, PREFIX_SEQUENCE, sequence.slot, 0, shared
+                    )
+                sequence.position = shared
+                sequence.pending = sequence.tokens[shared:]
+                self.active[sequence.slot] = sequence
+            BATCH_SEQUENCES.set(len(self.active), model=self.name)
+            return bool(self.active)
+
+    def decode(self, llm: Llama, entries: List[tuple]) -> None:
+        """
+        function decode run one llama_decode over (token, position, sequence, logits) entries
+        """
+        batch = self.batch
+        for i, (token, position, seq_id, logits) in enumerate(entries):
+            batch.token[i] = token
+            batch.pos[i] = position
+            batch.n_seq_id[i] = 1
+            batch.seq_id[i][0] = seq_id
+            batch.logits[i] = logits
+        batch.n_tokens = len(entries)
+        result = llama_cpp.llama_decode(llm.ctx, batch)
+        if result != 0:
+            raise RuntimeError(f"llama_decode returned {result}")
+
+    def step(self, llm: Llama) -> None:
+        """
+        function step decode one token of every generating sequence and a prompt chunk of the others
+        """
+        entries = []
+        outputs = {}
+        # sequences decoding one token go first so a long prompt cannot stall them
+        for slot, sequence in sorted(
+            self.active.items(), key=lambda item: len(item[1].pending) > 1
+        ):
+            if sequence.stop.is_set():
+                self.finish(llm, slot)
+                continue
+            budget = llm.n_batch - len(entries)
+            if budget <= 0:
+                break
+            chunk = sequence.pending[:budget]
+            for offset, token in enumerate(chunk):
+                last = offset == len(sequence.pending) - 1
+                if last:
+                    outputs[slot] = len(entries)
+                entries.append((token, sequence.position + offset, slot, last))
+            sequence.position += len(chunk)
+            sequence.pending = sequence.pending[len(chunk):]
+        if not entries:
+            return
+        self.decode(llm, entries)
+        n_vocab = llm.n_vocab()
+        for slot, i in outputs.items():
+            sequence = self.active[slot]
+            logits = np.ctypeslib.as_array(
+                llama_cpp.llama_get_logits_ith(llm.ctx, i), shape=(n_vocab,)
+            )
+            token = sample(logits, sequence.tokens, sequence.params, sequence.rng)
+            sequence.tokens.append(token)
+            sequence.generated += 1
+            if sequence.first is None:
+                sequence.first = time.monotonic()
+                TIME_TO_FIRST_TOKEN_SECONDS.observe(
+                    sequence.first - sequence.started, model=self.name
+                )
+            if llama_cpp.llama_token_is_eog(llm.model, token):
+                self.finish(llm, slot)
+                continue
+            delta = sequence.decoder.decode(llm.detokenize([token]))
+            if delta:
+                sequence.emit(delta)
+            limit = min(
+                sequence.params.get("max_tokens", self.context_window),
+                self.context_window - len(sequence.tokens)
+            )
+            if sequence.generated >= limit:
+                self.finish(llm, slot)
+            else:
+                sequence.pending = [token]
+
+    def finish(self, llm: Llama, slot: int, error: Exception = None) -> None:
+        """
+        function finish free the slot and KV cells of a sequence and end its stream
+        """
+        sequence = self.active.pop(slot)
+        llama_cpp.llama_kv_cache_seq_rm(llm.ctx, slot, -1, -1)
+        BATCH_SEQUENCES.set(len(self.active), model=self.name)
+        ended = time.monotonic()
+        GENERATION_SECONDS.observe(ended - sequence.started, model=self.name)
+        if sequence.first is not None and sequence.generated > 1 and ended > sequence.first:
+            TOKENS_PER_SECOND.observe(
+                (sequence.generated - 1) / (ended - sequence.first), model=self.name
+            )
+        if error is None:
+            tail = sequence.decoder.decode(b"", final=True)
+            if tail:
+                sequence.emit(tail)
+        sequence.emit(error)
+
+
+class BatchedGenerationExecutor(LocalExecutor):
+    """
+    This class contains the BatchedGenerationExecutor.
+
+    Same stream/complete interface as the GenerationExecutor, serving every
+    request of a model through that model's BatchEngine.
+    """
+
+    def __init__(self, pool: ModelPool, slots: int) -> None:
+        super().__init__(pool)
+        self.slots = slots
+        self.engines: Dict[int, BatchEngine] = {}
+        self.lock = threading.Lock()
+
+    def engine(self, model: int) -> BatchEngine:
+        """
+        function engine return the batch engine of a model, starting it on first use
+        """
+        with self.lock:
+            if model not in self.engines:
+                self.engines[model] = BatchEngine(self.pool, model, self.slots)
+            return self.engines[model]
+
+    async def stream(
+        self,
+        model: int,
+        prompt: str,
+        params: Dict,
+        stop: threading.Event = None
+    ) -> AsyncIterator[str]:
+        """
+        function stream yield the text deltas of a sequence in the model's batch
+        """
+        queue = asyncio.Queue()
+        with self.running(stop) as event:
+            self.engine(model).submit(
+                Sequence(asyncio.get_running_loop(), queue, event, prompt, params)
+            )
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+
+    def shutdown(self) -> None:
+        """
+        function shutdown cancel the running sequences and stop the engines
+        """
+        self.stop_all()
+        with self.lock:
+            engines = list(self.engines.values())
+        for engine in engines:
+            engine.close()
@@ -0,0 +1,71 @@
+"""
+This module contains the history token budgeter for bot.
+"""
+
+from typing import Awaitable, Callable, List, Tuple
+
+from llama_index.core.llms import ChatMessage
+
+TURN_OVERHEAD = 8
+
+
+class HistoryBudgeter:
+    """
+    This class contains the HistoryBudgeter.
+
+    Counts tokens with the selected model's own tokenizer, caching each
+    message count in its additional_kwargs so it is computed once per model,
+    and drops the oldest turns until system prompt, history, prompt and
+    max_new_tokens fit the context window of the model's profile.
+    """
+
+    def __init__(
+        self,
+        count_tokens: Callable[[int, List[str]], Awaitable[List[int]]],
+        models: List[dict],
+        context_window: int
+    ) -> None:
+        self.count_tokens = count_tokens
+        self.models = models
+        self.context_window = context_window
+
+    async def count(self, model: int, messages: List[ChatMessage]) -> List[int]:
+        """
+        function count return the token count of each message, tokenizing only the new ones
+        """
+        name = self.models[model]["name"]
+        missing = [
+            message for message in messages
+            if name not in message.additional_kwargs.get("tokens", {})
+        ]
+        if missing:
+            counts = await self.count_tokens(model, [message.content or "" for message in missing])
+            for message, count in zip(missing, counts):
+                message.additional_kwargs.setdefault("tokens", {})[name] = count
+        return [message.additional_kwargs["tokens"][name] + TURN_OVERHEAD for message in messages]
+
+    async def fit(
+        self,
+        model: int,
+        system: ChatMessage,
+        messages: List[ChatMessage],
+        prompt: ChatMessage,
+        max_new_tokens: int
+    ) -> Tuple[List[ChatMessage], int]:
+        """
+        function fit return the newest turns that fit and the max_new_tokens left for the answer
+        """
+        system_tokens, prompt_tokens, *history_tokens = await self.count(
+            model, [system, prompt, *messages]
+        )
+        context_window = self.models[model].get("context_window", self.context_window)
+        budget = context_window - max_new_tokens - system_tokens - prompt_tokens
+        start = 0
+        used = sum(history_tokens)
+        while used > budget and start < len(messages):
+            # drop a whole user/assistant turn to keep the roles alternating
+            used -= sum(history_tokens[start:start + 2])
+            start += 2
+        if used > budget:
+            max_new_tokens = max(1, max_new_tokens - (used - budget))
+        return messages[start:], max_new_tokens
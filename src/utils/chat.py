@@ -0,0 +1,84 @@
+"""
+This module contains the chat prompt helpers for bot.
+"""
+
+from typing import Dict, List
+
+from llama_index.core.llms import ChatMessage, MessageRole
+
+
+def messages_to_prompt(messages: List[ChatMessage], chat_format: str = "llama2") -> str:
+    """
+    function messages_to_prompt format messages with the chat template of a model profile
+
+    `llama2` is the llama_index llama.cpp prompt template. The integration
+    imports llama.cpp itself, so it is only loaded on first use.
+    """
+    if chat_format == "chatml":
+        return chatml_prompt(messages)
+    # pylint: disable-next=import-outside-toplevel
+    from llama_index.llms.llama_cpp import llama_utils
+    return llama_utils.messages_to_prompt(messages)
+
+
+def chatml_prompt(messages: List[ChatMessage]) -> str:
+    """
+    function chatml_prompt format messages as ChatML turns ending with the assistant header
+    """
+    prompt = ""
+    for message in messages:
+        content = message.content or ""
+        if message.role == MessageRole.SYSTEM:
+            # chat_messages_template already frames the system prompt, unwrap it into one turn
+            content = content.replace("<|im_start|>system\n", "", 1)
+            content = content.replace("<|im_end|>\n", "\n", 1)
+        role = message.role.value if hasattr(message.role, "value") else message.role
+        prompt += f"<|im_start|>{role}\n{content}<|im_end|>\n"
+    return prompt + "<|im_start|>assistant\n"
+
+
+def chat_messages_template(
+    system_prompt: str,
+    prompt: str,
+    messages: List[ChatMessage],
+    context: str = ""
+) -> List[ChatMessage]:
+    """
+    function chat_messages_template build the system, history and user messages
+
+    `context` is retrieved documentation the answer should be grounded in.
+    """
+    # compaction summaries go after the shared system prompt so the cached prefix still matches
+    summaries = "".join(
+        f"Summary of the earlier conversation:\n{message.content}\n"
+        for message in messages if message.role == MessageRole.SYSTEM
+    )
+    if context:
+        context = f"Relevant documentation:\n{context}\n"
+    chat_template = [
+        ChatMessage(
+            role=MessageRole.SYSTEM,
+            content=f"<|im_start|>system\n{system_prompt}<|im_end|>\n{summaries}{context}"
+        )
+    ]
+    chat_template.extend(message for message in messages if message.role != MessageRole.SYSTEM)
+    chat_template.extend([ChatMessage(role=MessageRole.USER,content=f"{prompt}")])
+    return chat_template
+
+
+def prompt_prefix(system_prompt: str, chat_format: str = "llama2") -> str:
+    """
+    function prompt_prefix return the prompt text shared by every conversation
+    """
+    prompt = messages_to_prompt(chat_messages_template(system_prompt, "", []), chat_format)
+    if chat_format == "chatml":
+        return prompt[:prompt.index("<|im_end|>")]
+    return prompt[:prompt.rindex(" [/INST]")]
+
+
+def set_prefixes(system_prompt: str, models: List[Dict]) -> None:
+    """
+    function set_prefixes store the shared prompt prefix of each model's chat format
+    """
+    for model in models:
+        model["prefix"] = prompt_prefix(system_prompt, model["chat_format"])
@@ -0,0 +1,135 @@
+"""
+This module contains the inference server client for bot.
+"""
+
+import asyncio
+import json
+import threading
+
+from typing import Any, AsyncIterator, Dict, List
+
+import aiohttp
+
+
+async def result_deltas(
+    items: AsyncIterator[Dict[str, Any]],
+    stop: threading.Event = None
+) -> AsyncIterator[str]:
+    """
+    function result_deltas yield the deltas of streamed result items until done or stopped
+
+    An item holds a "delta", an "error" or the "done" marker.
+    """
+    async for item in items:
+        if stop is not None and stop.is_set():
+            break
+        if "error" in item:
+            raise RuntimeError(item["error"])
+        if item.get("done"):
+            break
+        yield item["delta"]
+
+
+async def wait_stop(stop: threading.Event, interval: float = 0.1) -> None:
+    """
+    function wait_stop return once the stop event is set, polling it from the loop
+    """
+    while not stop.is_set():
+        await asyncio.sleep(interval)
+
+
+class InferenceClient:
+    """
+    This class contains the InferenceClient.
+
+    Thin async client of the inference server, with the same stream/complete
+    interface as the in-process GenerationExecutor. Connections are pooled
+    by one shared aiohttp session.
+    """
+
+    def __init__(self, url: str, connections: int = 16):
+        self.connections = connections
+        if url.startswith("unix://"):
+            self.socket = url[len("unix://"):]
+            self.url = "http://localhost"
+        else:
+            self.socket = None
+            self.url = url.rstrip("/")
+        self.session: aiohttp.ClientSession = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """
+        function get_session return the pooled session, creating it on first use
+        """
+        if self.session is None or self.session.closed:
+            if self.socket:
+                connector = aiohttp.UnixConnector(path=self.socket, limit=self.connections)
+            else:
+                connector = aiohttp.TCPConnector(limit=self.connections)
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=10)
+            )
+        return self.session
+
+    async def stream(
+        self,
+        model: int,
+        prompt: str,
+        params: Dict,
+        stop: threading.Event = None
+    ) -> AsyncIterator[str]:
+        """
+        function stream yield the text deltas streamed by the server
+
+        Setting `stop` closes the connection, which stops the generation on the server.
+        """
+        async with self.get_session().post(
+            f"{self.url}/v1/chat/stream",
+            json={"model": model, "prompt": prompt, "params": params}
+        ) as response:
+            response.raise_for_status()
+            watcher = None
+            if stop is not None:
+                watcher = asyncio.create_task(self.watch(response, stop))
+            items = (json.loads(line) async for line in response.content if line.strip())
+            try:
+                async for delta in result_deltas(items, stop):
+                    yield delta
+            except aiohttp.ClientError:
+                if stop is None or not stop.is_set():
+                    raise
+            finally:
+                if watcher is not None:
+                    watcher.cancel()
+
+    async def watch(self, response: aiohttp.ClientResponse, stop: threading.Event) -> None:
+        """
+        function watch close the response as soon as the stop event is set
+        """
+        await wait_stop(stop)
+        response.close()
+
+    async def complete(self, model: int, prompt: str, params: Dict) -> str:
+        """
+        function complete return the whole generated text
+        """
+        return "".join([delta async for delta in self.stream(model, prompt, params)])
+
+    async def count_tokens(self, model: int, texts: List[str]) -> List[int]:
+        """
+        function count_tokens count tokens with the model's tokenizer on the server
+        """
+        async with self.get_session().post(
+            f"{self.url}/v1/tokenize",
+            json={"model": model, "texts": texts}
+        ) as response:
+            response.raise_for_status()
+            return (await response.json())["counts"]
+
+    def shutdown(self) -> None:
+        """
+        function shutdown close the pooled connections
+        """
+        if self.session is not None and not self.session.closed:
+            asyncio.get_event_loop().create_task(self.session.close())
@@ -0,0 +1,116 @@
+"""
+This module contains the background conversation compaction for bot.
+"""
+
+import asyncio
+import logging
+
+from typing import Dict, List
+
+from llama_index.core.llms import ChatMessage, MessageRole
+
+from utils.budget import HistoryBudgeter
+from utils.chat import messages_to_prompt
+from utils.history import ChatHistory
+from utils.models import sampling_kwargs
+from utils.scheduler import Scheduler
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below in a few short paragraphs. Keep the facts, names, "
+    "decisions, code and open questions that later answers may need. Write only the summary."
+)
+
+logger = logging.getLogger(__name__)
+
+
+# four collaborators of the command plus the summarisation settings
+class Compactor:  # pylint: disable=too-many-instance-attributes
+    """
+    This class contains the Compactor.
+
+    Once a conversation crosses the token threshold, waits for the scheduler
+    to go idle and summarises the older turns with a small model. The summary
+    replaces those turns in the store as one system message, and the raw
+    turns are archived for Send Chat.
+    """
+
+    def __init__(
+        self,
+        history: ChatHistory,
+        generation,
+        scheduler: Scheduler,
+        budgeter: HistoryBudgeter,
+        model: int,
+        threshold: int = 0,
+        keep: int = 4
+    ) -> None:
+        self.history = history
+        self.generation = generation
+        self.scheduler = scheduler
+        self.budgeter = budgeter
+        self.model = model
+        self.threshold = threshold
+        self.keep = keep - keep % 2
+        self.tasks: Dict[str, asyncio.Task] = {}
+
+    def schedule(self, key: str, model: int) -> None:
+        """
+        function schedule start a background compaction check for a conversation
+        """
+        if self.threshold <= 0 or key in self.tasks:
+            return
+        task = asyncio.create_task(self.run(key, model))
+        self.tasks[key] = task
+        task.add_done_callback(lambda _: self.tasks.pop(key, None))
+
+    def get_summary_template(self, messages: List[ChatMessage]) -> List[ChatMessage]:
+        """
+        function get_summary_template build the summarisation prompt
+        """
+        transcript = "\n".join(
+            f"{message.role.value if hasattr(message.role, 'value') else message.role}: "
+            f"{message.content}"
+            for message in messages
+        )
+        return [
+            ChatMessage(role=MessageRole.SYSTEM, content=SUMMARY_PROMPT),
+            ChatMessage(role=MessageRole.USER, content=transcript)
+        ]
+
+    async def run(self, key: str, model: int) -> None:
+        """
+        function run compact a conversation when it is over the threshold
+        """
+        try:
+            messages = await self.history.get(key)
+            if sum(await self.budgeter.count(model, messages)) <= self.threshold:
+                return
+            summaries = 1 if messages and messages[0].role == MessageRole.SYSTEM else 0
+            cut = len(messages) - summaries - self.keep
+            cut -= cut % 2
+            if cut <= 0:
+                return
+            older = messages[:summaries + cut]
+            await self.scheduler.idle()
+            async with self.scheduler.slot(author="compaction", lane=self.model, priority=-1):
+                summary = await self.generation.complete(
+                    self.model,
+                    messages_to_prompt(
+                        self.get_summary_template(older),
+                        self.budgeter.models[self.model]["chat_format"]
+                    ),
+                    sampling_kwargs(max_new_tokens=512)
+                )
+            compacted = await self.history.compact(
+                key,
+                older,
+                ChatMessage(
+                    role=MessageRole.SYSTEM,
+                    content=summary.replace("<|im_end|>", "").strip(),
+                    additional_kwargs={"summary": True}
+                ),
+                archived=older[summaries:]
+            )
+            logger.info("Compacted %s messages of %s: %s", len(older), key, compacted)
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.exception("Compaction of %s failed", key)
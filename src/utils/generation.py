@@ -0,0 +1,214 @@
+"""
+This module contains the generation executor for bot.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import AsyncIterator, Dict, List, Set
+
+from utils.metrics import (
+    GENERATION_SECONDS,
+    SPECULATIVE_ACCEPTANCE,
+    TIME_TO_FIRST_TOKEN_SECONDS,
+    TOKENS_PER_SECOND
+)
+from utils.models import ModelPool
+
+logger = logging.getLogger(__name__)
+
+
+class StopSignal(threading.Event):
+    """
+    This class contains the StopSignal, a stop event that remembers why it was set.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.reason: str = None
+
+    def stop(self, reason: str) -> None:
+        """
+        function stop set the event, keeping the first reason
+        """
+        if not self.is_set():
+            self.reason = reason
+            self.set()
+
+
+class LocalExecutor:
+    """
+    This class contains the LocalExecutor.
+
+    The part of the stream/complete interface shared by the executors that
+    generate in this process: subclasses implement `stream` and run each
+    generation inside `running`, so shutdown can stop it.
+    """
+
+    def __init__(self, pool: ModelPool) -> None:
+        self.pool = pool
+        self.active: Set[threading.Event] = set()
+
+    async def stream(
+        self,
+        model: int,
+        prompt: str,
+        params: Dict,
+        stop: threading.Event = None
+    ) -> AsyncIterator[str]:
+        """
+        function stream yield the generated text deltas
+        """
+        raise NotImplementedError
+
+    @contextmanager
+    def running(self, stop: threading.Event = None):
+        """
+        function running track the stop event of a generation, setting it when it ends
+        """
+        stop = stop or threading.Event()
+        self.active.add(stop)
+        try:
+            yield stop
+        finally:
+            stop.set()
+            self.active.discard(stop)
+
+    async def complete(self, model: int, prompt: str, params: Dict) -> str:
+        """
+        function complete return the whole generated text
+        """
+        return "".join([delta async for delta in self.stream(model, prompt, params)])
+
+    async def count_tokens(self, model: int, texts: List[str]) -> List[int]:
+        """
+        function count_tokens count tokens with the model's tokenizer off the event loop
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.pool.count_tokens, model, texts)
+
+    def stop_all(self) -> None:
+        """
+        function stop_all stop the running generations
+        """
+        for stop in list(self.active):
+            stop.set()
+
+
+class GenerationExecutor(LocalExecutor):
+    """
+    This class contains the GenerationExecutor.
+
+    Runs the synchronous llama.cpp generators on worker threads and feeds
+    the tokens back to the event loop through a bounded asyncio queue.
+    """
+
+    def __init__(self, pool: ModelPool, workers: int = 1, queue_size: int = 64):
+        super().__init__(pool)
+        self.queue_size = queue_size
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="dolphin-generation"
+        )
+
+    def produce(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        queue: asyncio.Queue,
+        stop: threading.Event,
+        model: int,
+        prompt: str,
+        params: Dict
+    ) -> None:
+        """
+        function produce run one generation on a worker thread
+        """
+        name = self.pool.models[model]["name"]
+        with self.pool.acquire(model) as llm:
+            started = time.monotonic()
+            first = None
+            tokens = 0
+            draft = getattr(llm, "draft_model", None)
+            drafted = draft.snapshot() if draft is not None else None
+            try:
+                # checked by llama.cpp after every decoded token, even while the queue is full
+                for chunk in llm(
+                    prompt=prompt,
+                    stream=True,
+                    stopping_criteria=lambda input_ids, logits: stop.is_set(),
+                    **params
+                ):
+                    if stop.is_set():
+                        break
+                    if first is None:
+                        first = time.monotonic()
+                        TIME_TO_FIRST_TOKEN_SECONDS.observe(first - started, model=name)
+                    tokens += 1
+                    if not self.put(loop, queue, stop, chunk["choices"][0]["text"]):
+                        return
+            finally:
+                ended = time.monotonic()
+                GENERATION_SECONDS.observe(ended - started, model=name)
+                if first is not None and tokens > 1 and ended > first:
+                    TOKENS_PER_SECOND.observe((tokens - 1) / (ended - first), model=name)
+                if draft is not None:
+                    acceptance = draft.acceptance(drafted, tokens)
+                    if acceptance is not None:
+                        SPECULATIVE_ACCEPTANCE.observe(acceptance, model=name)
+                        logger.info("Speculative acceptance of %s: %.0f%%", name, acceptance * 100)
+
+    def put(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        queue: asyncio.Queue,
+        stop: threading.Event,
+        delta: str
+    ) -> bool:
+        """
+        function put hand a delta to the event loop, waiting while the queue is full
+        """
+        put = asyncio.run_coroutine_threadsafe(queue.put(delta), loop)
+        while True:
+            try:
+                put.result(timeout=0.1)
+                return True
+            except concurrent.futures.TimeoutError:
+                if stop.is_set():
+                    put.cancel()
+                    return False
+
+    async def stream(
+        self,
+        model: int,
+        prompt: str,
+        params: Dict,
+        stop: threading.Event = None
+    ) -> AsyncIterator[str]:
+        """
+        function stream yield the generated text deltas without blocking the loop
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        with self.running(stop) as event:
+            future = loop.run_in_executor(
+                self.executor, self.produce, loop, queue, event, model, prompt, params
+            )
+            while not (future.done() and queue.empty()):
+                getter = asyncio.ensure_future(queue.get())
+                await asyncio.wait({getter, future}, return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    yield getter.result()
+                else:
+                    getter.cancel()
+            future.result()
+
+    def shutdown(self) -> None:
+        """
+        function shutdown stop the running generations and the workers
+        """
+        self.stop_all()
+        self.executor.shutdown(wait=True, cancel_futures=True)
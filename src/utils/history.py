@@ -0,0 +1,257 @@
+"""
+This module contains the async chat history store for bot.
+"""
+
+import asyncio
+import json
+import time
+import uuid
+
+from collections import OrderedDict
+from typing import AsyncIterator, List, Tuple
+
+from llama_index.core.llms import ChatMessage
+from redis.asyncio import Redis
+from redis.exceptions import WatchError
+
+from utils.metrics import REDIS_SECONDS
+from utils.pubsub import subscribe
+
+
+class ChatHistory:
+    """
+    This class contains the ChatHistory.
+
+    Async Redis chat store, using the same list layout as RedisChatStore,
+    with pipelined appends that refresh the TTL in the same round-trip and
+    an in-process LRU write-through cache of the recent conversations. Every
+    write is published on `channel`, so the other replicas drop their copy.
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        ttl: int = 300,
+        cache_size: int = 256,
+        channel: str = "dolphin:history"
+    ) -> None:
+        self.redis = redis
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.cache: OrderedDict[str, Tuple[float, List[ChatMessage]]] = OrderedDict()
+        self.channel = channel
+        self.origin = uuid.uuid4().hex
+        self.task: asyncio.Task = None
+
+    @classmethod
+    def from_url(cls, redis_url: str, ttl: int = 300, max_connections: int = 16) -> "ChatHistory":
+        """
+        function from_url create the history over a pooled async Redis client
+        """
+        return cls(Redis.from_url(redis_url, max_connections=max_connections), ttl=ttl)
+
+    def cached(self, key: str) -> List[ChatMessage]:
+        """
+        function cached return the cached conversation if it did not expire
+        """
+        if key not in self.cache:
+            return None
+        expires, messages = self.cache[key]
+        if expires < time.monotonic():
+            del self.cache[key]
+            return None
+        self.cache.move_to_end(key)
+        return messages
+
+    def remember(self, key: str, messages: List[ChatMessage]) -> None:
+        """
+        function remember store a conversation in the LRU cache
+        """
+        self.cache[key] = (time.monotonic() + self.ttl, messages)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def get(self, key: str) -> List[ChatMessage]:
+        """
+        function get return the messages of a conversation
+        """
+        messages = self.cached(key)
+        if messages is not None:
+            return list(messages)
+        started = time.monotonic()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.lrange(key, 0, -1)
+            pipe.expire(key, self.ttl)
+            pipe.expire(f"{key}:raw", self.ttl)
+            items, *_ = await pipe.execute()
+        REDIS_SECONDS.observe(time.monotonic() - started, op="get")
+        messages = [ChatMessage(**json.loads(item)) for item in items]
+        self.remember(key, messages)
+        return list(messages)
+
+    async def append(self, key: str, *messages: ChatMessage) -> None:
+        """
+        function append add messages to a conversation in one round-trip
+        """
+        started = time.monotonic()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, *[json.dumps(message.dict()) for message in messages])
+            pipe.expire(key, self.ttl)
+            pipe.expire(f"{key}:raw", self.ttl)
+            pipe.publish(self.channel, f"{self.origin} {key}")
+            await pipe.execute()
+        REDIS_SECONDS.observe(time.monotonic() - started, op="append")
+        cached = self.cached(key)
+        if cached is not None:
+            self.remember(key, cached + list(messages))
+
+    async def replace_last(self, key: str, message: ChatMessage) -> None:
+        """
+        function replace_last overwrite the last message of a conversation in place
+        """
+        started = time.monotonic()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.lset(key, -1, json.dumps(message.dict()))
+            pipe.expire(key, self.ttl)
+            pipe.publish(self.channel, f"{self.origin} {key}")
+            await pipe.execute()
+        REDIS_SECONDS.observe(time.monotonic() - started, op="replace")
+        cached = self.cached(key)
+        if cached:
+            self.remember(key, cached[:-1] + [message])
+
+    async def transcript_page(
+        self,
+        key: str,
+        start: int,
+        count: int
+    ) -> Tuple[List[ChatMessage], int]:
+        """
+        function transcript_page return a page of the archived and live turns and their total
+        """
+        started = time.monotonic()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.llen(f"{key}:raw")
+            pipe.llen(key)
+            pipe.lindex(key, 0)
+            archived, live, head = await pipe.execute()
+        # a compaction summary heads the live list, it is not part of the transcript
+        offset = 1 if head is not None and json.loads(head).get(
+            "additional_kwargs", {}
+        ).get("summary") else 0
+        total = archived + live - offset
+        stop = min(start + count, total)
+        items = []
+        if start < stop:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                if start < archived:
+                    pipe.lrange(f"{key}:raw", start, min(stop, archived) - 1)
+                if stop > archived:
+                    pipe.lrange(
+                        key, max(start - archived, 0) + offset, stop - archived + offset - 1
+                    )
+                for chunk in await pipe.execute():
+                    items.extend(chunk)
+        REDIS_SECONDS.observe(time.monotonic() - started, op="page")
+        return [ChatMessage(**json.loads(item)) for item in items], total
+
+    async def transcript(self, key: str, chunk: int = 64) -> AsyncIterator[ChatMessage]:
+        """
+        function transcript yield the archived and live turns, reading `chunk` at a time
+        """
+        start = 0
+        while True:
+            messages, total = await self.transcript_page(key, start, chunk)
+            for message in messages:
+                yield message
+            start += len(messages)
+            if not messages or start >= total:
+                break
+
+    async def compact(
+        self,
+        key: str,
+        expected: List[ChatMessage],
+        summary: ChatMessage,
+        archived: List[ChatMessage],
+        retries: int = 3
+    ) -> bool:
+        """
+        function compact replace the leading messages by a summary if they did not change
+        """
+        started = time.monotonic()
+        for _ in range(retries):
+            async with self.redis.pipeline(transaction=True) as pipe:
+                try:
+                    await pipe.watch(key)
+                    head = [
+                        ChatMessage(**json.loads(item))
+                        for item in await pipe.lrange(key, 0, len(expected) - 1)
+                    ]
+                    if [(message.role, message.content) for message in head] != [
+                        (message.role, message.content) for message in expected
+                    ]:
+                        return False
+                    pipe.multi()
+                    if archived:
+                        pipe.rpush(
+                            f"{key}:raw", *[json.dumps(message.dict()) for message in archived]
+                        )
+                    pipe.ltrim(key, len(expected), -1)
+                    pipe.lpush(key, json.dumps(summary.dict()))
+                    pipe.expire(key, self.ttl)
+                    pipe.expire(f"{key}:raw", self.ttl)
+                    pipe.publish(self.channel, f"{self.origin} {key}")
+                    await pipe.execute()
+                    break
+                except WatchError:
+                    continue
+        else:
+            return False
+        REDIS_SECONDS.observe(time.monotonic() - started, op="compact")
+        self.cache.pop(key, None)
+        return True
+
+    async def clear(self, key: str) -> None:
+        """
+        function clear delete a conversation
+        """
+        self.cache.pop(key, None)
+        started = time.monotonic()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.delete(key, f"{key}:raw")
+            pipe.publish(self.channel, f"{self.origin} {key}")
+            await pipe.execute()
+        REDIS_SECONDS.observe(time.monotonic() - started, op="clear")
+
+    def invalidate(self, data: str) -> None:
+        """
+        function invalidate drop a conversation another replica wrote from the cache
+        """
+        origin, _, key = data.partition(" ")
+        if origin != self.origin:
+            self.cache.pop(key, None)
+
+    async def listen(self) -> None:
+        """
+        function listen drop the cached conversations written by other replicas
+        """
+        # writes published while disconnected are missed, start over from Redis
+        await subscribe(self.redis, self.channel, self.invalidate, on_lost=self.cache.clear)
+
+    def start(self) -> None:
+        """
+        function start subscribe to the writes of other replicas once, in the running loop
+        """
+        if self.task is None and self.cache_size > 0:
+            self.task = asyncio.create_task(self.listen())
+
+    async def close(self) -> None:
+        """
+        function close stop the subscription and release the Redis connections
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.redis.aclose()
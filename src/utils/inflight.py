@@ -0,0 +1,130 @@
+"""
+This module contains the shared in-flight generation state for bot.
+"""
+
+import asyncio
+import time
+
+from typing import Callable, Dict, Optional
+
+from redis.asyncio import Redis
+
+from utils.generation import StopSignal
+from utils.pubsub import subscribe
+
+
+def text(value) -> Optional[str]:
+    """
+    function text decode a Redis reply of a client without decode_responses
+    """
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+class InflightRegistry:
+    """
+    This class contains the InflightRegistry.
+
+    Keeps the stop signal of every generation running in this process and
+    mirrors it to Redis with its replica, so a cancel can come from any
+    replica. A cancel sets a flag key, seen by generations that register
+    later, and is published to every replica, where the owner stops it.
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        replica: str,
+        ttl: int = 600,
+        prefix: str = "dolphin",
+        on_stop: Callable[[], None] = None
+    ) -> None:
+        self.redis = redis
+        self.replica = replica
+        self.ttl = ttl
+        self.prefix = prefix
+        self.on_stop = on_stop
+        self.stops: Dict[str, StopSignal] = {}
+        self.task: asyncio.Task = None
+
+    @property
+    def channel(self) -> str:
+        """
+        function channel return the pub/sub channel of the cancels
+        """
+        return f"{self.prefix}:cancel"
+
+    def stop(self, generation_id: str, reason: str) -> bool:
+        """
+        function stop stop a generation of this process, returning if it was running
+        """
+        stop = self.stops.get(generation_id)
+        if stop is None or stop.is_set():
+            return False
+        stop.stop(reason)
+        if self.on_stop is not None:
+            self.on_stop()
+        return True
+
+    async def add(self, generation_id: str, stop: StopSignal, **fields) -> None:
+        """
+        function add register a generation, stopping it at once if it was cancelled already
+        """
+        self.stops[generation_id] = stop
+        key = f"{self.prefix}:inflight:{generation_id}"
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(key, mapping={"replica": self.replica, "started": time.time(), **fields})
+            pipe.expire(key, self.ttl)
+            pipe.get(f"{self.prefix}:cancel:{generation_id}")
+            *_, reason = await pipe.execute()
+        if reason is not None:
+            self.stop(generation_id, text(reason))
+
+    async def remove(self, generation_id: str) -> None:
+        """
+        function remove drop a finished generation
+        """
+        self.stops.pop(generation_id, None)
+        await self.redis.delete(f"{self.prefix}:inflight:{generation_id}")
+
+    async def cancel(self, generation_id: str, reason: str) -> bool:
+        """
+        function cancel stop a generation on whichever replica runs it
+
+        Returns if the generation was running here or is registered elsewhere.
+        """
+        if self.stop(generation_id, reason):
+            return True
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(f"{self.prefix}:cancel:{generation_id}", reason, ex=self.ttl)
+            pipe.exists(f"{self.prefix}:inflight:{generation_id}")
+            pipe.publish(self.channel, f"{generation_id} {reason}")
+            _, running, _ = await pipe.execute()
+        return bool(running)
+
+    def on_cancel(self, data: str) -> None:
+        """
+        function on_cancel stop a generation cancelled through another replica
+        """
+        generation_id, _, reason = data.partition(" ")
+        self.stop(generation_id, reason)
+
+    async def listen(self) -> None:
+        """
+        function listen stop the generations cancelled by other replicas
+        """
+        await subscribe(self.redis, self.channel, self.on_cancel)
+
+    def start(self) -> None:
+        """
+        function start subscribe to the cancels once, in the running loop
+        """
+        if self.task is None:
+            self.task = asyncio.create_task(self.listen())
+
+    async def close(self) -> None:
+        """
+        function close stop the cancel subscription
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
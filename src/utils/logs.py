@@ -0,0 +1,23 @@
+"""
+This module contains the non-blocking logging setup for bot.
+"""
+
+import logging
+import queue
+
+from logging.handlers import QueueHandler, QueueListener
+
+
+def setup_logging(level: int = logging.INFO) -> QueueListener:
+    """
+    function setup_logging route every record through a queue drained by a listener thread
+    """
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(log_queue)]
+    root.setLevel(level)
+    listener.start()
+    return listener
@@ -0,0 +1,231 @@
+"""
+This module contains the Prometheus metrics for bot.
+"""
+
+import bisect
+import threading
+
+from typing import Dict, List, Tuple
+
+from aiohttp import web
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 120, 200)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1)
+
+
+class Metric:
+    """
+    This class contains the base Metric with labels.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        """
+        function key return the label values in declaration order
+        """
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def label_text(self, key: Tuple[str, ...], extra: str = "") -> str:
+        """
+        function label_text format a label set
+        """
+        pairs = [f'{label}="{value}"' for label, value in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> List[str]:
+        """
+        function samples return the exposition lines of the metric
+        """
+        raise NotImplementedError
+
+    def render(self) -> str:
+        """
+        function render return the metric in the Prometheus text format
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """
+    This class contains the Counter metric.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        """
+        function inc increase the counter
+        """
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self.label_text(key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    """
+    This class contains the Gauge metric.
+    """
+
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        """
+        function dec decrease the gauge
+        """
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        """
+        function set set the gauge
+        """
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """
+    This class contains the Histogram metric.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        """
+        function observe record a sample
+        """
+        key = self.key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                counts[index] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = self.label_text(key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            inf = self.label_text(key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{inf} {count}")
+            lines.append(f"{self.name}_sum{self.label_text(key)} {total}")
+            lines.append(f"{self.name}_count{self.label_text(key)} {count}")
+        return lines
+
+
+REGISTRY: List[Metric] = []
+
+MODEL_LOAD_SECONDS = Histogram(
+    "dolphin_model_load_seconds", "Time to load a model", ("model",)
+)
+TIME_TO_FIRST_TOKEN_SECONDS = Histogram(
+    "dolphin_time_to_first_token_seconds", "Time from generation start to first token", ("model",)
+)
+TOKENS_PER_SECOND = Histogram(
+    "dolphin_tokens_per_second", "Decode rate of a generation", ("model",), RATE_BUCKETS
+)
+GENERATION_SECONDS = Histogram(
+    "dolphin_generation_seconds", "Total generation time", ("model",)
+)
+SPECULATIVE_ACCEPTANCE = Histogram(
+    "dolphin_speculative_acceptance", "Estimated share of drafted tokens accepted per generation",
+    ("model",), RATIO_BUCKETS
+)
+RETRIEVAL_SECONDS = Histogram(
+    "dolphin_retrieval_seconds", "Latency of a query embedding or index search", ("op",)
+)
+DISCORD_EDIT_SECONDS = Histogram(
+    "dolphin_discord_edit_seconds", "Latency of a Discord message edit or send"
+)
+REDIS_SECONDS = Histogram(
+    "dolphin_redis_seconds", "Latency of a chat history Redis round-trip", ("op",)
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "dolphin_requests_in_flight", "Generations running"
+)
+QUEUE_DEPTH = Gauge(
+    "dolphin_queue_depth", "Requests waiting for a generation slot"
+)
+MODELS_LOADED = Gauge(
+    "dolphin_models_loaded", "Models resident in memory"
+)
+BATCH_SEQUENCES = Gauge(
+    "dolphin_batch_sequences", "Sequences decoding in the batch of a model", ("model",)
+)
+ADMISSION_BACKLOG_SECONDS = Gauge(
+    "dolphin_admission_backlog_seconds", "Estimated seconds of admitted work per model", ("model",)
+)
+ADMISSION_TOTAL = Counter(
+    "dolphin_admission_total", "Admission decisions by result", ("result",)
+)
+RESPONSE_CACHE_TOTAL = Counter(
+    "dolphin_response_cache_total", "Response cache lookups by result", ("result",)
+)
+CANCELS_TOTAL = Counter(
+    "dolphin_cancels_total", "Generations stopped early by reason", ("reason",)
+)
+ERRORS_TOTAL = Counter(
+    "dolphin_errors_total", "Errors by kind", ("kind",)
+)
+
+
+def render() -> str:
+    """
+    function render return every metric in the Prometheus text format
+    """
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+async def metrics_handler(_: web.Request) -> web.Response:
+    """
+    Serve the metrics
+    """
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """
+    function start_metrics_server serve /metrics on the running event loop
+    """
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
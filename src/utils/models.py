@@ -0,0 +1,462 @@
+"""
+This module contains the resident model pool for bot.
+"""
+
+import concurrent.futures
+import json
+import logging
+import os
+import struct
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple
+
+from dotenv import load_dotenv
+
+from utils.metrics import MODEL_LOAD_SECONDS, MODELS_LOADED
+
+if TYPE_CHECKING:
+    # llama.cpp is imported on the first model load, so the bot starts without it
+    from llama_cpp import Llama
+    from utils.prefix_cache import TieredLlamaCache
+
+load_dotenv()
+DOLPHIN_PATH = os.getenv('DOLPHIN_PATH')
+DOLPHIN_MODELS = os.getenv('DOLPHIN_MODELS')
+DOLPHIN_MODEL_PROFILES = os.getenv('DOLPHIN_MODEL_PROFILES')
+DOLPHIN_GPU_LAYERS = os.getenv('DOLPHIN_GPU_LAYERS')
+DOLPHIN_NTHREADS = os.getenv('DOLPHIN_NTHREADS')
+DOLPHIN_POOL_BUDGET_MB = int(os.getenv('DOLPHIN_POOL_BUDGET_MB', str(0)))
+DOLPHIN_CACHE_RAM_MB = int(os.getenv('DOLPHIN_CACHE_RAM_MB', str(2048)))
+DOLPHIN_CACHE_DISK_MB = int(os.getenv('DOLPHIN_CACHE_DISK_MB', str(8192)))
+DOLPHIN_CACHE_DIR = os.getenv('DOLPHIN_CACHE_DIR')
+DOLPHIN_BATCH_SLOTS = int(os.getenv('DOLPHIN_BATCH_SLOTS', str(0)))
+DOLPHIN_PREWARM = os.getenv('DOLPHIN_PREWARM', '')
+DOLPHIN_USE_MMAP = os.getenv('DOLPHIN_USE_MMAP', '1') == '1'
+DOLPHIN_USE_MLOCK = os.getenv('DOLPHIN_USE_MLOCK', '0') == '1'
+DOLPHIN_READAHEAD = os.getenv('DOLPHIN_READAHEAD', '0') == '1'
+DOLPHIN_CONTEXT_WINDOW = 8192
+
+# ggml type ids of the KV cache types llama.cpp supports
+KV_CACHE_TYPES = {"f16": 1, "q8_0": 8, "q5_1": 7, "q5_0": 6, "q4_1": 3, "q4_0": 2}
+CHAT_FORMATS = ("llama2", "chatml")
+
+logger = logging.getLogger(__name__)
+
+
+def default_profile() -> Dict[str, Any]:
+    """
+    function default_profile return the runtime settings of a model without a profile
+    """
+    n_threads = int(DOLPHIN_NTHREADS) if DOLPHIN_NTHREADS else None
+    return {
+        "context_window": DOLPHIN_CONTEXT_WINDOW,
+        "n_batch": 512,
+        "n_threads": n_threads,
+        "n_threads_batch": n_threads,
+        "n_gpu_layers": int(DOLPHIN_GPU_LAYERS) if DOLPHIN_GPU_LAYERS else 0,
+        "main_gpu": 0,
+        "tensor_split": None,
+        "type_k": "f16",
+        "type_v": "f16",
+        "flash_attn": False,
+        "chat_format": "llama2",
+        "memory_mb": 0
+    }
+
+
+def model_profile(entry: Dict[str, Any], path: str) -> Dict[str, Any]:
+    """
+    function model_profile fill a profile entry with the defaults and check its settings
+    """
+    profile = {**default_profile(), **entry}
+    if not profile.get("name") or not profile.get("file"):
+        raise ValueError(f"Model profile needs a name and a file: {entry}")
+    if not os.path.isabs(profile["file"]):
+        profile["file"] = f"{path}/{profile['file']}"
+    draft = profile.get("draft")
+    if isinstance(draft, str):
+        profile["draft"] = parse_draft(draft, path)
+    for cache in ("type_k", "type_v"):
+        if profile[cache] not in KV_CACHE_TYPES:
+            raise ValueError(f"Unknown KV cache type {profile[cache]} for {profile['name']}")
+    if profile["type_v"] != "f16" and not profile["flash_attn"]:
+        raise ValueError(f"A quantised V cache needs flash_attn for {profile['name']}")
+    if profile["chat_format"] not in CHAT_FORMATS:
+        raise ValueError(f"Unknown chat format {profile['chat_format']} for {profile['name']}")
+    return profile
+
+
+def load_profiles(file: str, path: str) -> List[Dict[str, Any]]:
+    """
+    function load_profiles read the JSON list of model profiles of DOLPHIN_MODEL_PROFILES
+
+    Each entry has a name and a file (relative to DOLPHIN_PATH), and
+    optionally a draft spec and any key of default_profile.
+    """
+    with open(file, encoding="utf-8") as profiles_file:
+        entries = json.load(profiles_file)
+    return [model_profile(entry, path) for entry in entries]
+
+
+def get_models() -> List[Dict[str, Any]]:
+    """
+    function get_models return the models of the profile file, else of DOLPHIN_MODELS
+    """
+    if DOLPHIN_MODEL_PROFILES:
+        return load_profiles(DOLPHIN_MODEL_PROFILES, DOLPHIN_PATH)
+    return parse_models(DOLPHIN_MODELS, DOLPHIN_PATH)
+
+
+def llama_kwargs(model: Dict[str, Any], slots: int = 0) -> Dict[str, Any]:
+    """
+    function llama_kwargs return the llama.cpp context settings of a model profile
+    """
+    kwargs = {
+        "model_path": model["file"],
+        "n_ctx": model["context_window"] * max(1, slots),
+        "n_batch": model["n_batch"],
+        "n_threads": model["n_threads"],
+        "n_threads_batch": model["n_threads_batch"],
+        "n_gpu_layers": model["n_gpu_layers"],
+        "main_gpu": model["main_gpu"],
+        "type_k": KV_CACHE_TYPES[model["type_k"]],
+        "type_v": KV_CACHE_TYPES[model["type_v"]],
+        "flash_attn": model["flash_attn"],
+        "use_mmap": DOLPHIN_USE_MMAP,
+        "use_mlock": DOLPHIN_USE_MLOCK
+    }
+    if model["tensor_split"]:
+        kwargs["tensor_split"] = model["tensor_split"]
+    return kwargs
+
+
+def parse_draft(spec: str, path: str) -> Tuple[str, int]:
+    """
+    function parse_draft parse a `lookup[=n]` or `<file>[=n]` draft spec
+    """
+    kind, _, tokens = spec.partition("=")
+    if kind == "lookup":
+        return "lookup", int(tokens or 10)
+    return f"{path}/{kind}", int(tokens or 4)
+
+
+def parse_models(models: str, path: str) -> List[Dict[str, Any]]:
+    """
+    function parse_models parse the `name:file[:draft]` entries of DOLPHIN_MODELS
+
+    The optional draft enables speculative decoding, either `lookup[=n]` for
+    prompt-lookup decoding or `<draft-file>[=n]` for a small draft GGUF, with
+    `n` the number of tokens drafted per step. The other settings are the
+    defaults of a model profile.
+    """
+    parsed = []
+    for model_str in models.split(","):
+        name, file, *draft = model_str.split(":")
+        parsed.append(model_profile(
+            {"name": name, "file": file, "draft": draft[0] if draft else None}, path
+        ))
+    return parsed
+
+
+def parse_prewarm(prewarm: str, models: List[Dict[str, str]]) -> List[int]:
+    """
+    function parse_prewarm return the indexes of the `all` or `name,...` models to prewarm
+    """
+    if prewarm.strip() == "all":
+        return list(range(len(models)))
+    names = [model["name"] for model in models]
+    indexes = []
+    for name in filter(None, (name.strip() for name in prewarm.split(","))):
+        if name not in names:
+            raise ValueError(f"Unknown model to prewarm: {name}")
+        indexes.append(names.index(name))
+    return indexes
+
+
+def read_gguf_header(file: str) -> Tuple[int, int, int]:
+    """
+    function read_gguf_header return the version, tensor count and metadata count of a GGUF file
+    """
+    if not os.path.isfile(file):
+        raise ValueError(f"Model file not found: {file}")
+    with open(file, "rb") as model_file:
+        header = model_file.read(24)
+    if len(header) < 24 or header[:4] != b"GGUF":
+        raise ValueError(f"Not a GGUF file: {file}")
+    version, tensors, metadata = struct.unpack("<IQQ", header[4:24])
+    if version not in (1, 2, 3):
+        raise ValueError(f"Unsupported GGUF version {version}: {file}")
+    return version, tensors, metadata
+
+
+def sampling_kwargs(
+    max_new_tokens: int = 2048,
+    temperature: float = 0.1,
+    repeat_penalty: float = 1.3,
+    top_k: int = 50,
+    top_p: float = 0.95
+) -> Dict[str, float]:
+    """
+    function sampling_kwargs build the per request llama.cpp sampling params
+    """
+    return {
+        "max_tokens": max_new_tokens,
+        "temperature": temperature,
+        "repeat_penalty": repeat_penalty,
+        "top_k": top_k,
+        "top_p": top_p
+    }
+
+
+# the pool keeps per-model bookkeeping next to the models it guards
+class ModelPool:  # pylint: disable=too-many-instance-attributes
+    """
+    This class contains the ModelPool.
+
+    Keeps loaded models resident and evicts the least recently used ones
+    once their summed footprint goes over the budget (0 = unlimited). Each
+    model is loaded with the settings of its profile and warmed with its
+    `prefix`. With `slots` > 0 each model gets one context sized for that
+    many batched sequences, and the prefix is handled by the batch engine.
+    """
+
+    def __init__(
+        self,
+        models: List[Dict[str, Any]],
+        budget_mb: int = DOLPHIN_POOL_BUDGET_MB,
+        slots: int = 0
+    ):
+        self.models = models
+        self.slots = slots
+        self.budget = budget_mb * 1024 * 1024
+        self.loaded: OrderedDict[int, Llama] = OrderedDict()
+        self.caches: Dict[int, TieredLlamaCache] = {}
+        self.tokenizers: Dict[int, Llama] = {}
+        self.in_use: Dict[int, int] = {}
+        self.load_times: Dict[int, float] = {}
+        self.loading: Dict[int, concurrent.futures.Future] = {}
+        self.lock = threading.Lock()
+        self.model_locks = [threading.Lock() for _ in models]
+
+    def size(self, index: int) -> int:
+        """
+        function size return the model footprint measured by the tuner, else its file size
+        """
+        if self.models[index].get("memory_mb"):
+            return self.models[index]["memory_mb"] * 1024 * 1024
+        draft = self.models[index].get("draft")
+        size = os.path.getsize(self.models[index]["file"])
+        if draft and draft[0] != "lookup":
+            size += os.path.getsize(draft[0])
+        return size
+
+    def validate(self) -> None:
+        """
+        function validate check every model and draft file has a readable GGUF header
+        """
+        for model in self.models:
+            version, tensors, _ = read_gguf_header(model["file"])
+            logger.info("Model %s: GGUF v%s, %s tensors", model["name"], version, tensors)
+            if model.get("draft") and model["draft"][0] != "lookup":
+                read_gguf_header(model["draft"][0])
+
+    def readahead(self, index: int) -> None:
+        """
+        function readahead ask the kernel to pull a model file into the page cache
+        """
+        if not hasattr(os, "posix_fadvise"):
+            return
+        fd = os.open(self.models[index]["file"], os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+    def resident_size(self) -> int:
+        """
+        function resident_size return the footprint of the loaded and loading models
+        """
+        return sum(self.size(index) for index in [*self.loaded, *self.loading])
+
+    def cache(self, index: int) -> "TieredLlamaCache":
+        """
+        function cache return the prompt prefix cache of a model
+
+        The cache outlives the model so an evicted model reloads warm.
+        """
+        from llama_cpp.llama_cache import LlamaDiskCache  # pylint: disable=import-outside-toplevel
+        from utils.prefix_cache import TieredLlamaCache  # pylint: disable=import-outside-toplevel
+        if index not in self.caches:
+            disk = None
+            if DOLPHIN_CACHE_DIR:
+                disk = LlamaDiskCache(
+                    cache_dir=f"{DOLPHIN_CACHE_DIR}/{self.models[index]['name']}",
+                    capacity_bytes=DOLPHIN_CACHE_DISK_MB * 1024 * 1024
+                )
+            self.caches[index] = TieredLlamaCache(DOLPHIN_CACHE_RAM_MB * 1024 * 1024, disk)
+        return self.caches[index]
+
+    def load(self, index: int) -> "Llama":
+        """
+        function load create the llama.cpp model
+        """
+        from llama_cpp import Llama  # pylint: disable=import-outside-toplevel
+        from utils.prefix_cache import warm_prefix  # pylint: disable=import-outside-toplevel
+        from utils.speculative import create_draft  # pylint: disable=import-outside-toplevel
+        started = time.monotonic()
+        if DOLPHIN_READAHEAD:
+            self.readahead(index)
+        draft = None
+        if self.models[index].get("draft") and self.slots:
+            logger.warning("Speculative decoding is not used with batching for %s",
+                           self.models[index]["name"])
+        elif self.models[index].get("draft"):
+            draft = create_draft(
+                self.models[index]["draft"],
+                n_ctx=self.models[index]["context_window"],
+                n_threads=self.models[index]["n_threads"],
+                n_gpu_layers=self.models[index]["n_gpu_layers"]
+            )
+        llm = Llama(
+            **llama_kwargs(self.models[index], self.slots),
+            draft_model=draft,
+            verbose=True,
+        )
+        if not self.slots:
+            llm.set_cache(self.cache(index))
+            warm_prefix(llm, self.models[index].get("prefix", ""))
+        elapsed = time.monotonic() - started
+        self.load_times[index] = elapsed
+        MODEL_LOAD_SECONDS.observe(elapsed, model=self.models[index]["name"])
+        logger.info("Loaded model %s in %.2fs", self.models[index]["name"], elapsed)
+        return llm
+
+    def tokenizer(self, index: int) -> "Llama":
+        """
+        function tokenizer return a vocab-only instance of a model for token counting
+        """
+        from llama_cpp import Llama  # pylint: disable=import-outside-toplevel
+        with self.lock:
+            if index not in self.tokenizers:
+                self.tokenizers[index] = Llama(
+                    model_path=self.models[index]["file"],
+                    vocab_only=True,
+                    verbose=False,
+                )
+            return self.tokenizers[index]
+
+    def count_tokens(self, index: int, texts: List[str]) -> List[int]:
+        """
+        function count_tokens count the tokens of each text with the model's tokenizer
+        """
+        tokenizer = self.tokenizer(index)
+        return [
+            len(tokenizer.tokenize(text.encode("utf-8"), add_bos=False, special=True))
+            for text in texts
+        ]
+
+    def unload(self, llm: "Llama") -> None:
+        """
+        function unload free a model and its draft model
+
+        The pinned llama-cpp-python has no Llama.close(), the context and
+        weights are freed by its internals once the last reference is gone.
+        """
+        if llm.draft_model is not None:
+            llm.draft_model.close()
+
+    def evict(self, needed: int) -> None:
+        """
+        function evict drop idle models in LRU order until `needed` bytes fit
+        """
+        if self.budget <= 0:
+            return
+        for index in list(self.loaded):
+            if self.resident_size() + needed <= self.budget:
+                break
+            if self.in_use.get(index, 0) > 0:
+                continue
+            logger.info("Evicting model %s", self.models[index]["name"])
+            self.unload(self.loaded.pop(index))
+            MODELS_LOADED.set(len(self.loaded))
+
+    def get(self, index: int) -> "Llama":
+        """
+        function get return a resident model, loading it when needed
+
+        The pool lock only covers the bookkeeping, the load itself runs
+        outside it so requests to resident models are not held up. Callers
+        asking for a model that is being loaded wait for that load.
+        """
+        with self.lock:
+            if index in self.loaded:
+                self.loaded.move_to_end(index)
+                return self.loaded[index]
+            loading = self.loading.get(index)
+            owner = loading is None
+            if owner:
+                self.evict(self.size(index))
+                loading = self.loading[index] = concurrent.futures.Future()
+        if not owner:
+            return loading.result()
+        try:
+            llm = self.load(index)
+        except BaseException as e:
+            with self.lock:
+                del self.loading[index]
+            loading.set_exception(e)
+            raise
+        with self.lock:
+            del self.loading[index]
+            self.loaded[index] = llm
+            MODELS_LOADED.set(len(self.loaded))
+        loading.set_result(llm)
+        return llm
+
+    def prewarm(self, indexes: List[int]) -> Dict[str, float]:
+        """
+        function prewarm load models ahead of the first request and report their load times
+
+        Runs alongside the requests: only requests for the model being
+        loaded wait, and they get it as soon as its load is done.
+        """
+        report = {}
+        for index in indexes:
+            try:
+                self.get(index)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Prewarm of %s failed", self.models[index]["name"])
+                continue
+            report[self.models[index]["name"]] = self.load_times.get(index, 0.0)
+        logger.info("Prewarmed models: %s", ", ".join(
+            f"{name} {elapsed:.2f}s" for name, elapsed in report.items()
+        ) or "none")
+        return report
+
+    @contextmanager
+    def acquire(self, index: int):
+        """
+        function acquire hold a model exclusively for one generation
+        """
+        with self.model_locks[index]:
+            with self.lock:
+                self.in_use[index] = self.in_use.get(index, 0) + 1
+            try:
+                yield self.get(index)
+            finally:
+                with self.lock:
+                    self.in_use[index] -= 1
+
+    def close(self) -> None:
+        """
+        function close free every resident model
+        """
+        with self.lock:
+            while self.loaded:
+                _, llm = self.loaded.popitem(last=False)
+                self.unload(llm)
+            MODELS_LOADED.set(0)
@@ -0,0 +1,89 @@
+"""
+This module contains the prompt prefix cache for bot.
+"""
+
+from collections import OrderedDict
+from typing import Optional, Sequence, Tuple
+
+from llama_cpp import Llama, LlamaState
+from llama_cpp.llama_cache import BaseLlamaCache, LlamaDiskCache
+
+
+class TieredLlamaCache(BaseLlamaCache):
+    """
+    This class contains the TieredLlamaCache.
+
+    Keeps llama.cpp state snapshots keyed by their token prefix in a RAM tier
+    with a byte budget, spilling the evicted snapshots to an optional disk tier.
+    Lookups return the snapshot sharing the longest prefix with the prompt.
+    """
+
+    def __init__(self, capacity_bytes: int, disk: Optional[LlamaDiskCache] = None):
+        super().__init__(capacity_bytes)
+        self.cache_state: OrderedDict[Tuple[int, ...], LlamaState] = OrderedDict()
+        self.disk = disk
+
+    @property
+    def cache_size(self):
+        """
+        function cache_size return the bytes held by the RAM tier
+        """
+        return sum(state.llama_state_size for state in self.cache_state.values())
+
+    def _find_longest_prefix_key(self, key: Tuple[int, ...]) -> Optional[Tuple[int, ...]]:
+        min_len = 0
+        min_key = None
+        for k in self.cache_state:
+            prefix_len = Llama.longest_token_prefix(k, key)
+            if prefix_len > min_len:
+                min_len = prefix_len
+                min_key = k
+        return min_key
+
+    def __getitem__(self, key: Sequence[int]) -> LlamaState:
+        key = tuple(key)
+        ram_key = self._find_longest_prefix_key(key)
+        ram_len = Llama.longest_token_prefix(ram_key, key) if ram_key is not None else 0
+        if self.disk is not None and key in self.disk:
+            # pylint: disable=protected-access
+            disk_key = self.disk._find_longest_prefix_key(key)
+            if Llama.longest_token_prefix(disk_key, key) > ram_len:
+                value = self.disk[disk_key]
+                self[disk_key] = value
+                return value
+        if ram_key is None:
+            raise KeyError("Key not found")
+        self.cache_state.move_to_end(ram_key)
+        return self.cache_state[ram_key]
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        key = tuple(key)
+        if self._find_longest_prefix_key(key) is not None:
+            return True
+        return self.disk is not None and key in self.disk
+
+    def __setitem__(self, key: Sequence[int], value: LlamaState):
+        key = tuple(key)
+        if key in self.cache_state:
+            del self.cache_state[key]
+        self.cache_state[key] = value
+        while self.cache_size > self.capacity_bytes and len(self.cache_state) > 1:
+            evicted_key, evicted = self.cache_state.popitem(last=False)
+            if self.disk is not None:
+                self.disk[evicted_key] = evicted
+
+
+def warm_prefix(llm: Llama, prefix: str) -> None:
+    """
+    function warm_prefix evaluate a shared prompt prefix once and cache its state
+    """
+    if not prefix or llm.cache is None:
+        return
+    tokens = llm.tokenize(prefix.encode("utf-8"), special=True)
+    if tokens in llm.cache:
+        state = llm.cache[tokens]
+        if Llama.longest_token_prefix(state.input_ids.tolist(), tokens) == len(tokens):
+            return
+    llm.reset()
+    llm.eval(tokens)
+    llm.cache[tokens] = llm.save_state()
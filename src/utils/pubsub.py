@@ -0,0 +1,43 @@
+"""
+This module contains the Redis pub/sub subscription helper for bot.
+"""
+
+import asyncio
+import logging
+
+from typing import Callable
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+
+async def subscribe(
+    redis: Redis,
+    channel: str,
+    handle: Callable[[str], None],
+    on_lost: Callable[[], None] = None
+) -> None:
+    """
+    function subscribe call `handle` with every message of a channel until cancelled
+
+    Resubscribes when the connection drops, calling `on_lost` first since
+    the messages published meanwhile are gone.
+    """
+    while True:
+        pubsub = redis.pubsub()
+        try:
+            await pubsub.subscribe(channel)
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                data = message["data"]
+                handle(data.decode("utf-8") if isinstance(data, bytes) else data)
+        except RedisError:
+            logger.warning("Subscription to %s lost, reconnecting", channel, exc_info=True)
+            if on_lost is not None:
+                on_lost()
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
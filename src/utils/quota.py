@@ -0,0 +1,112 @@
+"""
+This module contains the Redis token-bucket quotas for bot.
+"""
+
+import time
+
+from typing import Dict, Tuple
+
+from redis.asyncio import Redis
+
+from utils.metrics import REDIS_SECONDS
+
+# refill, then take `cost` when the bucket holds it, timed by the Redis clock so
+# every replica agrees; a negative cost refunds up to the capacity
+TOKEN_BUCKET = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if cost <= tokens then
+    tokens = math.min(capacity, tokens - cost)
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+local wait = 0
+if allowed == 0 then
+    wait = (cost - tokens) / rate
+end
+return {allowed, tostring(tokens), tostring(wait)}
+"""
+
+
+class TokenQuota:
+    """
+    This class contains the TokenQuota.
+
+    Per-user token buckets in Redis, measured in prompt and generated tokens.
+    The bucket size and refill rate of a user are the largest of their role
+    quotas, or the defaults, and a capacity of 0 disables the quota.
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        capacity: int = 0,
+        refill_per_minute: int = 0,
+        roles: Dict[int, Tuple[int, int]] = None,
+        prefix: str = "dolphin:quota"
+    ) -> None:
+        self.redis = redis
+        self.capacity = capacity
+        self.refill_per_minute = refill_per_minute
+        self.roles = roles or {}
+        self.prefix = prefix
+        self.script = redis.register_script(TOKEN_BUCKET)
+
+    @staticmethod
+    def parse_roles(roles: str) -> Dict[int, Tuple[int, int]]:
+        """
+        function parse_roles parse the `role-id:capacity:refill-per-minute` entries
+        """
+        parsed = {}
+        for role_str in filter(None, roles.split(",")):
+            role, capacity, refill = role_str.split(":")
+            parsed[int(role)] = (int(capacity), int(refill))
+        return parsed
+
+    def limits(self, author) -> Tuple[int, int]:
+        """
+        function limits return the bucket capacity and refill per minute of an author
+        """
+        limits = [(self.capacity, self.refill_per_minute)]
+        limits.extend(
+            self.roles[int(role.id)] for role in getattr(author, "roles", [])
+            if int(role.id) in self.roles
+        )
+        return max(limits)
+
+    def enabled(self, author) -> bool:
+        """
+        function enabled check if the author has a quota
+        """
+        capacity, refill = self.limits(author)
+        return capacity > 0 and refill > 0
+
+    async def take(self, author, cost: int) -> Tuple[bool, float, float]:
+        """
+        function take reserve `cost` tokens, returning if allowed, the tokens left
+        and the seconds until the bucket holds the cost
+        """
+        capacity, refill = self.limits(author)
+        started = time.monotonic()
+        allowed, tokens, wait = await self.script(
+            keys=[f"{self.prefix}:{author.id}"],
+            args=[capacity, refill / 60, min(cost, capacity)]
+        )
+        REDIS_SECONDS.observe(time.monotonic() - started, op="quota")
+        return bool(int(allowed)), float(tokens), float(wait)
+
+    async def refund(self, author, tokens: int) -> None:
+        """
+        function refund give back the reserved tokens that were not used
+        """
+        if tokens > 0:
+            await self.take(author, -tokens)
@@ -0,0 +1,214 @@
+"""
+This module contains the streaming embed renderer for bot.
+"""
+
+import asyncio
+import copy
+import time
+
+from typing import Iterator, List, Optional
+
+from interactions import Embed, EmbedFooter, Message, SlashContext
+from interactions.api.http.route import Route
+
+from utils.metrics import DISCORD_EDIT_SECONDS
+
+EMBED_LIMIT = 4096
+MESSAGE_LIMIT = 6000
+FENCE = "```"
+
+
+def split_pages(text: str, limits: Iterator[int]) -> List[str]:
+    """
+    function split_pages split text at line/word boundaries, keeping code fences balanced
+    """
+    pages = []
+    reopen = ""
+    while text:
+        limit = next(limits) - len(reopen) - len(FENCE) - 1
+        page = text
+        if len(text) > limit:
+            cut = text.rfind("\n", limit // 2, limit)
+            if cut == -1:
+                cut = text.rfind(" ", limit // 2, limit)
+            if cut == -1:
+                cut = limit
+            page = text[:cut]
+        text = text[len(page):]
+        if text[:1] in ("\n", " "):
+            text = text[1:]
+        page = reopen + page
+        reopen = ""
+        if page.count(FENCE) % 2 == 1:
+            lang = page[page.rfind(FENCE) + len(FENCE):].split("\n", 1)[0]
+            page = f"{page}\n{FENCE}"
+            reopen = f"{FENCE}{lang}\n" if text else ""
+        pages.append(page)
+    return pages or [""]
+
+
+# the pacing state of one streamed answer is read on every delta, keep it flat
+class EmbedRenderer:  # pylint: disable=too-many-instance-attributes
+    """
+    This class contains the EmbedRenderer.
+
+    Buffers the streamed deltas and edits the response only when it is due:
+    no faster than the Discord bucket and the measured edit latency allow,
+    and only once enough new text arrived for the current token rate.
+    Pages that do not fit the original message go to follow-up messages,
+    and a message is only edited when its embeds changed.
+    """
+
+    def __init__(
+        self,
+        ctx: SlashContext,
+        embeds: List[Embed],
+        min_interval: float = 0.6,
+        max_interval: float = 3.0,
+        min_chars: int = 48
+    ) -> None:
+        self.ctx = ctx
+        self.header = embeds[:2]
+        self.answer = embeds[2]
+        self.footer = embeds[2].footer
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.min_chars = min_chars
+        self.text = ""
+        self.pending: List[str] = []
+        self.pending_chars = 0
+        self.last_flush = 0.0
+        self.edit_latency = 0.0
+        self.followups: List[Message] = []
+        self.sent: List[tuple] = []
+        self.edits = 0
+
+    def feed(self, delta: str) -> None:
+        """
+        function feed buffer a streamed delta
+        """
+        self.pending.append(delta)
+        self.pending_chars += len(delta)
+
+    def response(self) -> str:
+        """
+        function response return the whole buffered text
+        """
+        if self.pending:
+            self.text += "".join(self.pending)
+            self.pending = []
+            self.pending_chars = 0
+        return self.text
+
+    def bucket_delay(self) -> float:
+        """
+        function bucket_delay spread the remaining calls of the Discord bucket over its reset
+        """
+        route = Route(
+            "PATCH",
+            "/webhooks/{application_id}/{interaction_token}/messages/{message_id}",
+            application_id=self.ctx.client.app.id,
+            interaction_token=self.ctx.token,
+            message_id="@original"
+        )
+        lock = self.ctx.client.http.get_ratelimit(route)
+        return lock.delta / max(lock.remaining, 1)
+
+    def due(self) -> bool:
+        """
+        function due check if an edit should be sent now
+        """
+        if self.pending_chars == 0:
+            return False
+        elapsed = time.monotonic() - self.last_flush
+        if elapsed < max(self.min_interval, self.edit_latency, self.bucket_delay()):
+            return False
+        return self.pending_chars >= self.min_chars or elapsed >= self.max_interval
+
+    def pages(self, text: str, strike: bool = False) -> List[str]:
+        """
+        function pages split the text for the original and the follow-up messages
+        """
+        wrap = 4 if strike else 0
+        used = sum(len(embed) for embed in self.header) + len(self.footer.text or "")
+
+        def limits() -> Iterator[int]:
+            first = min(EMBED_LIMIT, MESSAGE_LIMIT - used)
+            yield first - wrap
+            if MESSAGE_LIMIT - used - first >= 512:
+                yield MESSAGE_LIMIT - used - first - wrap
+            while True:
+                yield EMBED_LIMIT - wrap
+
+        pages = split_pages(text, limits())
+        if strike:
+            pages = [f"~~{page}~~" if page else page for page in pages]
+        return pages
+
+    def layout(self, pages: List[str]) -> List[List[Embed]]:
+        """
+        function layout build the embeds of each message
+        """
+        answer = [copy.copy(self.answer)]
+        answer[0].description = pages[0]
+        room = MESSAGE_LIMIT - sum(len(embed) for embed in self.header) - len(pages[0])
+        rest = pages[1:]
+        if rest and len(rest[0]) + len(self.footer.text or "") <= room:
+            answer.append(Embed(description=rest.pop(0)))
+        messages = [[*self.header, *answer]] + [[Embed(description=page)] for page in rest]
+        for embeds in messages:
+            embeds[-1].footer = None
+        messages[-1][-1].footer = EmbedFooter(text=self.footer.text, icon_url=self.footer.icon_url)
+        return messages
+
+    async def flush(self, components: Optional[list] = None, strike: bool = False) -> None:
+        """
+        function flush send the edits of the messages that changed
+        """
+        text = self.response()
+        if strike:
+            for embed in self.header[1:]:
+                if not embed.description.startswith("~~"):
+                    embed.description = f"~~{embed.description}~~"
+        messages = self.layout(self.pages(text, strike))
+        started = time.monotonic()
+        for index, embeds in enumerate(messages):
+            signature = (
+                tuple(embed.description for embed in embeds),
+                repr(components) if index == 0 else None
+            )
+            if index < len(self.sent) and self.sent[index] == signature:
+                continue
+            edit_started = time.monotonic()
+            if index == 0:
+                await self.ctx.edit(embeds=embeds, components=components or [])
+            elif index <= len(self.followups):
+                await self.followups[index - 1].edit(embeds=embeds)
+            else:
+                self.followups.append(await self.ctx.send(embeds=embeds))
+            DISCORD_EDIT_SECONDS.observe(time.monotonic() - edit_started)
+            if index < len(self.sent):
+                self.sent[index] = signature
+            else:
+                self.sent.append(signature)
+            self.edits += 1
+        self.last_flush = time.monotonic()
+        self.edit_latency = self.last_flush - started
+
+    async def update(self, components: Optional[list] = None) -> None:
+        """
+        function update flush the buffered deltas when an edit is due
+        """
+        if self.due():
+            await self.flush(components)
+
+    async def finish(self, components: Optional[list] = None, strike: bool = False) -> str:
+        """
+        function finish render the final response and return it
+        """
+        self.text = self.response().replace("<|im_end|>", "")
+        wait = max(self.min_interval, self.bucket_delay()) - (time.monotonic() - self.last_flush)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await self.flush(components, strike)
+        return self.text
@@ -0,0 +1,106 @@
+"""
+This module contains the exact-match response cache for bot.
+"""
+
+import asyncio
+import hashlib
+import json
+import time
+
+from typing import AsyncIterator, Dict, List, Optional
+
+from llama_index.core.llms import ChatMessage
+from redis.asyncio import Redis
+
+from utils.metrics import RESPONSE_CACHE_TOTAL
+
+
+class ResponseCache:
+    """
+    This class contains the ResponseCache.
+
+    Stores finished answers in Redis with a TTL, keyed by model, normalised
+    system prompt, history, prompt and sampling params. An index sorted set
+    caps the number of entries, dropping the oldest ones first.
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        size: int = 0,
+        ttl: int = 3600,
+        max_temperature: float = 0.1,
+        prefix: str = "dolphin:response"
+    ) -> None:
+        self.redis = redis
+        self.size = size
+        self.ttl = ttl
+        self.max_temperature = max_temperature
+        self.prefix = prefix
+
+    def cacheable(self, params: Dict) -> bool:
+        """
+        function cacheable check if the cache is enabled for these sampling params
+        """
+        return self.size > 0 and params["temperature"] <= self.max_temperature
+
+    def key(
+        self,
+        model: str,
+        system_prompt: str,
+        messages: List[ChatMessage],
+        prompt: str,
+        params: Dict
+    ) -> str:
+        """
+        function key hash everything that determines the answer
+        """
+        history = hashlib.sha256()
+        for message in messages:
+            history.update(f"{message.role}\0{message.content}\0".encode("utf-8"))
+        payload = json.dumps([
+            model,
+            " ".join((system_prompt or "").split()),
+            history.hexdigest(),
+            prompt.strip(),
+            params
+        ], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        """
+        function get return the cached answer
+        """
+        response = await self.redis.get(f"{self.prefix}:{key}")
+        RESPONSE_CACHE_TOTAL.inc(result="miss" if response is None else "hit")
+        if response is None:
+            return None
+        return response.decode("utf-8") if isinstance(response, bytes) else response
+
+    async def put(self, key: str, response: str) -> None:
+        """
+        function put store an answer and trim the oldest entries over the size cap
+        """
+        index = f"{self.prefix}:index"
+        now = time.time()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.set(f"{self.prefix}:{key}", response, ex=self.ttl)
+            pipe.zadd(index, {key: now})
+            pipe.zremrangebyscore(index, 0, now - self.ttl)
+            pipe.zrange(index, 0, -self.size - 1)
+            pipe.zremrangebyrank(index, 0, -self.size - 1)
+            results = await pipe.execute()
+        overflow = results[3]
+        if overflow:
+            await self.redis.delete(*[
+                f"{self.prefix}:{item.decode('utf-8') if isinstance(item, bytes) else item}"
+                for item in overflow
+            ])
+
+    async def replay(self, response: str, chunk: int = 32) -> AsyncIterator[str]:
+        """
+        function replay stream a cached answer like a generation
+        """
+        for start in range(0, len(response), chunk):
+            yield response[start:start + chunk]
+            await asyncio.sleep(0)
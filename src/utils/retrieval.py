@@ -0,0 +1,260 @@
+"""
+This module contains the memory-mapped document retrieval for bot.
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import time
+
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from utils.metrics import RETRIEVAL_SECONDS
+
+DEFAULT_EMBED_MODEL = "BAAI/bge-small-en-v1.5"
+SEARCH_BLOCK = 65536
+
+logger = logging.getLogger(__name__)
+
+
+def embed_model(name: str):
+    """
+    function embed_model load a HuggingFace embedding model on CPU
+
+    Loading pulls in torch, so it is only imported when an index is used.
+    """
+    # pylint: disable-next=import-outside-toplevel
+    from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+    return HuggingFaceEmbedding(model_name=name, device="cpu")
+
+
+def quantize(embeddings: np.ndarray, dtype: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    function quantize return the stored rows and their dequantisation scales
+
+    int8 rows are scaled symmetrically per row, float16 rows keep a scale of 1.
+    """
+    embeddings = embeddings.astype(np.float32)
+    if dtype == "float16":
+        return embeddings.astype(np.float16), np.ones(len(embeddings), dtype=np.float32)
+    scales = np.abs(embeddings).max(axis=1) / 127
+    scales[scales == 0] = 1
+    rows = np.clip(np.rint(embeddings / scales[:, None]), -127, 127).astype(np.int8)
+    return rows, scales.astype(np.float32)
+
+
+def build_index(
+    input_dir: str,
+    output_dir: str,
+    model_name: str = DEFAULT_EMBED_MODEL,
+    dtype: str = "float16",
+    batch_size: int = 64,
+    chunk_size: int = 512,
+    chunk_overlap: int = 64
+) -> int:
+    """
+    function build_index embed a document directory into an index directory
+
+    Writes vectors.npy (float16 or int8 rows), scales.npy and norms.npy
+    (float32 per row), chunks.jsonl with offsets.npy to slice it, and
+    meta.json last so a half-written index is never loaded. Returns the
+    number of chunks.
+    """
+    # pylint: disable-next=import-outside-toplevel
+    from llama_index.core import SimpleDirectoryReader
+    # pylint: disable-next=import-outside-toplevel
+    from llama_index.core.node_parser import SentenceSplitter
+
+    documents = SimpleDirectoryReader(input_dir, recursive=True).load_data()
+    nodes = SentenceSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    ).get_nodes_from_documents(documents)
+    if not nodes:
+        raise ValueError(f"No documents to index in {input_dir}")
+    os.makedirs(output_dir, exist_ok=True)
+    model = embed_model(model_name)
+    offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+    vectors = scales = norms = None
+    with open(os.path.join(output_dir, "chunks.jsonl"), "wb") as chunks_file:
+        for start in range(0, len(nodes), batch_size):
+            batch = nodes[start:start + batch_size]
+            started = time.perf_counter()
+            embeddings = np.asarray(
+                model.get_text_embedding_batch([node.get_content() for node in batch]),
+                dtype=np.float32
+            )
+            if vectors is None:
+                shape = (len(nodes), embeddings.shape[1])
+                vectors = np.lib.format.open_memmap(
+                    os.path.join(output_dir, "vectors.npy"), mode="w+", dtype=dtype, shape=shape
+                )
+                scales = np.lib.format.open_memmap(
+                    os.path.join(output_dir, "scales.npy"), mode="w+",
+                    dtype=np.float32, shape=(len(nodes),)
+                )
+                norms = np.lib.format.open_memmap(
+                    os.path.join(output_dir, "norms.npy"), mode="w+",
+                    dtype=np.float32, shape=(len(nodes),)
+                )
+            end = start + len(batch)
+            vectors[start:end], scales[start:end] = quantize(embeddings, dtype)
+            # norms of the stored rows, so the cosine matches what search dequantises
+            norms[start:end] = np.linalg.norm(
+                vectors[start:end].astype(np.float32) * scales[start:end, None], axis=1
+            )
+            for index, node in enumerate(batch, start=start):
+                chunks_file.write(json.dumps({
+                    "text": node.get_content(),
+                    "source": node.metadata.get("file_name", "")
+                }).encode("utf-8") + b"\n")
+                offsets[index + 1] = chunks_file.tell()
+            logger.info("Embedded %s/%s chunks in %.2fs", end, len(nodes),
+                        time.perf_counter() - started)
+    for array in (vectors, scales, norms):
+        array.flush()
+    np.save(os.path.join(output_dir, "offsets.npy"), offsets)
+    with open(os.path.join(output_dir, "meta.json"), "w", encoding="utf-8") as meta_file:
+        json.dump({
+            "model": model_name,
+            "dtype": dtype,
+            "count": len(nodes),
+            "dim": int(vectors.shape[1])
+        }, meta_file)
+    return len(nodes)
+
+
+class VectorIndex:
+    """
+    This class contains the VectorIndex.
+
+    A read-only index memory-mapped from disk, so loading it only reads the
+    headers and the pages a search touches stay in the page cache. Search
+    dequantises the rows in blocks and ranks them by cosine similarity.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as meta_file:
+            self.meta = json.load(meta_file)
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.scales = np.load(os.path.join(path, "scales.npy"), mmap_mode="r")
+        self.norms = np.load(os.path.join(path, "norms.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.chunks = np.memmap(os.path.join(path, "chunks.jsonl"), dtype=np.uint8, mode="r")
+        if len(self.vectors) != self.meta["count"]:
+            raise ValueError(f"Index {path} holds {len(self.vectors)} of "
+                             f"{self.meta['count']} vectors")
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def chunk(self, index: int) -> Dict[str, str]:
+        """
+        function chunk return the text and source of a row
+        """
+        data = self.chunks[self.offsets[index]:self.offsets[index + 1]]
+        return json.loads(data.tobytes().decode("utf-8"))
+
+    def search(self, query: np.ndarray, top_k: int) -> List[Tuple[float, Dict[str, str]]]:
+        """
+        function search return the top_k chunks by cosine similarity, best first
+        """
+        query = np.asarray(query, dtype=np.float32)
+        scores = np.empty(len(self.vectors), dtype=np.float32)
+        for start in range(0, len(self.vectors), SEARCH_BLOCK):
+            end = start + SEARCH_BLOCK
+            scores[start:end] = self.vectors[start:end].astype(np.float32) @ query
+        scores *= self.scales
+        scores /= np.maximum(self.norms * np.linalg.norm(query), 1e-12)
+        top_k = min(top_k, len(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[index]), self.chunk(int(index))) for index in best]
+
+
+class Retriever:
+    """
+    This class contains the Retriever.
+
+    Embeds prompts with the model the index was built with and searches the
+    index on one CPU worker thread, keeping the event loop free. Query
+    embeddings are kept in an LRU cache.
+    """
+
+    def __init__(
+        self,
+        index: VectorIndex,
+        top_k: int = 4,
+        min_score: float = 0.0,
+        cache_size: int = 256
+    ) -> None:
+        self.index = index
+        self.top_k = top_k
+        self.min_score = min_score
+        self.cache_size = cache_size
+        self.cache: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.model = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="dolphin-retrieval"
+        )
+
+    def load(self) -> None:
+        """
+        function load load the embedding model, on the worker thread
+        """
+        if self.model is None:
+            started = time.perf_counter()
+            self.model = embed_model(self.index.meta["model"])
+            logger.info("Loaded embedding model %s in %.2fs", self.index.meta["model"],
+                        time.perf_counter() - started)
+
+    def embed(self, query: str) -> np.ndarray:
+        """
+        function embed return the cached or computed embedding of a query
+        """
+        key = " ".join(query.split())
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.load()
+        started = time.perf_counter()
+        embedding = np.asarray(self.model.get_query_embedding(key), dtype=np.float32)
+        RETRIEVAL_SECONDS.observe(time.perf_counter() - started, op="embed")
+        self.cache[key] = embedding
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return embedding
+
+    def search(self, query: str) -> List[Tuple[float, Dict[str, str]]]:
+        """
+        function search embed a query and return the chunks above min_score
+        """
+        embedding = self.embed(query)
+        started = time.perf_counter()
+        results = self.index.search(embedding, self.top_k)
+        RETRIEVAL_SECONDS.observe(time.perf_counter() - started, op="search")
+        return [(score, chunk) for score, chunk in results if score >= self.min_score]
+
+    async def warm(self) -> None:
+        """
+        function warm load the embedding model in the background
+        """
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.load)
+
+    async def retrieve(self, query: str) -> List[Tuple[float, Dict[str, str]]]:
+        """
+        function retrieve search the index for a prompt off the event loop
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.search, query)
+
+    def shutdown(self) -> None:
+        """
+        function shutdown stop the worker thread
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,260 @@
+"""
+This module contains the fair-share request scheduler for bot.
+"""
+
+import asyncio
+import itertools
+import threading
+import time
+
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from utils.metrics import QUEUE_DEPTH, REQUESTS_IN_FLIGHT
+
+
+class QueueFull(Exception):
+    """
+    This class contains the QueueFull error raised when the queue is at capacity.
+    """
+
+
+class Cancelled(Exception):
+    """
+    This class contains the Cancelled exception, raised when a queued request is cancelled.
+    """
+
+
+@dataclass(eq=False)
+class Ticket:
+    """
+    This class contains the Ticket of one queued request, compared by identity.
+    """
+
+    author: str
+    lane: int
+    priority: int
+    enqueued: float = field(default_factory=time.monotonic)
+    started: float = 0.0
+    granted: bool = False
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+class Lane:
+    """
+    This class contains the Lane of one model.
+
+    Waiting tickets are grouped by priority and author, authors of the same
+    priority are served round-robin.
+    """
+
+    def __init__(self, concurrent: int, duration: float) -> None:
+        self.concurrent = concurrent
+        self.running = 0
+        self.duration = duration
+        self.waiting: Dict[int, OrderedDict[str, Deque[Ticket]]] = {}
+
+    def size(self) -> int:
+        """
+        function size return the number of waiting tickets
+        """
+        return sum(
+            len(tickets) for authors in self.waiting.values() for tickets in authors.values()
+        )
+
+    def push(self, ticket: Ticket) -> None:
+        """
+        function push add a ticket at the end of its author queue
+        """
+        authors = self.waiting.setdefault(ticket.priority, OrderedDict())
+        authors.setdefault(ticket.author, deque()).append(ticket)
+
+    def remove(self, ticket: Ticket) -> None:
+        """
+        function remove drop a ticket that left before being granted
+        """
+        authors = self.waiting.get(ticket.priority, {})
+        tickets = authors.get(ticket.author)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del authors[ticket.author]
+            if not authors:
+                del self.waiting[ticket.priority]
+
+    def order(self) -> List[Ticket]:
+        """
+        function order return the waiting tickets in dispatch order
+        """
+        ordered = []
+        for priority in sorted(self.waiting, reverse=True):
+            queues = list(self.waiting[priority].values())
+            for turn in itertools.zip_longest(*queues):
+                ordered.extend(ticket for ticket in turn if ticket is not None)
+        return ordered
+
+    def head(self) -> Optional[Ticket]:
+        """
+        function head return the next ticket to dispatch
+        """
+        for priority in sorted(self.waiting, reverse=True):
+            for tickets in self.waiting[priority].values():
+                return tickets[0]
+        return None
+
+    def pop(self) -> Ticket:
+        """
+        function pop take the next ticket and rotate its author to the end
+        """
+        ticket = self.head()
+        authors = self.waiting[ticket.priority]
+        tickets = authors.pop(ticket.author)
+        tickets.popleft()
+        if tickets:
+            authors[ticket.author] = tickets
+        if not authors:
+            del self.waiting[ticket.priority]
+        return ticket
+
+
+class Scheduler:
+    """
+    This class contains the Scheduler.
+
+    Bounded queue in front of generation with one lane per model, a global
+    concurrency limit and per-author fair share inside each lane.
+    """
+
+    def __init__(
+        self,
+        concurrent: int = 1,
+        lane_concurrent: int = 1,
+        max_queue: int = 32,
+        duration: float = 30.0
+    ) -> None:
+        self.concurrent = concurrent
+        self.lane_concurrent = lane_concurrent
+        self.max_queue = max_queue
+        self.duration = duration
+        self.running = 0
+        self.lanes: Dict[int, Lane] = {}
+        self.quiet = asyncio.Event()
+        self.quiet.set()
+
+    def lane(self, index: int) -> Lane:
+        """
+        function lane return the lane of a model
+        """
+        if index not in self.lanes:
+            self.lanes[index] = Lane(self.lane_concurrent, self.duration)
+        return self.lanes[index]
+
+    def waiting(self) -> int:
+        """
+        function waiting return the number of queued requests
+        """
+        return sum(lane.size() for lane in self.lanes.values())
+
+    def status(self, ticket: Ticket) -> Tuple[int, float]:
+        """
+        function status return the queue position and the estimated wait in seconds
+        """
+        lane = self.lane(ticket.lane)
+        position = lane.order().index(ticket) + 1
+        wait = (position - 1 + lane.running) * lane.duration / lane.concurrent
+        return position, wait
+
+    async def idle(self) -> None:
+        """
+        function idle wait until nothing is running or queued
+        """
+        await self.quiet.wait()
+
+    def dispatch(self) -> None:
+        """
+        function dispatch grant the free slots and notify the waiting tickets
+        """
+        while self.running < self.concurrent:
+            ready = [
+                lane for lane in self.lanes.values()
+                if lane.running < lane.concurrent and lane.head() is not None
+            ]
+            if not ready:
+                break
+            lane = max(ready, key=lambda lane: (lane.head().priority, -lane.head().enqueued))
+            ticket = lane.pop()
+            ticket.granted = True
+            ticket.started = time.monotonic()
+            ticket.changed.set()
+            lane.running += 1
+            self.running += 1
+        QUEUE_DEPTH.set(self.waiting())
+        REQUESTS_IN_FLIGHT.set(self.running)
+        if self.running == 0 and self.waiting() == 0:
+            self.quiet.set()
+        else:
+            self.quiet.clear()
+        self.notify()
+
+    def notify(self) -> None:
+        """
+        function notify wake the waiting tickets to report their position or cancellation
+        """
+        for lane in self.lanes.values():
+            for authors in lane.waiting.values():
+                for tickets in authors.values():
+                    for ticket in tickets:
+                        ticket.changed.set()
+
+    def release(self, ticket: Ticket) -> None:
+        """
+        function release free the slot of a finished ticket
+        """
+        lane = self.lane(ticket.lane)
+        lane.running -= 1
+        self.running -= 1
+        lane.duration = 0.8 * lane.duration + 0.2 * (time.monotonic() - ticket.started)
+        self.dispatch()
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        author: str,
+        lane: int,
+        priority: int = 0,
+        on_position: Callable[[int, float], Awaitable[None]] = None,
+        stop: threading.Event = None
+    ):
+        """
+        function slot wait for a generation slot, reporting the queue position
+
+        Raises Cancelled when `stop` is set before the slot is granted, call
+        notify() after setting it to wake the waiting ticket.
+        """
+        if self.waiting() >= self.max_queue:
+            raise QueueFull(f"{self.waiting()} requests queued")
+        ticket = Ticket(author, lane, priority)
+        self.lane(lane).push(ticket)
+        self.dispatch()
+        try:
+            while not ticket.granted:
+                ticket.changed.clear()
+                if stop is not None and stop.is_set():
+                    raise Cancelled(f"{author} cancelled while queued")
+                if on_position is not None:
+                    await on_position(*self.status(ticket))
+                if not ticket.granted:
+                    await ticket.changed.wait()
+        except BaseException:
+            if ticket.granted:
+                self.release(ticket)
+            else:
+                self.lane(lane).remove(ticket)
+                self.dispatch()
+            raise
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
@@ -0,0 +1,126 @@
+"""
+This module contains the speculative decoding draft models for bot.
+"""
+
+import threading
+
+from typing import Optional, Tuple
+
+import numpy as np
+import numpy.typing as npt
+
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+
+class GGUFDraftModel(LlamaDraftModel):
+    """
+    This class contains the GGUFDraftModel.
+
+    Drafts greedily with a small GGUF sharing the target model's vocabulary,
+    reusing its KV cache across calls through the longest common prefix.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        num_pred_tokens: int = 4,
+        n_ctx: int = 8192,
+        n_threads: int = None,
+        n_gpu_layers: int = 0
+    ) -> None:
+        self.num_pred_tokens = num_pred_tokens
+        self.llm = Llama(
+            model_path=model_path,
+            n_ctx=n_ctx,
+            n_threads=n_threads,
+            n_gpu_layers=n_gpu_layers,
+            verbose=False,
+        )
+
+    def __call__(self, input_ids: npt.NDArray[np.intc], /, **kwargs) -> npt.NDArray[np.intc]:
+        draft = []
+        for token in self.llm.generate(input_ids.tolist(), top_k=1, temp=0.0, repeat_penalty=1.0):
+            if token == self.llm.token_eos():
+                break
+            draft.append(token)
+            if len(draft) >= self.num_pred_tokens:
+                break
+        return np.array(draft, dtype=np.intc)
+
+    def close(self) -> None:
+        """
+        function close free the draft model
+        """
+        self.llm.close()
+
+
+class SpeculativeDraft(LlamaDraftModel):
+    """
+    This class contains the SpeculativeDraft.
+
+    Wraps a draft model and counts the verification steps and drafted tokens,
+    from which the acceptance rate of a generation is estimated: every step
+    emits its accepted draft tokens plus one token sampled by the target.
+    """
+
+    def __init__(self, draft: LlamaDraftModel) -> None:
+        self.draft = draft
+        self.steps = 0
+        self.drafted = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, input_ids: npt.NDArray[np.intc], /, **kwargs) -> npt.NDArray[np.intc]:
+        tokens = self.draft(input_ids, **kwargs)
+        with self.lock:
+            self.steps += 1
+            self.drafted += len(tokens)
+        return tokens
+
+    def snapshot(self) -> Tuple[int, int]:
+        """
+        function snapshot return the steps and drafted tokens counted so far
+        """
+        with self.lock:
+            return self.steps, self.drafted
+
+    def acceptance(self, before: Tuple[int, int], tokens: int) -> Optional[float]:
+        """
+        function acceptance estimate the acceptance rate since `before` for `tokens` generated
+
+        Returns None when nothing was drafted, e.g. prompt lookup found no match.
+        """
+        steps, drafted = self.snapshot()
+        steps -= before[0]
+        drafted -= before[1]
+        if drafted <= 0:
+            return None
+        return min(1.0, max(0, tokens - steps) / drafted)
+
+    def close(self) -> None:
+        """
+        function close free the wrapped draft model
+        """
+        if hasattr(self.draft, "close"):
+            self.draft.close()
+
+
+def create_draft(
+    spec: Tuple[str, int],
+    n_ctx: int,
+    n_threads: int,
+    n_gpu_layers: int
+) -> SpeculativeDraft:
+    """
+    function create_draft build the counting draft model of a parsed spec
+    """
+    kind, tokens = spec
+    if kind == "lookup":
+        return SpeculativeDraft(LlamaPromptLookupDecoding(num_pred_tokens=tokens))
+    return SpeculativeDraft(GGUFDraftModel(
+        kind,
+        num_pred_tokens=tokens,
+        n_ctx=n_ctx,
+        n_threads=n_threads,
+        n_gpu_layers=n_gpu_layers
+    ))
@@ -0,0 +1,71 @@
+"""
+This module contains the chat transcript export for bot.
+"""
+
+import asyncio
+import gzip
+import shutil
+import tempfile
+
+from typing import AsyncIterator, BinaryIO, Callable, List, Tuple
+
+from llama_index.core.llms import ChatMessage
+
+SPOOL_SIZE = 1024 * 1024
+
+
+def spool() -> BinaryIO:
+    """
+    function spool return a buffer that moves to disk past SPOOL_SIZE
+    """
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE, mode="w+b")
+
+
+def compress(parts: List[BinaryIO]) -> BinaryIO:
+    """
+    function compress gzip the parts into one buffer, leaving them rewound
+    """
+    compressed = spool()
+    with gzip.GzipFile(filename="chat.txt", mode="wb", fileobj=compressed) as archive:
+        for part in parts:
+            shutil.copyfileobj(part, archive)
+            part.seek(0)
+    return compressed
+
+
+async def export_transcript(
+    messages: AsyncIterator[ChatMessage],
+    speaker: Callable[[ChatMessage], str],
+    limit: int
+) -> List[Tuple[str, BinaryIO]]:
+    """
+    function export_transcript stream a transcript into upload files of at most `limit` bytes
+
+    Returns no file for an empty transcript, one chat.txt when it fits, else
+    one chat.txt.gz when the compressed transcript fits, else chat-N.txt parts
+    split at message boundaries.
+    """
+    parts = [spool()]
+    size = 0
+    async for message in messages:
+        line = f"{speaker(message)}:{message.content}\n".encode("utf-8")
+        if size and size + len(line) > limit:
+            parts.append(spool())
+            size = 0
+        parts[-1].write(line)
+        size += len(line)
+    if size == 0:
+        parts[0].close()
+        return []
+    for part in parts:
+        part.seek(0)
+    if len(parts) == 1:
+        return [("chat.txt", parts[0])]
+    compressed = await asyncio.get_running_loop().run_in_executor(None, compress, parts)
+    if compressed.tell() <= limit:
+        for part in parts:
+            part.close()
+        compressed.seek(0)
+        return [("chat.txt.gz", compressed)]
+    compressed.close()
+    return [(f"chat-{index}.txt", part) for index, part in enumerate(parts, start=1)]
@@ -0,0 +1,420 @@
+"""
+This module contains the Redis work queue between bot and inference replicas.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Dict, List, Set, Tuple
+
+from dotenv import load_dotenv
+from redis.asyncio import Redis
+from redis.exceptions import RedisError, ResponseError
+
+from utils.client import result_deltas, wait_stop
+from utils.generation import StopSignal
+from utils.inflight import InflightRegistry, text
+from utils.metrics import ERRORS_TOTAL
+from utils.models import ModelPool
+
+load_dotenv()
+DOLPHIN_WORK_QUEUE = os.getenv('DOLPHIN_WORK_QUEUE', '0') == '1'
+DOLPHIN_REPLICA_ID = os.getenv('DOLPHIN_REPLICA_ID', f"{socket.gethostname()}-{os.getpid()}")
+
+HEARTBEAT_SECONDS = 3
+REPLICA_TTL = 10
+RESULT_TTL = 120
+GROUP = "workers"
+
+logger = logging.getLogger(__name__)
+
+
+def work_key(prefix: str, replica: str, kind: str) -> str:
+    """
+    function work_key return the job stream of a replica for a kind of job
+
+    Tokenize jobs get their own stream so they never wait behind generations.
+    """
+    return f"{prefix}:{'tokenize' if kind == 'tokenize' else 'work'}:{replica}"
+
+
+class ReplicaDirectory:
+    """
+    This class contains the ReplicaDirectory.
+
+    Every inference replica advertises the models it serves, the ones it has
+    loaded and its load under a key that expires without heartbeats. Jobs
+    go to the least loaded replica that already has their model loaded,
+    else to the least loaded one serving it.
+    """
+
+    def __init__(self, redis: Redis, prefix: str = "dolphin", refresh: float = 1.0) -> None:
+        self.redis = redis
+        self.prefix = prefix
+        self.refresh = refresh
+        self.cached: Tuple[float, Dict[str, Dict[str, Any]]] = (0.0, {})
+
+    async def advertise(
+        self,
+        replica: str,
+        models: List[str],
+        loaded: List[str],
+        active: int,
+        capacity: int
+    ) -> None:
+        """
+        function advertise publish the state of a replica for REPLICA_TTL seconds
+        """
+        key = f"{self.prefix}:replica:{replica}"
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(key, mapping={
+                "models": json.dumps(models),
+                "loaded": json.dumps(loaded),
+                "active": active,
+                "capacity": capacity
+            })
+            pipe.expire(key, REPLICA_TTL)
+            pipe.sadd(f"{self.prefix}:replicas", replica)
+            await pipe.execute()
+
+    async def replicas(self) -> Dict[str, Dict[str, Any]]:
+        """
+        function replicas return the live replicas, refreshed at most every `refresh` seconds
+        """
+        if time.monotonic() - self.cached[0] < self.refresh:
+            return self.cached[1]
+        members = [text(member) for member in await self.redis.smembers(f"{self.prefix}:replicas")]
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for replica in members:
+                pipe.hgetall(f"{self.prefix}:replica:{replica}")
+            states = await pipe.execute()
+        replicas = {}
+        for replica, state in zip(members, states):
+            if not state:
+                await self.redis.srem(f"{self.prefix}:replicas", replica)
+                continue
+            state = {text(key): text(value) for key, value in state.items()}
+            replicas[replica] = {
+                "models": json.loads(state["models"]),
+                "loaded": json.loads(state["loaded"]),
+                "active": int(state["active"]),
+                "capacity": max(1, int(state["capacity"]))
+            }
+        self.cached = (time.monotonic(), replicas)
+        return replicas
+
+    async def route(self, model: str) -> str:
+        """
+        function route return the replica a job of a model should go to
+        """
+        replicas = await self.replicas()
+        serving = [replica for replica, state in replicas.items() if model in state["models"]]
+        if not serving:
+            raise RuntimeError(f"No inference replica serves {model}")
+        replica = min(serving, key=lambda replica: (
+            model not in replicas[replica]["loaded"],
+            replicas[replica]["active"] / replicas[replica]["capacity"]
+        ))
+        # count the job until the next heartbeat so a burst spreads over the replicas
+        replicas[replica]["active"] += 1
+        return replica
+
+    async def alive(self, replica: str) -> bool:
+        """
+        function alive check if a replica still sends heartbeats
+        """
+        return bool(await self.redis.exists(f"{self.prefix}:replica:{replica}"))
+
+
+class WorkQueueClient:
+    """
+    This class contains the WorkQueueClient.
+
+    Same stream/complete interface as the InferenceClient, sending each job
+    to the stream of the replica picked by the ReplicaDirectory and reading
+    its deltas from a per-job result stream. Stopping a stream cancels the
+    job through the InflightRegistry. Blocking reads hold a connection each,
+    so the client gets its own Redis pool.
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        models: List[dict],
+        registry: InflightRegistry,
+        prefix: str = "dolphin"
+    ) -> None:
+        self.redis = redis
+        self.models = models
+        self.registry = registry
+        self.prefix = prefix
+        self.directory = ReplicaDirectory(redis, prefix)
+
+    async def submit(self, kind: str, model: int, **payload) -> Tuple[str, str]:
+        """
+        function submit queue a job on the replica for its model, returning replica and job id
+        """
+        name = self.models[model]["name"]
+        replica = await self.directory.route(name)
+        job = uuid.uuid4().hex
+        await self.redis.xadd(work_key(self.prefix, replica, kind), {
+            "job": job,
+            "kind": kind,
+            "model": name,
+            "payload": json.dumps(payload)
+        }, maxlen=10000, approximate=True)
+        return replica, job
+
+    async def results(self, replica: str, job: str) -> AsyncIterator[Dict[str, Any]]:
+        """
+        function results yield the result items of a job until the replica goes away
+        """
+        key = f"{self.prefix}:result:{job}"
+        last = "0"
+        try:
+            while True:
+                response = await self.redis.xread({key: last}, count=64, block=1000)
+                if not response:
+                    if not await self.directory.alive(replica):
+                        raise RuntimeError(f"Inference replica {replica} went away")
+                    continue
+                for entry_id, fields in response[0][1]:
+                    last = entry_id
+                    yield json.loads(text(fields.get(b"item", fields.get("item"))))
+        finally:
+            await self.redis.delete(key)
+
+    async def stream(
+        self,
+        model: int,
+        prompt: str,
+        params: Dict,
+        stop: StopSignal = None
+    ) -> AsyncIterator[str]:
+        """
+        function stream yield the text deltas of a queued generation
+
+        Setting `stop` cancels the job on the replica running it.
+        """
+        replica, job = await self.submit("stream", model, prompt=prompt, params=params)
+        watcher = None
+        if stop is not None:
+            watcher = asyncio.create_task(self.watch(job, stop))
+        try:
+            async with aclosing(self.results(replica, job)) as results:
+                async for delta in result_deltas(results, stop):
+                    yield delta
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+
+    async def watch(self, job: str, stop: StopSignal) -> None:
+        """
+        function watch cancel the job as soon as the stop event is set
+        """
+        await wait_stop(stop)
+        await self.registry.cancel(job, getattr(stop, "reason", None) or "user")
+
+    async def complete(self, model: int, prompt: str, params: Dict) -> str:
+        """
+        function complete return the whole generated text
+        """
+        return "".join([delta async for delta in self.stream(model, prompt, params)])
+
+    async def count_tokens(self, model: int, texts: List[str]) -> List[int]:
+        """
+        function count_tokens count tokens with the model's tokenizer on a replica
+        """
+        replica, job = await self.submit("tokenize", model, texts=texts)
+        async with aclosing(self.results(replica, job)) as results:
+            async for item in results:
+                if "error" in item:
+                    raise RuntimeError(item["error"])
+                return item["counts"]
+        return []
+
+    def shutdown(self) -> None:
+        """
+        function shutdown close the Redis connections of the result streams
+        """
+        asyncio.get_event_loop().create_task(self.redis.aclose())
+
+
+# the worker ties the pool, the executor and the registry of a replica together
+class WorkQueueWorker:  # pylint: disable=too-many-instance-attributes
+    """
+    This class contains the WorkQueueWorker.
+
+    Runs on each inference replica: advertises the replica, consumes its
+    job streams through a consumer group and writes the results of each job
+    to its result stream, running at most `capacity` generations at once.
+    Tokenize jobs are cheap and run as they come. Cancels arrive through the
+    InflightRegistry.
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        replica: str,
+        pool: ModelPool,
+        generation,
+        registry: InflightRegistry,
+        capacity: int = 1,
+        prefix: str = "dolphin"
+    ) -> None:
+        self.redis = redis
+        self.replica = replica
+        self.pool = pool
+        self.generation = generation
+        self.registry = registry
+        self.capacity = capacity
+        self.prefix = prefix
+        self.key = work_key(prefix, replica, "stream")
+        self.tokenize_key = work_key(prefix, replica, "tokenize")
+        self.directory = ReplicaDirectory(redis, prefix)
+        self.names = [model["name"] for model in pool.models]
+        self.jobs: Set[asyncio.Task] = set()
+        self.tokenizing: Set[asyncio.Task] = set()
+        self.tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        """
+        function start begin the heartbeats, the cancel subscription and the consumer
+        """
+        self.registry.start()
+        self.tasks = [
+            asyncio.create_task(self.heartbeat()),
+            asyncio.create_task(self.consume(self.key, self.jobs, self.capacity)),
+            asyncio.create_task(self.consume(self.tokenize_key, self.tokenizing))
+        ]
+
+    async def heartbeat(self) -> None:
+        """
+        function heartbeat advertise the loaded models and load of this replica
+        """
+        loaded = []
+        while True:
+            try:
+                loaded = [self.names[index] for index in list(self.pool.loaded)]
+            except RuntimeError:
+                # a load on a worker thread changed the pool, keep the last known list
+                pass
+            try:
+                await self.directory.advertise(
+                    self.replica, self.names, loaded, len(self.jobs), self.capacity
+                )
+            except RedisError:
+                logger.warning("Replica heartbeat failed", exc_info=True)
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+
+    async def consume(self, key: str, jobs: Set[asyncio.Task], capacity: int = 0) -> None:
+        """
+        function consume start a task for every job queued on a stream
+
+        With a `capacity` only that many jobs of the stream run at once.
+        """
+        try:
+            await self.redis.xgroup_create(key, GROUP, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        await self.fail_orphans(key)
+        while True:
+            free = capacity - len(jobs) if capacity > 0 else 64
+            if free <= 0:
+                await asyncio.wait(jobs, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            try:
+                response = await self.redis.xreadgroup(
+                    GROUP, self.replica, {key: ">"}, count=free, block=1000
+                )
+            except RedisError:
+                logger.warning("Reading the job stream failed", exc_info=True)
+                await asyncio.sleep(1)
+                continue
+            for _, entries in response or []:
+                for entry_id, fields in entries:
+                    job = asyncio.create_task(self.handle(
+                        key, entry_id, {text(name): text(value) for name, value in fields.items()}
+                    ))
+                    jobs.add(job)
+                    job.add_done_callback(jobs.discard)
+
+    async def fail_orphans(self, key: str) -> None:
+        """
+        function fail_orphans fail the jobs delivered to an earlier run of this replica
+
+        Their results were lost with that run, and with a stable replica id
+        their clients would otherwise wait for a replica that is alive again.
+        """
+        error = {"error": f"Inference replica {self.replica} restarted"}
+        while True:
+            pending = await self.redis.xpending_range(
+                key, GROUP, "-", "+", 100, consumername=self.replica
+            )
+            if not pending:
+                return
+            for entry in pending:
+                entry_id = entry["message_id"]
+                for _, fields in await self.redis.xrange(key, entry_id, entry_id):
+                    await self.publish(text(fields.get(b"job", fields.get("job"))), error)
+                await self.redis.xack(key, GROUP, entry_id)
+                await self.redis.xdel(key, entry_id)
+
+    async def publish(self, job: str, item: Dict[str, Any]) -> None:
+        """
+        function publish append a result item to the stream of a job
+        """
+        key = f"{self.prefix}:result:{job}"
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.xadd(key, {"item": json.dumps(item)})
+            pipe.expire(key, RESULT_TTL)
+            await pipe.execute()
+
+    async def handle(self, key: str, entry_id, fields: Dict[str, str]) -> None:
+        """
+        function handle run one job and write its results
+        """
+        job = fields["job"]
+        try:
+            model = self.names.index(fields["model"])
+            payload = json.loads(fields["payload"])
+            if fields["kind"] == "tokenize":
+                counts = await self.generation.count_tokens(model, payload["texts"])
+                await self.publish(job, {"counts": counts})
+                return
+            stop = StopSignal()
+            await self.registry.add(job, stop, model=fields["model"])
+            try:
+                stream = self.generation.stream(
+                    model, payload["prompt"], payload["params"], stop=stop
+                )
+                async with aclosing(stream):
+                    async for delta in stream:
+                        await self.publish(job, {"delta": delta})
+                await self.publish(job, {"done": True})
+            finally:
+                await self.registry.remove(job)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            ERRORS_TOTAL.inc(kind=type(e).__name__)
+            logger.exception("Job %s failed", job)
+            await self.publish(job, {"error": f"{e}"})
+        finally:
+            await self.redis.xack(key, GROUP, entry_id)
+            await self.redis.xdel(key, entry_id)
+
+    async def close(self) -> None:
+        """
+        function close stop consuming and cancel the running jobs
+        """
+        for task in [*self.tasks, *self.jobs, *self.tokenizing]:
+            task.cancel()
+        await self.registry.close()
+        await self.redis.srem(f"{self.prefix}:replicas", self.replica)
+        await self.redis.delete(f"{self.prefix}:replica:{self.replica}")
@@ -0,0 +1,25 @@
+"""
+This module contains the shared fixtures of the tests.
+"""
+
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def run_redis():
+    """
+    fixture run_redis call a test body with an in-memory Redis shared by its clients
+    """
+    fakeredis = pytest.importorskip("fakeredis")
+
+    def run(coroutine_function):
+        async def main():
+            redis = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+            try:
+                return await coroutine_function(redis)
+            finally:
+                await redis.aclose()
+        return asyncio.run(main())
+    return run
@@ -0,0 +1,96 @@
+"""
+This module contains the tests of the cost-based admission control.
+"""
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+# pylint: disable=wrong-import-position
+from utils.admission import AdmissionController
+from utils.scheduler import Scheduler
+
+MODELS = [{"name": "large"}, {"name": "small"}]
+
+
+def controller(concurrent: int = 1, **kwargs) -> AdmissionController:
+    """
+    function controller return an admission controller of 10 tok/s and 100 tok/s prefill
+    """
+    settings = {"slo": 30.0, "min_tokens": 64, "decode_rate": 10.0, "prefill_rate": 100.0}
+    return AdmissionController(
+        Scheduler(concurrent=concurrent), MODELS, **{**settings, **kwargs}
+    )
+
+
+def test_plan_admits_everything_without_slo():
+    """
+    function test_plan_admits_everything_without_slo an SLO of 0 turns admission off
+    """
+    admission = controller(slo=0.0)
+    admission.admit(0, 1000.0)
+    assert admission.plan(0, 10000, 4096) == (0, 4096)
+
+
+def test_plan_admits_a_request_that_fits():
+    """
+    function test_plan_admits_a_request_that_fits an idle lane serves the full request
+    """
+    # 1s of prefill and 20s of decode fit the 30s SLO
+    assert controller().plan(0, 100, 200) == (0, 200)
+
+
+def test_plan_lowers_max_tokens():
+    """
+    function test_plan_lowers_max_tokens a request over the SLO gets the tokens that fit
+    """
+    admission = controller()
+    admission.admit(0, 10.0)
+    # 30s - 10s of backlog - 1s of prefill leaves 19s at 10 tok/s
+    assert admission.plan(0, 100, 400) == (0, 190)
+
+
+def test_plan_falls_back_to_the_other_model():
+    """
+    function test_plan_falls_back_to_the_other_model a busy lane sends the request elsewhere
+    """
+    admission = controller(concurrent=4, fallback=1)
+    admission.admit(0, 29.0)
+    assert admission.plan(0, 100, 200) == (1, 200)
+
+
+def test_plan_rejects_when_nothing_fits():
+    """
+    function test_plan_rejects_when_nothing_fits below min_tokens the request is shed
+    """
+    admission = controller(fallback=1)
+    admission.admit(0, 29.0)
+    admission.admit(1, 29.0)
+    assert admission.plan(0, 100, 200) is None
+    admission.release(0, 29.0)
+    admission.release(1, 29.0)
+    assert admission.plan(0, 100, 200) == (0, 200)
+
+
+def test_wait_counts_the_shared_slots():
+    """
+    function test_wait_counts_the_shared_slots other lanes hold the global slots too
+    """
+    admission = controller(concurrent=1)
+    admission.admit(1, 12.0)
+    assert admission.wait(0) == pytest.approx(12.0)
+    admission = controller(concurrent=4)
+    admission.admit(1, 12.0)
+    assert admission.wait(0) == pytest.approx(3.0)
+
+
+def test_observe_moves_the_decode_rate():
+    """
+    function test_observe_moves_the_decode_rate the measured rate feeds the cost
+    """
+    admission = controller()
+    assert admission.cost(0, 100, 100) == pytest.approx(11.0)
+    admission.observe(0, 300, 10.0)
+    assert admission.rate(0) == pytest.approx(14.0)
+    admission.observe(0, 1, 0.1)
+    assert admission.rate(0) == pytest.approx(14.0)
@@ -0,0 +1,79 @@
+"""
+This module contains the tests of the Redis token-bucket quotas.
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("redis")
+pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+# pylint: disable-next=wrong-import-position
+from utils.quota import TokenQuota
+
+
+def author(*roles: int) -> SimpleNamespace:
+    """
+    function author build a guild member with some role ids
+    """
+    return SimpleNamespace(id=42, roles=[SimpleNamespace(id=role) for role in roles])
+
+
+def test_take_allows_up_to_capacity(run_redis):
+    """
+    function test_take_allows_up_to_capacity a full bucket serves its capacity and then waits
+    """
+    async def body(redis):
+        quota = TokenQuota(redis, capacity=100, refill_per_minute=60)
+        allowed, tokens, _ = await quota.take(author(), 60)
+        assert allowed and tokens == pytest.approx(40, abs=1)
+        allowed, tokens, wait = await quota.take(author(), 60)
+        assert not allowed and tokens == pytest.approx(40, abs=1)
+        # 20 missing tokens at one token per second
+        assert wait == pytest.approx(20, abs=1)
+    run_redis(body)
+
+
+def test_refund_gives_tokens_back_up_to_capacity(run_redis):
+    """
+    function test_refund_gives_tokens_back_up_to_capacity unused reservations are returned
+    """
+    async def body(redis):
+        quota = TokenQuota(redis, capacity=100, refill_per_minute=60)
+        await quota.take(author(), 80)
+        await quota.refund(author(), 50)
+        allowed, tokens, _ = await quota.take(author(), 0)
+        assert allowed and tokens == pytest.approx(70, abs=1)
+        await quota.refund(author(), 500)
+        _, tokens, _ = await quota.take(author(), 0)
+        assert tokens == pytest.approx(100)
+    run_redis(body)
+
+
+def test_cost_is_capped_at_capacity(run_redis):
+    """
+    function test_cost_is_capped_at_capacity a request larger than the bucket can still run
+    """
+    async def body(redis):
+        quota = TokenQuota(redis, capacity=100, refill_per_minute=60)
+        allowed, tokens, _ = await quota.take(author(), 1000)
+        assert allowed and tokens == pytest.approx(0, abs=1)
+    run_redis(body)
+
+
+def test_roles_raise_the_limits(run_redis):
+    """
+    function test_roles_raise_the_limits the largest role quota applies
+    """
+    async def body(redis):
+        quota = TokenQuota(
+            redis, capacity=100, refill_per_minute=60, roles=TokenQuota.parse_roles("7:500:600")
+        )
+        assert quota.limits(author()) == (100, 60)
+        assert quota.limits(author(3, 7)) == (500, 600)
+        assert not TokenQuota(redis).enabled(author())
+        allowed, tokens, _ = await quota.take(author(7), 300)
+        assert allowed and tokens == pytest.approx(200, abs=10)
+    run_redis(body)
@@ -0,0 +1,56 @@
+"""
+This module contains the tests of the embed page splitting.
+"""
+
+import itertools
+
+import pytest
+
+pytest.importorskip("interactions")
+
+# pylint: disable-next=wrong-import-position
+from utils.renderer import FENCE, split_pages
+
+
+def test_split_pages_keeps_short_text():
+    """
+    function test_split_pages_keeps_short_text text under the limit is one page
+    """
+    assert split_pages("hello world", itertools.repeat(100)) == ["hello world"]
+    assert split_pages("", itertools.repeat(100)) == [""]
+
+
+def test_split_pages_cuts_at_line_boundaries():
+    """
+    function test_split_pages_cuts_at_line_boundaries pages end on a newline within the limit
+    """
+    text = "\n".join(f"line {index}" for index in range(40))
+    pages = split_pages(text, itertools.repeat(64))
+    assert all(len(page) <= 64 for page in pages)
+    assert "\n".join(pages) == text
+
+
+def test_split_pages_balances_fences():
+    """
+    function test_split_pages_balances_fences a fence cut by a page is closed and reopened
+    """
+    code = "\n".join(f"print({index})" for index in range(30))
+    text = f"Here:\n{FENCE}python\n{code}\n{FENCE}\nDone."
+    pages = split_pages(text, itertools.repeat(80))
+    assert len(pages) > 2
+    assert all(len(page) <= 80 for page in pages)
+    assert all(page.count(FENCE) % 2 == 0 for page in pages)
+    assert pages[0].endswith(f"\n{FENCE}")
+    assert all(page.startswith(f"{FENCE}python\n") for page in pages[1:-1])
+    assert pages[-1].endswith("Done.")
+
+
+def test_split_pages_uses_each_limit():
+    """
+    function test_split_pages_uses_each_limit the first page can have a smaller limit
+    """
+    text = " ".join(["word"] * 60)
+    pages = split_pages(text, iter([40, 200, 200]))
+    assert len(pages[0]) <= 40
+    assert all(len(page) <= 200 for page in pages[1:])
+    assert " ".join(pages) == text
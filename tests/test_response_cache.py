@@ -0,0 +1,74 @@
+"""
+This module contains the tests of the response cache keys.
+"""
+
+import pytest
+
+pytest.importorskip("redis")
+pytest.importorskip("llama_index.core")
+
+# pylint: disable=wrong-import-position
+from llama_index.core.llms import ChatMessage, MessageRole
+
+from utils.response_cache import ResponseCache
+
+PARAMS = {"max_tokens": 256, "temperature": 0.0, "top_k": 40, "top_p": 0.95}
+HISTORY = [
+    ChatMessage(role=MessageRole.USER, content="Hi"),
+    ChatMessage(role=MessageRole.ASSISTANT, content="Hello!")
+]
+
+
+def make_key(**changes) -> str:
+    """
+    function make_key return the key of a reference request with some parts changed
+    """
+    request = {
+        "model": "dolphin",
+        "system_prompt": "You are Dolphin.",
+        "messages": HISTORY,
+        "prompt": "What is Redis?",
+        "params": PARAMS,
+        **changes
+    }
+    return ResponseCache(None, size=8).key(**request)
+
+
+def test_key_is_stable():
+    """
+    function test_key_is_stable the same request maps to the same key
+    """
+    assert make_key() == make_key()
+    assert make_key(params=dict(reversed(PARAMS.items()))) == make_key()
+
+
+def test_key_normalises_whitespace():
+    """
+    function test_key_normalises_whitespace spacing of the system prompt and prompt is ignored
+    """
+    assert make_key(system_prompt="  You are\n Dolphin. ") == make_key()
+    assert make_key(prompt="What is Redis?\n") == make_key()
+
+
+@pytest.mark.parametrize("changes", [
+    {"model": "other"},
+    {"system_prompt": "You are someone else."},
+    {"messages": HISTORY[:1]},
+    {"messages": [HISTORY[1], HISTORY[0]]},
+    {"prompt": "What is Postgres?"},
+    {"params": {**PARAMS, "max_tokens": 128}},
+])
+def test_key_covers_every_input(changes):
+    """
+    function test_key_covers_every_input anything that changes the answer changes the key
+    """
+    assert make_key(**changes) != make_key()
+
+
+def test_cacheable_needs_size_and_low_temperature():
+    """
+    function test_cacheable_needs_size_and_low_temperature only near-greedy answers are cached
+    """
+    assert ResponseCache(None, size=8).cacheable(PARAMS)
+    assert not ResponseCache(None, size=0).cacheable(PARAMS)
+    assert not ResponseCache(None, size=8).cacheable({**PARAMS, "temperature": 0.7})
@@ -0,0 +1,139 @@
+"""
+This module contains the tests of the fair-share request scheduler.
+"""
+
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip("aiohttp")
+
+# pylint: disable-next=wrong-import-position
+from utils.scheduler import Cancelled, Lane, QueueFull, Scheduler, Ticket
+
+
+def test_lane_serves_authors_round_robin():
+    """
+    function test_lane_serves_authors_round_robin an author with a burst does not starve others
+    """
+    lane = Lane(concurrent=1, duration=1.0)
+    for author in ("alice", "alice", "alice", "bob", "carol"):
+        lane.push(Ticket(author, 0, 0))
+    served = [lane.pop().author for _ in range(5)]
+    assert served == ["alice", "bob", "carol", "alice", "alice"]
+    assert lane.size() == 0
+
+
+def test_lane_serves_higher_priority_first():
+    """
+    function test_lane_serves_higher_priority_first a priority role jumps the queue
+    """
+    lane = Lane(concurrent=1, duration=1.0)
+    lane.push(Ticket("alice", 0, 0))
+    lane.push(Ticket("bob", 0, 2))
+    lane.push(Ticket("carol", 0, 1))
+    assert [ticket.author for ticket in lane.order()] == ["bob", "carol", "alice"]
+    assert [lane.pop().author for _ in range(3)] == ["bob", "carol", "alice"]
+
+
+def test_lane_remove_keeps_identity():
+    """
+    function test_lane_remove_keeps_identity removing a ticket leaves equal-looking ones queued
+    """
+    lane = Lane(concurrent=1, duration=1.0)
+    first, second = Ticket("alice", 0, 0), Ticket("alice", 0, 0)
+    second.enqueued = first.enqueued
+    lane.push(first)
+    lane.push(second)
+    lane.remove(second)
+    assert lane.order() == [first]
+
+
+def test_scheduler_grants_in_fair_order():
+    """
+    function test_scheduler_grants_in_fair_order queued requests run one author at a time
+    """
+    async def run():
+        scheduler = Scheduler(concurrent=1, max_queue=8)
+        started = []
+        release = asyncio.Event()
+
+        async def request(author):
+            async with scheduler.slot(author, 0):
+                started.append(author)
+                await release.wait()
+
+        tasks = []
+        for author in ("alice", "alice", "alice", "bob"):
+            tasks.append(asyncio.create_task(request(author)))
+            await asyncio.sleep(0)
+        while len(started) < 4:
+            release.set()
+            await asyncio.sleep(0)
+            release.clear()
+            await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(*tasks)
+        return started, scheduler
+
+    started, scheduler = asyncio.run(run())
+    assert started == ["alice", "alice", "bob", "alice"]
+    assert scheduler.running == 0 and scheduler.waiting() == 0
+
+
+def test_scheduler_rejects_when_full():
+    """
+    function test_scheduler_rejects_when_full the queue is bounded
+    """
+    async def run():
+        scheduler = Scheduler(concurrent=1, max_queue=1)
+        hold = asyncio.Event()
+
+        async def request():
+            async with scheduler.slot("alice", 0):
+                await hold.wait()
+
+        running = asyncio.create_task(request())
+        queued = asyncio.create_task(request())
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFull):
+            async with scheduler.slot("bob", 0):
+                pass
+        hold.set()
+        await asyncio.gather(running, queued)
+
+    asyncio.run(run())
+
+
+def test_scheduler_cancels_queued_request():
+    """
+    function test_scheduler_cancels_queued_request a stopped ticket leaves the queue
+    """
+    async def run():
+        scheduler = Scheduler(concurrent=1, max_queue=4)
+        hold = asyncio.Event()
+        stop = threading.Event()
+
+        async def running():
+            async with scheduler.slot("alice", 0):
+                await hold.wait()
+
+        async def queued():
+            async with scheduler.slot("bob", 0, stop=stop):
+                pass
+
+        first = asyncio.create_task(running())
+        await asyncio.sleep(0)
+        second = asyncio.create_task(queued())
+        await asyncio.sleep(0)
+        stop.set()
+        scheduler.notify()
+        with pytest.raises(Cancelled):
+            await second
+        assert scheduler.waiting() == 0
+        hold.set()
+        await first
+        return scheduler
+
+    assert asyncio.run(run()).running == 0
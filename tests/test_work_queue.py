@@ -0,0 +1,144 @@
+"""
+This module contains the tests of the Redis work queue cancel path.
+"""
+
+import asyncio
+import json
+
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("redis")
+pytest.importorskip("dotenv")
+pytest.importorskip("fakeredis")
+
+# pylint: disable=wrong-import-position
+from utils.generation import StopSignal
+from utils.inflight import InflightRegistry
+from utils.work_queue import GROUP, WorkQueueWorker
+
+
+def test_cancel_stops_a_local_generation(run_redis):
+    """
+    function test_cancel_stops_a_local_generation the owner replica stops it directly
+    """
+    async def body(redis):
+        registry = InflightRegistry(redis, "a")
+        stop = StopSignal()
+        await registry.add("job", stop)
+        assert await registry.cancel("job", "user")
+        assert stop.is_set() and stop.reason == "user"
+        assert not await registry.cancel("missing", "user")
+    run_redis(body)
+
+
+def test_cancel_before_register_stops_at_once(run_redis):
+    """
+    function test_cancel_before_register_stops_at_once the flag key catches late registrations
+    """
+    async def body(redis):
+        await InflightRegistry(redis, "a").cancel("job", "deadline")
+        stop = StopSignal()
+        await InflightRegistry(redis, "b").add("job", stop)
+        assert stop.is_set() and stop.reason == "deadline"
+    run_redis(body)
+
+
+def test_cancel_reaches_the_owner_replica(run_redis):
+    """
+    function test_cancel_reaches_the_owner_replica the cancel is published to every replica
+    """
+    async def body(redis):
+        owner = InflightRegistry(redis, "a")
+        owner.start()
+        stop = StopSignal()
+        await owner.add("job", stop)
+        await asyncio.sleep(0.1)
+        assert await InflightRegistry(redis, "b").cancel("job", "user")
+        for _ in range(50):
+            if stop.is_set():
+                break
+            await asyncio.sleep(0.02)
+        await owner.close()
+        assert stop.reason == "user"
+    run_redis(body)
+
+
+def test_worker_fails_orphaned_jobs(run_redis):
+    """
+    function test_worker_fails_orphaned_jobs jobs of an earlier run get an error, not silence
+    """
+    async def body(redis):
+        pool = SimpleNamespace(models=[{"name": "small"}], loaded={})
+        worker = WorkQueueWorker(redis, "a", pool, None, InflightRegistry(redis, "a"))
+        await redis.xgroup_create(worker.key, GROUP, id="0", mkstream=True)
+        await redis.xadd(worker.key, {"job": "job", "kind": "stream", "model": "small"})
+        # delivered to the earlier run, which died before acknowledging it
+        await redis.xreadgroup(GROUP, "a", {worker.key: ">"})
+        await worker.fail_orphans()
+        (_, fields), = await redis.xrange("dolphin:result:job")
+        assert "restarted" in json.loads(fields[b"item"])["error"]
+        assert not await redis.xpending_range(worker.key, GROUP, "-", "+", 10)
+        assert await redis.xlen(worker.key) == 0
+    run_redis(body)
+
+
+class FakeGeneration:
+    """
+    This class contains the FakeGeneration, a generation held until released.
+    """
+
+    def __init__(self) -> None:
+        self.release = asyncio.Event()
+
+    async def stream(self, _model, _prompt, _params, stop=None):  # pylint: disable=unused-argument
+        """
+        function stream yield one delta once released
+        """
+        await self.release.wait()
+        yield "hi"
+
+    async def count_tokens(self, _model, texts):
+        """
+        function count_tokens count characters as tokens
+        """
+        return [len(text) for text in texts]
+
+
+def test_tokenize_runs_beside_full_capacity(run_redis):
+    """
+    function test_tokenize_runs_beside_full_capacity token counts do not wait for a slot
+    """
+    async def body(redis):
+        pool = SimpleNamespace(models=[{"name": "small"}], loaded={})
+        generation = FakeGeneration()
+        worker = WorkQueueWorker(redis, "a", pool, generation, InflightRegistry(redis, "a"))
+        payload = json.dumps({"prompt": "", "params": {}})
+        for job in ("first", "second"):
+            await redis.xadd(worker.key, {
+                "job": job, "kind": "stream", "model": "small", "payload": payload
+            })
+        await redis.xadd(worker.tokenize_key, {
+            "job": "count", "kind": "tokenize", "model": "small",
+            "payload": json.dumps({"texts": ["hello"]})
+        })
+        worker.start()
+        try:
+            for _ in range(100):
+                if await redis.exists("dolphin:result:count"):
+                    break
+                await asyncio.sleep(0.02)
+            (_, fields), = await redis.xrange("dolphin:result:count")
+            assert json.loads(fields[b"item"]) == {"counts": [5]}
+            # the one slot still holds the first generation
+            assert len(worker.jobs) == 1
+            generation.release.set()
+            for _ in range(100):
+                if await redis.exists("dolphin:result:second"):
+                    break
+                await asyncio.sleep(0.02)
+            assert await redis.exists("dolphin:result:second")
+        finally:
+            await worker.close()
+    run_redis(body)